@@ -0,0 +1,56 @@
+from collections import deque
+import queue
+import threading
+import time
+
+
+class DropOldestQueue:
+    def __init__(self, maxsize=0):
+        """Thread safe FIFO queue that never blocks the producer: when full, the oldest item is dropped.
+        Used between a receiving thread and a slower processing thread, stale frames are worth less than bounded latency.
+        Same get/put interface as queue.Queue, get raises queue.Empty.
+
+        Args:
+            maxsize (int, optional): maximum number of queued items, 0 means unbounded. Defaults to 0.
+        """
+        self.maxsize = maxsize
+        self._items = deque(maxlen=maxsize if maxsize > 0 else None)
+        self._not_empty = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item) -> bool:
+        """
+        Returns:
+            bool: True if an older item had to be dropped to make room
+        """
+        with self._not_empty:
+            dropped = self.maxsize > 0 and len(self._items) == self.maxsize
+            if dropped:
+                self.dropped += 1
+            # a full deque with maxlen discards from the other end
+            self._items.append(item)
+            self._not_empty.notify()
+        return dropped
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                if not self._items:
+                    raise queue.Empty
+            elif timeout is None:
+                while not self._items:
+                    self._not_empty.wait()
+            else:
+                deadline = time.monotonic() + timeout
+                while not self._items:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            return self._items.popleft()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        return len(self._items)
@@ -0,0 +1,88 @@
+from collections import deque
+import threading
+import numpy as np
+
+
+class FrameBufferPool:
+    def __init__(self, size=4, frame_shape=(1080, 1920, 3), dtype=np.uint8):
+        """Preallocated frame buffers reused by a camera instead of allocating a new array for every frame.
+        A buffer goes back to the pool once every holder released it, consumers keeping a frame beyond the new frame
+        callback call retain and later release. When all buffers are taken a temporary array is allocated and
+        counted as exhausted, capturing never waits for a consumer.
+
+        Args:
+            size (int, optional): number of buffers. Defaults to 4.
+            frame_shape (tuple, optional): shape of a frame. Defaults to (1080, 1920, 3).
+            dtype (optional): numpy dtype of a frame. Defaults to np.uint8.
+        """
+        self.size = size
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        # one contiguous allocation, buffer i is self._buffers[i]
+        self._buffers = np.empty((size,) + self.frame_shape, dtype=self.dtype)
+        self._refcounts = [0] * size
+        self._free = deque(range(size))
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.exhausted = 0
+        self.peak_in_use = 0
+
+    @property
+    def in_use(self) -> int:
+        return self.size - len(self._free)
+
+    @property
+    def statistics(self) -> dict:
+        return {
+            'pool_size': self.size,
+            'pool_in_use': self.in_use,
+            'pool_peak_in_use': self.peak_in_use,
+            'pool_acquired': self.acquired,
+            'pool_exhausted': self.exhausted
+        }
+
+    def matches(self, frame_shape: tuple, dtype) -> bool:
+        return self.frame_shape == tuple(frame_shape) and self.dtype == np.dtype(dtype)
+
+    def acquire(self) -> np.ndarray:
+        """
+        Returns:
+            np.ndarray: a free buffer with one reference held by the caller, its content is undefined
+        """
+        with self._lock:
+            self.acquired += 1
+            if not self._free:
+                self.exhausted += 1
+                return np.empty(self.frame_shape, dtype=self.dtype)
+            index = self._free.popleft()
+            self._refcounts[index] = 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        return self._buffers[index]
+
+    def retain(self, frame: np.ndarray):
+        # arrays not taken from the pool are ignored
+        index = self._index(frame)
+        if index is not None:
+            with self._lock:
+                self._refcounts[index] += 1
+
+    def release(self, frame: np.ndarray):
+        index = self._index(frame)
+        if index is None:
+            return
+        with self._lock:
+            if self._refcounts[index] == 0:
+                raise ValueError("Frame buffer released more often than it was acquired and retained.")
+            self._refcounts[index] -= 1
+            if self._refcounts[index] == 0:
+                self._free.append(index)
+
+    def _index(self, frame: np.ndarray):
+        # buffers are recognized by their address, views into a buffer do not count as the buffer itself
+        if not isinstance(frame, np.ndarray) or frame.shape != self.frame_shape or frame.dtype != self.dtype:
+            return None
+        offset = frame.__array_interface__['data'][0] - self._buffers.__array_interface__['data'][0]
+        frame_nbytes = self._buffers[0].nbytes
+        if offset < 0 or offset % frame_nbytes or offset // frame_nbytes >= self.size:
+            return None
+        return offset // frame_nbytes
@@ -0,0 +1,173 @@
+# On disk recording of camera frames, written by RecorderNode and replayed by ReplayCamera.
+#
+# A recording is a directory:
+#   recording.json     camera_info, frames_per_chunk and shape/dtype of every chunk
+#   index.bin          one fixed size record per frame: sequence, time_stamp, chunk, slot
+#   chunk_00000.raw    frames_per_chunk raw frames of one shape and dtype, back to back
+#
+# Chunks are memory mapped on both sides, writing a frame is one copy into the page cache and reading a frame is a
+# numpy view without any copy. The index is appended after the frame data, a recording cut short by a crash is
+# readable up to the last indexed frame. A new chunk starts when the current one is full. All frames of a recording
+# have the shape and dtype of the first one, replay streams them into a ring buffer of that shape.
+
+import json
+import os
+import numpy as np
+
+
+METADATA_FILE = 'recording.json'
+INDEX_FILE = 'index.bin'
+INDEX_DTYPE = np.dtype([('sequence', '<i8'), ('time_stamp', '<f8'), ('chunk', '<i4'), ('slot', '<i4')])
+
+
+class FrameRecordingWriter:
+    def __init__(self, path: str, frames_per_chunk=256, camera_info=None):
+        """
+        Args:
+            path (str): directory of the recording, created if missing, must not hold a recording yet
+            frames_per_chunk (int, optional): frames per chunk file. Defaults to 256.
+            camera_info (str, optional): description of the recorded camera. Defaults to None.
+        """
+        if os.path.exists(os.path.join(path, METADATA_FILE)):
+            raise FileExistsError(f"{path} already holds a recording.")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.frames_per_chunk = frames_per_chunk
+        self.camera_info = camera_info
+        self.frames = 0
+        # of the first frame, every later frame must match
+        self.frame_shape = None
+        self.dtype = None
+        self._chunks = []
+        self._chunk = None
+        self._slot = 0
+        self._index = open(os.path.join(path, INDEX_FILE), 'wb')
+        self._write_metadata()
+
+    def append(self, image: np.ndarray, sequence=0, timestamp=0.0) -> int:
+        """
+        Args:
+            image (np.ndarray): frame to record
+            sequence (int, optional): sequence number of the frame. Defaults to 0.
+            timestamp (float, optional): capture time, used for replay at recorded speed. Defaults to 0.0.
+
+        Returns:
+            int: number of the frame in the recording
+
+        Raises:
+            ValueError: the frame differs in shape or dtype from the first frame, eg. after a resolution change,
+                it belongs in a new recording
+        """
+        image = np.asarray(image)
+        if self.frame_shape is None:
+            self.frame_shape, self.dtype = image.shape, image.dtype
+        elif image.shape != self.frame_shape or image.dtype != self.dtype:
+            raise ValueError(f"Frame of shape {image.shape} and dtype {image.dtype} does not match the recording "
+                             f"{self.path} of shape {self.frame_shape} and dtype {self.dtype}.")
+        if self._chunk is None or self._slot == self.frames_per_chunk:
+            self._new_chunk(image.shape, image.dtype)
+        self._chunk[self._slot] = image
+        record = np.array([(sequence, timestamp if timestamp is not None else 0.0, len(self._chunks) - 1, self._slot)],
+                          dtype=INDEX_DTYPE)
+        self._index.write(record.tobytes())
+        self._slot += 1
+        self.frames += 1
+        return self.frames - 1
+
+    def flush(self):
+        if self._chunk is not None:
+            self._chunk.flush()
+        self._index.flush()
+
+    def close(self):
+        self._close_chunk()
+        self._index.close()
+        self._write_metadata()
+
+    def _new_chunk(self, shape: tuple, dtype):
+        self._close_chunk()
+        name = f"chunk_{len(self._chunks):05d}.raw"
+        self._chunk = np.memmap(os.path.join(self.path, name), mode='w+', dtype=dtype,
+                                shape=(self.frames_per_chunk,) + tuple(shape))
+        self._slot = 0
+        self._chunks.append({'file': name, 'shape': list(shape), 'dtype': np.dtype(dtype).str})
+        # readers find the new chunk before its first frame is indexed
+        self._write_metadata()
+
+    def _close_chunk(self):
+        if self._chunk is None:
+            return
+        self._chunk.flush()
+        filename = self._chunk.filename
+        used_bytes = self._slot * self._chunk[0].nbytes
+        self._chunk = None
+        # the last chunk is usually not full, give the preallocated space back
+        os.truncate(filename, used_bytes)
+
+    def _write_metadata(self):
+        metadata = {
+            'camera_info': self.camera_info,
+            'frames_per_chunk': self.frames_per_chunk,
+            'frames': self.frames,
+            'chunks': self._chunks
+        }
+        temporary_path = os.path.join(self.path, f"{METADATA_FILE}.tmp")
+        with open(temporary_path, 'w') as file:
+            json.dump(metadata, file, indent=2)
+        os.replace(temporary_path, os.path.join(self.path, METADATA_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FrameRecording:
+    def __init__(self, path: str):
+        """Read only access to a recording, frames are memory mapped views
+
+        Args:
+            path (str): directory of the recording
+        """
+        self.path = path
+        with open(os.path.join(path, METADATA_FILE)) as file:
+            self.metadata = json.load(file)
+        self.index = np.fromfile(os.path.join(path, INDEX_FILE), dtype=INDEX_DTYPE)
+        self._chunks = {}
+
+    @property
+    def camera_info(self):
+        return self.metadata.get('camera_info')
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self.index['time_stamp']
+
+    @property
+    def sequences(self) -> np.ndarray:
+        return self.index['sequence']
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, number: int) -> np.ndarray:
+        record = self.index[number]
+        return self._chunk(int(record['chunk']))[int(record['slot'])]
+
+    def __iter__(self):
+        for number in range(len(self)):
+            yield self[number]
+
+    def _chunk(self, number: int) -> np.memmap:
+        chunk = self._chunks.get(number)
+        if chunk is None:
+            description = self.metadata['chunks'][number]
+            dtype = np.dtype(description['dtype'])
+            shape = tuple(description['shape'])
+            filename = os.path.join(self.path, description['file'])
+            # closed chunks are truncated to the frames they hold
+            frames = os.path.getsize(filename) // (int(np.prod(shape)) * dtype.itemsize)
+            chunk = np.memmap(filename, mode='r', dtype=dtype, shape=(frames,) + shape)
+            self._chunks[number] = chunk
+        return chunk
@@ -1,34 +1,261 @@
-# A dummy ringbuffer, demo purpose
+# Shared memory ring buffer for handing camera frames to other processes without copying.
+#
+# Multiple child Python processes started via the multiprocessing module can read from a
+# ring buffer created in the parent process. One write counter is maintained for the single
+# writer (the camera), and one read cursor per consumer. Frames are stored in fixed-size slots
+# inside a multiprocessing.shared_memory block, readers get numpy views onto those slots.
+# Idea based on: https://github.com/bslatkin/ringbuffer/blob/master/ringbuffer.py
+#
+# Memory layout of the shared block:
+#   descriptor   int64[8]              size, num_readers, ndim, shape[4], frame_nbytes
+#   dtype        16 bytes              numpy dtype string, eg. b'|u1'
+#   counters     int64[1 + readers]    write counter followed by one read cursor per reader
+#   dropped      int64[readers]        frames a reader missed because the writer lapped it
+#   sequences    int64[size]           sequence number stored in each slot
+#   timestamps   float64[size]         capture timestamp stored in each slot
+#   frames       size * frame_nbytes   frame data, 64 bytes aligned
 
+from multiprocessing import shared_memory
+import numpy as np
+import time
 
-# Correct implementation should use shared memory based ring buffer in multiprocessing concept
-# See example at: https://github.com/bslatkin/ringbuffer/blob/master/ringbuffer.py
-# Quick overview: Allows multiple child Python processes started via the multiprocessing module
-# to read from a shared ring buffer in the parent process. For each child, a
-# pointer is maintained for the purpose of reading. One pointer is maintained by
-# for the purpose of writing. 
+
+_MAX_DIMS = 4
+_DESCRIPTOR_FIELDS = 8
+_DTYPE_FIELD_SIZE = 16
+_ALIGNMENT = 64
+
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
 
 
 class RingBuffer:
-    def __init__(self, size):
-        self.size = size
-        self.buffer = [None] * size
-        self.counter = 0
-        self.current_index = 0
+    def __init__(self, size=16, frame_shape=(1080, 1920, 3), dtype=np.uint8, num_readers=4, name=None):
+        """Fixed size frame ring buffer living in shared memory
+
+        Args:
+            size (int, optional): number of frame slots. Defaults to 16.
+            frame_shape (tuple, optional): shape of every frame stored in the buffer. Defaults to (1080, 1920, 3).
+            dtype (optional): numpy dtype of the frames. Defaults to np.uint8.
+            num_readers (int, optional): number of independent read cursors. Defaults to 4.
+            name (str, optional): attach to an existing buffer with this shared memory name instead of creating one.
+        """
+        if name is None:
+            if size <= 0 or num_readers <= 0:
+                raise ValueError("Ring buffer size and number of readers must be positive.")
+            if len(frame_shape) > _MAX_DIMS:
+                raise ValueError(f"Frames can have at most {_MAX_DIMS} dimensions.")
+            dtype = np.dtype(dtype)
+            frame_nbytes = int(np.prod(frame_shape)) * dtype.itemsize
+            total_size = self._layout(size, num_readers, frame_nbytes)['total']
+            self._shm = shared_memory.SharedMemory(create=True, size=total_size)
+            self._owner = True
+
+            descriptor = np.ndarray((_DESCRIPTOR_FIELDS,), dtype=np.int64, buffer=self._shm.buf)
+            descriptor[:] = 0
+            descriptor[0] = size
+            descriptor[1] = num_readers
+            descriptor[2] = len(frame_shape)
+            descriptor[3:3 + len(frame_shape)] = frame_shape
+            descriptor[7] = frame_nbytes
+            dtype_field = np.ndarray((_DTYPE_FIELD_SIZE,), dtype=np.uint8, buffer=self._shm.buf,
+                                     offset=_DESCRIPTOR_FIELDS * 8)
+            dtype_field[:] = 0
+            encoded_dtype = dtype.str.encode()
+            dtype_field[:len(encoded_dtype)] = np.frombuffer(encoded_dtype, dtype=np.uint8)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+
+        self._map_shared_memory()
+        if self._owner:
+            self._counters[:] = 0
+            self._dropped[:] = 0
+            self._sequences[:] = 0
+            self._timestamps[:] = 0
+
+    @classmethod
+    def attach(cls, name: str) -> "RingBuffer":
+        """Attach to a ring buffer created by another process
+
+        Args:
+            name (str): shared memory name of the buffer, see RingBuffer.name
+
+        Returns:
+            RingBuffer: buffer sharing the same frames and cursors
+        """
+        return cls(name=name)
+
+    @staticmethod
+    def _layout(size: int, num_readers: int, frame_nbytes: int) -> dict:
+        layout = {}
+        offset = _DESCRIPTOR_FIELDS * 8 + _DTYPE_FIELD_SIZE
+        layout['counters'] = offset
+        offset += (1 + num_readers) * 8
+        layout['dropped'] = offset
+        offset += num_readers * 8
+        layout['sequences'] = offset
+        offset += size * 8
+        layout['timestamps'] = offset
+        offset += size * 8
+        layout['frames'] = _align(offset)
+        layout['total'] = layout['frames'] + size * frame_nbytes
+        return layout
+
+    def _map_shared_memory(self):
+        buf = self._shm.buf
+        descriptor = np.ndarray((_DESCRIPTOR_FIELDS,), dtype=np.int64, buffer=buf)
+        self.size = int(descriptor[0])
+        self.num_readers = int(descriptor[1])
+        ndim = int(descriptor[2])
+        self.frame_shape = tuple(int(d) for d in descriptor[3:3 + ndim])
+        frame_nbytes = int(descriptor[7])
+        dtype_field = bytes(buf[_DESCRIPTOR_FIELDS * 8:_DESCRIPTOR_FIELDS * 8 + _DTYPE_FIELD_SIZE])
+        self.dtype = np.dtype(dtype_field.rstrip(b'\x00').decode())
+
+        layout = self._layout(self.size, self.num_readers, frame_nbytes)
+        self._counters = np.ndarray((1 + self.num_readers,), dtype=np.int64, buffer=buf, offset=layout['counters'])
+        self._dropped = np.ndarray((self.num_readers,), dtype=np.int64, buffer=buf, offset=layout['dropped'])
+        self._sequences = np.ndarray((self.size,), dtype=np.int64, buffer=buf, offset=layout['sequences'])
+        self._timestamps = np.ndarray((self.size,), dtype=np.float64, buffer=buf, offset=layout['timestamps'])
+        self._frames = np.ndarray((self.size,) + self.frame_shape, dtype=self.dtype, buffer=buf,
+                                  offset=layout['frames'])
+
+    def __reduce__(self):
+        # Child processes attach to the same shared memory instead of copying the frames
+        return (RingBuffer.attach, (self.name,))
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def counter(self) -> int:
+        return int(self._counters[0])
+
+    @property
+    def current_index(self) -> int:
+        return self.counter % self.size
+
+    def claim(self) -> np.ndarray:
+        """Return the slot that the next frame will be written to, so a camera can fill it in place.
+        The frame only becomes visible to readers after commit()
 
-    def add(self, item):
-        self.counter += 1
-        self.current_index = (self.counter) % self.size
-        self.buffer[self.current_index] = item
+        Returns:
+            np.ndarray: writable view onto the next slot
+        """
+        index = (self.counter + 1) % self.size
+        # the slot still holds the oldest readable frame, it stops being readable before it is written to
+        self._sequences[index] = 0
+        return self._frames[index]
+
+    def commit(self, timestamp=None) -> int:
+        """Publish the frame previously written into the claimed slot
+
+        Args:
+            timestamp (float, optional): capture time of the frame. Defaults to time.time().
+
+        Returns:
+            int: sequence number of the published frame
+        """
+        sequence = self.counter + 1
+        index = sequence % self.size
+        self._timestamps[index] = time.time() if timestamp is None else timestamp
+        self._sequences[index] = sequence
+        # update the write counter last, readers never see a half written slot as the latest one
+        self._counters[0] = sequence
+        return sequence
+
+    def add(self, item, timestamp=None) -> int:
+        """Copy a frame into the next slot and publish it
+
+        Args:
+            item (np.ndarray): frame matching frame_shape, converted to the buffer dtype if needed
+            timestamp (float, optional): capture time of the frame. Defaults to time.time().
+
+        Returns:
+            int: sequence number of the frame
+        """
+        np.copyto(self.claim(), item, casting='unsafe')
+        return self.commit(timestamp)
 
     def get_by_index(self, index):
-        return self.buffer[index]
+        return self._frames[index]
+
+    def get_by_sequence(self, sequence: int):
+        """Return a view of the frame with the given sequence number, None if it has been overwritten or not written yet"""
+        if sequence <= 0 or sequence > self.counter:
+            return None
+        index = sequence % self.size
+        if self._sequences[index] != sequence:
+            return None
+        return self._frames[index]
 
     def get_latest(self):
-        return self.buffer[self.current_index]
-    
-    def is_updated(self):
-        # dummy code: check if ring buffer is updated with newest frame
-        ring_buffer_updated = True
-        return ring_buffer_updated
+        if self.counter == 0:
+            return None
+        return self._frames[self.current_index]
+
+    def get_timestamp(self, sequence: int):
+        index = sequence % self.size
+        if self._sequences[index] != sequence:
+            return None
+        return float(self._timestamps[index])
+
+    def is_overwritten(self, sequence: int) -> bool:
+        """Readers holding a view should check this after using it, the writer may have lapped them in the meantime"""
+        return self._sequences[sequence % self.size] != sequence
+
+    def is_updated(self, reader=0) -> bool:
+        # check if ring buffer has a frame this reader has not consumed yet
+        return self.counter > self._counters[1 + reader]
+
+    def read(self, reader=0):
+        """Return the next unread frame for this reader and advance its cursor.
+        If the writer lapped the reader, the missed frames are skipped and counted as dropped.
+
+        Args:
+            reader (int, optional): read cursor index, each consumer process should use its own. Defaults to 0.
+
+        Returns:
+            tuple: (sequence, view) of the next frame, None if there is no new frame
+        """
+        latest = self.counter
+        cursor = int(self._counters[1 + reader])
+        if latest <= cursor:
+            return None
+        sequence = cursor + 1
+        oldest = latest - self.size + 1
+        if sequence < oldest:
+            self._dropped[reader] += oldest - sequence
+            sequence = oldest
+        self._counters[1 + reader] = sequence
+        return sequence, self._frames[sequence % self.size]
+
+    def read_latest(self, reader=0):
+        """Skip straight to the newest frame, older unread frames are counted as dropped
+
+        Returns:
+            tuple: (sequence, view) of the newest frame, None if there is no new frame
+        """
+        latest = self.counter
+        cursor = int(self._counters[1 + reader])
+        if latest <= cursor:
+            return None
+        self._dropped[reader] += latest - cursor - 1
+        self._counters[1 + reader] = latest
+        return latest, self._frames[latest % self.size]
+
+    def dropped(self, reader=0) -> int:
+        return int(self._dropped[reader])
+
+    def close(self):
+        # release numpy views before closing, shared memory refuses to close with exported buffers
+        self._counters = self._dropped = self._sequences = self._timestamps = self._frames = None
+        self._shm.close()
 
+    def unlink(self):
+        # only the creating process should free the shared memory
+        if self._owner:
+            self._shm.unlink()
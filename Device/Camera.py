@@ -1,3 +1,4 @@
+from Buffer.FrameBufferPool import FrameBufferPool
 from enum import Enum
 import numpy as np
 import time
@@ -15,22 +16,41 @@ class CameraType(Enum):
     TOF3D = 7
 
 
+# (channels, dtype) of the frames of each camera type, channels None for single channel (height, width) frames
+FRAME_FORMATS = {
+    CameraType.MONO: (None, np.uint8),
+    CameraType.Color: (3, np.uint8),
+    CameraType.MONO_NIR: (None, np.uint16),
+    CameraType.Color_NIR: (4, np.uint8),
+    CameraType.SWIR: (None, np.uint16),
+    CameraType.UV: (None, np.uint8),
+    # depth in meters
+    CameraType.Laser3D: (None, np.float32),
+    CameraType.TOF3D: (None, np.float32)
+}
+
 
 class Camera:
-    def __init__(self, cameratype: CameraType, resolution=(1920, 1080), framerate=30):
+    def __init__(self, cameratype: CameraType, resolution=(1920, 1080), framerate=30, buffer_pool_size=4):
         """A camera object that is used to capture frame, start streaming etc..
 
         Args:
             cameratype (CameraType): detailed information of this camera
             resolution (tuple, optional): basic camera setting. Defaults to (1920, 1080).
             framerate (int, optional): basic camera setting. Defaults to 30.
+            buffer_pool_size (int, optional): preallocated frame buffers, see FrameBufferPool. Frames copied by the
+                new frame callback (eg. into a RingBuffer) return to the pool right away, so a few suffice. Defaults to 4.
         """
         self._resolution = resolution
         self._framerate = framerate
         self._is_opened = False
         self._streaming = False
         self._new_frame_callback = None
+        self._streaming_thread = None
         self._cameratype = cameratype
+        self.buffer_pool_size = buffer_pool_size
+        # created on the first capture, and again when the resolution or camera type changed
+        self._frame_pool = None
 
     # Property for resolution
     @property
@@ -55,21 +75,41 @@ class Camera:
         self._framerate = value
     
     @property
-    def cameratype(self, value):
-        if not isinstance(value, CameraType):
-            raise ValueError("Camera Type invalid")
-        self._cameratype = value
+    def cameratype(self):
+        return self._cameratype
     
     @cameratype.setter
     def cameratype(self, value):
+        if not isinstance(value, CameraType):
+            raise ValueError("Camera Type invalid")
         self._cameratype = value
 
+    @property
+    def frame_shape(self) -> tuple:
+        # numpy shape of a frame, (height, width) or (height, width, channels)
+        width, height = self._resolution
+        channels, _ = FRAME_FORMATS[self._cameratype]
+        return (height, width) if channels is None else (height, width, channels)
+
+    @property
+    def dtype(self):
+        return np.dtype(FRAME_FORMATS[self._cameratype][1])
+
+    @property
+    def frame_pool(self) -> FrameBufferPool:
+        if self._frame_pool is None or not self._frame_pool.matches(self.frame_shape, self.dtype):
+            self._frame_pool = FrameBufferPool(self.buffer_pool_size, self.frame_shape, self.dtype)
+        return self._frame_pool
+
     @property
     def is_opened(self):
         return self._is_opened
 
     # Method to start streaming
     def start_streaming(self):
+        if self._streaming:
+            # already streaming, do not spawn a second capture thread
+            return
         self._streaming = True
         self._is_opened = True
         print(f"Streaming started with resolution {self._resolution} at {self._framerate} FPS.")
@@ -79,7 +119,7 @@ class Camera:
     # Method to stop streaming
     def stop_streaming(self):
         self._streaming = False
-        if self._streaming_thread.is_alive():
+        if self._streaming_thread is not None and self._streaming_thread.is_alive():
             self._streaming_thread.join()
 
     def is_opened(self):
@@ -89,15 +129,38 @@ class Camera:
 
     # Method to capture a new frame
     def capture_new_frame(self):
+        """Fill the next frame into a pooled buffer and pass it to the new frame callback. The buffer is reused
+        once the callback returned, a callback keeping the frame calls frame_pool.retain and later frame_pool.release.
+        Without a callback the frame is returned, the caller releases it to the frame_pool when done.
+        """
         if not self._streaming:
             print("Streaming is not started.")
             return
-        # Simulate capturing a frame
-        frame = np.ones(self.resolution)
-        if self._new_frame_callback:
+        pool = self.frame_pool
+        buffer = pool.acquire()
+        try:
+            # cameras may return their own array instead of filling the buffer, eg. a memmap of a recording
+            frame = self._read_frame_into(buffer)
+            if not self._new_frame_callback:
+                if frame is buffer:
+                    # the caller releases it
+                    buffer = None
+                return frame
             self._new_frame_callback(frame)
-        else:
-            return frame
+        finally:
+            if buffer is not None:
+                pool.release(buffer)
+
+    # Read one frame into a new array, eg. for a single capture outside of streaming
+    def _read_frame(self):
+        return self._read_frame_into(np.empty(self.frame_shape, dtype=self.dtype))
+
+    # Internal method reading one frame from the sensor into buffer, camera implementations override this.
+    # Returns the frame, usually buffer itself, an implementation may return a different array it owns instead
+    def _read_frame_into(self, buffer: np.ndarray) -> np.ndarray:
+        # Simulate capturing a frame
+        buffer.fill(1)
+        return buffer
 
     # Internal method to simulate streaming
     def _stream(self):
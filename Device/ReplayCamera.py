@@ -0,0 +1,71 @@
+from Device.Camera import Camera, CameraType
+from Buffer.FrameRecording import FrameRecording
+import time
+
+
+class ReplayCamera(Camera):
+    def __init__(self, path: str, realtime=True, speed=1.0, loop=False, cameratype=CameraType.Color):
+        """Camera streaming the frames of a recording made by RecorderNode, for offline reprocessing and for
+        reproducing what a production camera saw
+
+        Args:
+            path (str): directory of the recording, see Buffer/FrameRecording.py
+            realtime (bool, optional): keep the recorded frame intervals. Defaults to True, False streams as fast
+                as the consumer of the frames allows.
+            speed (float, optional): playback speed factor of realtime replay. Defaults to 1.0.
+            loop (bool, optional): start over at the end of the recording. Defaults to False, streaming stops.
+            cameratype (CameraType, optional): type of the recorded camera. Defaults to CameraType.Color.
+        """
+        self.recording = FrameRecording(path)
+        if len(self.recording) == 0:
+            raise ValueError(f"Recording {path} has no frames.")
+        formats = {(tuple(chunk['shape']), chunk['dtype']) for chunk in self.recording.metadata['chunks']}
+        if len(formats) > 1:
+            # frames are streamed into buffers of the first frame's shape
+            raise ValueError(f"Recording {path} mixes frame shapes or dtypes {sorted(formats)}, it can not be replayed.")
+        height, width = self.recording[0].shape[:2]
+        timestamps = self.recording.timestamps
+        duration = timestamps[-1] - timestamps[0]
+        framerate = int(round((len(timestamps) - 1) / duration)) if duration > 0 else 30
+        super().__init__(cameratype, (width, height), max(framerate, 1))
+        self.realtime = realtime
+        self.speed = speed
+        self.loop = loop
+        self.frame_index = 0
+
+    def frames(self):
+        # every recorded frame once, without streaming, eg. for offline regression runs
+        return iter(self.recording)
+
+    @property
+    def frame_shape(self) -> tuple:
+        return self.recording[0].shape
+
+    @property
+    def dtype(self):
+        return self.recording[0].dtype
+
+    def _read_frame_into(self, buffer):
+        # the memory mapped frame is passed on without a copy, the pooled buffer goes back unused
+        frame = self.recording[self.frame_index % len(self.recording)]
+        self.frame_index += 1
+        return frame
+
+    def _stream(self):
+        started = time.perf_counter()
+        first = self.frame_index
+        while self._streaming:
+            if self.frame_index >= len(self.recording):
+                if not self.loop:
+                    self._streaming = False
+                    break
+                self.frame_index = 0
+                started, first = time.perf_counter(), 0
+            if self.realtime:
+                # sleep until the frame is due, intervals are taken from the recorded timestamps
+                timestamps = self.recording.timestamps
+                due = (timestamps[self.frame_index] - timestamps[first]) / self.speed
+                delay = due - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            self.capture_new_frame()
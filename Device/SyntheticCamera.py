@@ -0,0 +1,119 @@
+from Device.Camera import Camera, CameraType
+import numpy as np
+import cv2
+import os
+
+
+class SyntheticCamera(Camera):
+    def __init__(self, resolution=(1920, 1080), framerate=30, num_bricks=3, clutter=20, empty_ratio=0.5,
+                 belt_speed=12, seed=0, source_dir=None):
+        """Reproducible camera for benchmarks and offline runs, renders a conveyor belt with red lego bricks
+        or replays the images of a directory. Frames are uint8 with 3 channels in OpenCV BGR order,
+        as LegoBrickRecognition expects.
+
+        Args:
+            resolution (tuple, optional): (width, height) of the frames. Defaults to (1920, 1080).
+            framerate (int, optional): frames per second while streaming. Defaults to 30.
+            num_bricks (int, optional): maximum number of bricks on the belt at once. Defaults to 3.
+            clutter (int, optional): number of non brick blobs (dust, other parts, red specks). Defaults to 20.
+            empty_ratio (float, optional): fraction of the belt cycle without any brick. Defaults to 0.5.
+            belt_speed (int, optional): pixels the belt moves per frame. Defaults to 12.
+            seed (int, optional): random seed, the same seed renders the same frame sequence. Defaults to 0.
+            source_dir (str, optional): replay the images of this directory in file name order instead of rendering.
+        """
+        super().__init__(CameraType.Color, resolution, framerate)
+        self.num_bricks = num_bricks
+        self.clutter = clutter
+        self.empty_ratio = empty_ratio
+        self.belt_speed = belt_speed
+        self.seed = seed
+        self.frame_index = 0
+
+        self._source_files = None
+        if source_dir is not None:
+            extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+            self._source_files = sorted(os.path.join(source_dir, name) for name in os.listdir(source_dir)
+                                        if name.lower().endswith(extensions))
+            if not self._source_files:
+                raise ValueError(f"No images found in {source_dir}")
+
+        width, height = resolution
+        rng = np.random.default_rng(seed)
+        # static belt texture and clutter, rendered once
+        self._background = rng.integers(15, 45, size=(height, width, 3), dtype=np.uint8)
+        self._add_clutter(self._background, rng)
+        # one brick layout per belt cycle
+        self._bricks = [self._random_brick(rng) for _ in range(num_bricks)]
+
+    def _read_frame_into(self, buffer: np.ndarray) -> np.ndarray:
+        frame = self.render_frame(self.frame_index, out=buffer)
+        self.frame_index += 1
+        return frame
+
+    def render_frame(self, index: int, out: np.ndarray = None) -> np.ndarray:
+        """
+        Args:
+            index (int): frame number, bricks move belt_speed pixels per frame
+            out (np.ndarray, optional): (height, width, 3) uint8 buffer rendered into. Defaults to None, a new array.
+
+        Returns:
+            np.ndarray: (height, width, 3) uint8 frame
+        """
+        if self._source_files is not None:
+            frame = self._load_frame(index)
+            if out is None:
+                return frame
+            np.copyto(out, frame)
+            return out
+
+        width, height = self.resolution
+        if out is None:
+            frame = self._background.copy()
+        else:
+            frame = out
+            np.copyto(frame, self._background)
+        # the belt runs along x, a cycle is the belt length plus the empty gap between brick groups
+        cycle_length = int(width / max(1 - self.empty_ratio, 1e-3))
+        for offset, y, brick_width, brick_height, studs_x, studs_y in self._bricks:
+            x = (index * self.belt_speed + offset) % cycle_length - brick_width
+            if -brick_width < x < width:
+                self._draw_brick(frame, int(x), y, brick_width, brick_height, studs_x, studs_y)
+        return frame
+
+    def _load_frame(self, index: int) -> np.ndarray:
+        frame = cv2.imread(self._source_files[index % len(self._source_files)], cv2.IMREAD_COLOR)
+        if (frame.shape[1], frame.shape[0]) != tuple(self.resolution):
+            frame = cv2.resize(frame, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def _random_brick(self, rng) -> tuple:
+        width, height = self.resolution
+        stud_pitch = max(height // 27, 8)
+        studs_x, studs_y = int(rng.integers(1, 5)), int(rng.integers(1, 3))
+        brick_width, brick_height = studs_x * stud_pitch, studs_y * stud_pitch
+        offset = int(rng.integers(0, width))
+        y = int(rng.integers(0, max(height - brick_height, 1)))
+        return offset, y, brick_width, brick_height, studs_x, studs_y
+
+    @staticmethod
+    def _draw_brick(frame, x, y, brick_width, brick_height, studs_x, studs_y):
+        # bright red body, studs drawn as darker rings so they segment as circles inside the rectangle
+        cv2.rectangle(frame, (x, y), (x + brick_width, y + brick_height), (20, 20, 230), -1)
+        pitch = brick_width // studs_x
+        radius = max(pitch // 4, 2)
+        for i in range(studs_x):
+            for j in range(studs_y):
+                center = (x + pitch // 2 + i * pitch, y + pitch // 2 + j * pitch)
+                cv2.circle(frame, center, radius, (10, 10, 110), max(radius // 3, 1))
+
+    def _add_clutter(self, frame, rng):
+        width, height = self.resolution
+        for _ in range(self.clutter):
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            if rng.random() < 0.3:
+                # small red specks, removed by the morphological opening
+                cv2.circle(frame, center, int(rng.integers(1, 3)), (0, 0, 255), -1)
+            else:
+                color = tuple(int(c) for c in rng.integers(40, 160, size=3))
+                axes = (int(rng.integers(3, 30)), int(rng.integers(3, 30)))
+                cv2.ellipse(frame, center, axes, float(rng.integers(0, 180)), 0, 360, color, -1)
@@ -5,4 +5,8 @@ from typing import Any
 class ImageProcessing(ABC):
     @abstractmethod
     def run(self, image: np.ndarray) -> Any:
-        pass
\ No newline at end of file
+        pass
+
+    def run_batch(self, images: list) -> list:
+        # Algorithms that can process several images in one pass (eg. DNN inference) should override this
+        return [self.run(image) for image in images]
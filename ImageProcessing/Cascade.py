@@ -0,0 +1,130 @@
+"""
+Two stage cascade: a cheap detector gates every frame, the expensive detector only sees crops of its candidates
+
+LegoBrickRecognition finds red bricks with a single OpenCV pass. Frames without a brick never reach the model, every
+other frame is cut into padded windows around the bricks found, the windows of all frames of a batch are classified
+together by LegoBrickSorting and its boxes are mapped back to full frame coordinates. A small brick fills a larger
+part of a window than of the full frame, so the model sees it at a higher effective resolution.
+"""
+
+from ImageProcessing.AbstractImageProcessing import ImageProcessing
+from ImageProcessing.Tracking import box_iou, crop_window
+import numpy as np
+
+
+def _to_numpy(values) -> np.ndarray:
+    # torch tensors (also on the GPU) and numpy arrays alike
+    if hasattr(values, 'detach'):
+        values = values.detach().cpu()
+    return np.asarray(values)
+
+
+def non_maximum_suppression(boxes: np.ndarray, scores: np.ndarray, iou_threshold=0.5) -> np.ndarray:
+    """
+    Args:
+        boxes (np.ndarray): (N, 4) boxes as (x1, y1, x2, y2)
+        scores (np.ndarray): (N,) scores of the boxes
+        iou_threshold (float, optional): boxes overlapping a better box more than this are dropped. Defaults to 0.5.
+
+    Returns:
+        np.ndarray: indices of the kept boxes, best score first
+    """
+    sizes = np.column_stack((boxes[:, :2], boxes[:, 2:] - boxes[:, :2]))
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order):
+        best = order[0]
+        keep.append(best)
+        order = order[1:][box_iou(sizes[best], sizes[order[1:]]) <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+class CascadeDetector(ImageProcessing):
+    def __init__(self, detector, classifier: ImageProcessing, crop_size=(256, 256), padding=16, iou_threshold=0.5,
+                 max_crop_batch=8):
+        """
+        Args:
+            detector: LegoBrickRecognition, or any object with detect_bricks(image) returning (x, y, width, height) boxes
+            classifier (ImageProcessing): detector run on the crops, eg. LegoBrickSorting, returning dicts with
+                'boxes' (x1, y1, x2, y2), 'scores' and 'labels' like torchvision detection models
+            crop_size (tuple, optional): (width, height) of the window around a candidate, grown for bricks larger than
+                the window minus the padding. Windows of equal size are classified in one batch. Defaults to (256, 256).
+            padding (int, optional): minimum context in pixels kept around a candidate. Defaults to 16.
+            iou_threshold (float, optional): overlap above which detections of neighbouring windows are merged.
+                Defaults to 0.5.
+            max_crop_batch (int, optional): most crops passed to the classifier at once, bounds its memory on frames
+                with many bricks. Defaults to 8.
+        """
+        self.detector = detector
+        self.classifier = classifier
+        self.crop_size = crop_size
+        self.padding = padding
+        self.iou_threshold = iou_threshold
+        self.max_crop_batch = max_crop_batch
+        self.frames_gated = 0
+        self.candidates = 0
+        self.crops_classified = 0
+
+    @property
+    def statistics(self) -> dict:
+        # exported by ImageProcessingNode next to its own counters
+        return {
+            'frames_gated': self.frames_gated,
+            'candidates': self.candidates,
+            'crops_classified': self.crops_classified
+        }
+
+    def run(self, image: np.ndarray) -> dict:
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list) -> list:
+        """
+        Returns:
+            list: per frame a dict of numpy arrays 'boxes' (x1, y1, x2, y2 in full frame coordinates), 'scores' and
+                'labels', and the (x, y, width, height) candidate 'regions' of the first stage
+        """
+        regions = [self.detector.detect_bricks(image) for image in images]
+        # crops of every frame of the batch, grouped by size so crops of equal size are classified together
+        groups = {}
+        for frame_index, (image, frame_regions) in enumerate(zip(images, regions)):
+            if not frame_regions:
+                self.frames_gated += 1
+            self.candidates += len(frame_regions)
+            for region in frame_regions:
+                offset, crop = crop_window(image, region, self.crop_size, self.padding)
+                groups.setdefault(crop.shape, []).append((frame_index, region, offset, crop))
+
+        detections = [[] for _ in images]
+        for group in groups.values():
+            for start in range(0, len(group), self.max_crop_batch):
+                batch = group[start:start + self.max_crop_batch]
+                results = self.classifier.run_batch([crop for _, _, _, crop in batch])
+                self.crops_classified += len(batch)
+                for (frame_index, region, offset, _), result in zip(batch, results):
+                    detections[frame_index].append(self._to_frame(result, region, offset))
+
+        return [self._merge(frame_detections, frame_regions)
+                for frame_detections, frame_regions in zip(detections, regions)]
+
+    def _to_frame(self, result: dict, region: tuple, offset: tuple) -> tuple:
+        boxes = _to_numpy(result['boxes']).astype(np.float32).reshape(-1, 4)
+        scores = _to_numpy(result['scores']).astype(np.float32)
+        labels = _to_numpy(result['labels']).astype(np.int64)
+        boxes += np.array(offset * 2, dtype=np.float32)
+        # a window may show parts of neighbouring bricks, they belong to the windows of those bricks
+        x, y, w, h = region
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        inside = ((centers[:, 0] >= x - self.padding) & (centers[:, 0] <= x + w + self.padding)
+                  & (centers[:, 1] >= y - self.padding) & (centers[:, 1] <= y + h + self.padding))
+        return boxes[inside], scores[inside], labels[inside]
+
+    def _merge(self, detections: list, regions: list) -> dict:
+        if detections:
+            boxes, scores, labels = (np.concatenate(values) for values in zip(*detections))
+        else:
+            boxes, scores, labels = np.empty((0, 4), np.float32), np.empty(0, np.float32), np.empty(0, np.int64)
+        if len(detections) > 1 and len(boxes):
+            # windows of bricks close to each other overlap and detect the same brick twice
+            keep = non_maximum_suppression(boxes, scores, self.iou_threshold)
+            boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+        return {'boxes': boxes, 'scores': scores, 'labels': labels, 'regions': list(regions)}
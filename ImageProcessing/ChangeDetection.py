@@ -0,0 +1,40 @@
+import numpy as np
+
+
+class FrameChangeDetector:
+    def __init__(self, threshold=2.0, step=8):
+        """
+        Cheap scene change detection: mean absolute difference between a subsampled frame and the last frame
+        that was reported as changed. Slow drift accumulates until it crosses the threshold.
+
+        Args:
+            threshold (float, optional): mean absolute intensity difference (0-255) above which a frame counts as changed. Defaults to 2.0.
+            step (int, optional): only every step-th pixel in both directions is compared. Defaults to 8.
+        """
+        self.threshold = threshold
+        self.step = step
+        self._reference = None
+
+    def has_changed(self, image: np.ndarray) -> bool:
+        """
+        Compare the image against the reference, a changed image becomes the new reference
+
+        Args:
+            image (np.ndarray): input image
+
+        Returns:
+            bool: True if the scene changed or there is no reference yet
+        """
+        signature = image[::self.step, ::self.step].astype(np.float32)
+        if self._reference is None or self._reference.shape != signature.shape:
+            self._reference = signature
+            return True
+
+        difference = float(np.mean(np.abs(signature - self._reference)))
+        if difference <= self.threshold:
+            return False
+        self._reference = signature
+        return True
+
+    def reset(self):
+        self._reference = None
@@ -0,0 +1,332 @@
+"""
+Inference backends for the detection model of LegoBrickSorting
+
+eager        plain PyTorch module, optionally with dynamic INT8 quantization
+torchscript  scripted module saved with torch.jit.save, optionally quantized before scripting
+onnxruntime  model exported to ONNX and executed by ONNX Runtime on CPU, onnxruntime is an optional dependency
+
+Export a model for the non eager backends:
+    python -m ImageProcessing.InferenceBackend --weights model.pth --backend torchscript --output model.pt --quantize
+    python -m ImageProcessing.InferenceBackend --weights model.pth --backend onnxruntime --output model.onnx
+
+Exported models keep the input scaling of the model they were exported from, pass --min-size and --max-size matching
+input_min_size and input_max_size of LegoBrickSorting, loading a model exported for other sizes fails.
+
+Note: dynamic quantization only applies to Linear layers (box head and predictor), convolutions of the ResNet
+backbone would need static quantization with calibration data.
+
+Backends are checked against the eager model when they are loaded. Random noise is the default input of the check,
+a trained model may detect nothing on it, pass a real frame with --sample (backend_sample_path of LegoBrickSorting).
+"""
+
+from abc import ABC, abstractmethod
+from Logger.Logger import logger
+import argparse
+import copy
+import torch
+
+
+BACKENDS = ('eager', 'torchscript', 'onnxruntime')
+
+# score tolerance of the load check, dynamic INT8 quantization moves scores and boxes of dense outputs by up to 10%
+DEFAULT_TOLERANCE = 1e-3
+QUANTIZED_TOLERANCE = 0.1
+
+
+class InferenceBackend(ABC):
+    # (min_size, max_size) the model rescales its inputs to, None if unknown
+    input_size = None
+
+    @abstractmethod
+    def __call__(self, input_batch: torch.Tensor) -> list:
+        """Run detection on a normalized NCHW batch
+
+        Returns:
+            list: one dict with 'boxes', 'labels' and 'scores' tensors per image
+        """
+        pass
+
+
+class EagerBackend(InferenceBackend):
+    def __init__(self, model: torch.nn.Module):
+        self.model = model.eval()
+        # quantized models run on CPU, everything else wherever its weights are
+        self.device = next(model.parameters(), torch.empty(0)).device
+
+    def __call__(self, input_batch: torch.Tensor) -> list:
+        with torch.no_grad():
+            return self.model(input_batch.to(self.device))
+
+
+class TorchScriptBackend(InferenceBackend):
+    def __init__(self, path: str, device=torch.device('cpu')):
+        self.model = torch.jit.load(path, map_location=device).eval()
+        self.device = device
+        self.input_size = model_input_size(self.model)
+
+    def __call__(self, input_batch: torch.Tensor) -> list:
+        with torch.no_grad():
+            output = self.model(list(input_batch.to(self.device)))
+        # scripted detection models always return (losses, detections)
+        if isinstance(output, tuple):
+            output = output[1]
+        return output
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    def __init__(self, path: str, num_threads=0):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnxruntime backend requires the onnxruntime package: pip install onnxruntime") from e
+
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if 'input_min_size' in metadata and 'input_max_size' in metadata:
+            self.input_size = (int(metadata['input_min_size']), int(metadata['input_max_size']))
+
+    def __call__(self, input_batch: torch.Tensor) -> list:
+        # the exported graph takes one image at a time
+        results = []
+        for image in input_batch:
+            boxes, labels, scores = self.session.run(None, {self.input_name: image.cpu().numpy()})
+            results.append({
+                'boxes': torch.from_numpy(boxes),
+                'labels': torch.from_numpy(labels),
+                'scores': torch.from_numpy(scores)
+            })
+        return results
+
+
+def model_input_size(model) -> tuple:
+    """
+    Returns:
+        tuple: (min_size, max_size) of the GeneralizedRCNNTransform of an eager or scripted detection model
+    """
+    # several min sizes are only used for training, inference rescales to the last one
+    return int(model.transform.min_size[-1]), int(model.transform.max_size)
+
+
+def quantize_model(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic INT8 quantization of all Linear layers, weights are quantized ahead of time, activations on the fly
+
+    Args:
+        model (torch.nn.Module): float model, left unchanged
+
+    Returns:
+        torch.nn.Module: quantized copy running on CPU
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def example_input(height=480, width=640) -> torch.Tensor:
+    # fixed seed, so export checks and load checks see the same input
+    generator = torch.Generator().manual_seed(0)
+    return torch.rand((1, 3, height, width), generator=generator)
+
+
+def sample_input(path: str) -> torch.Tensor:
+    """Load a camera frame saved as image file as input of the load check
+
+    Returns:
+        torch.Tensor: (1, 3, H, W) batch normalized like LegoBrickSorting normalizes its frames
+    """
+    import cv2
+
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError(f"Sample frame {path} could not be read.")
+    batch = torch.from_numpy(image).permute(2, 0, 1).unsqueeze(0).float().div_(255)
+    mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    return batch.sub_(mean).div_(std)
+
+
+def export_model(model: torch.nn.Module, backend: str, path: str, quantize=False) -> None:
+    """Export the model for the torchscript or onnxruntime backend
+
+    Args:
+        model (torch.nn.Module): eager detection model with loaded weights, its transform sets the input size the
+            exported model rescales to
+        backend (str): 'torchscript' or 'onnxruntime'
+        path (str): output file
+        quantize (bool, optional): apply dynamic INT8 quantization before exporting. Defaults to False.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if quantize:
+        if backend == 'onnxruntime':
+            raise ValueError("Quantized models can only be exported for the torchscript backend.")
+        model = quantize_model(model)
+
+    if backend == 'torchscript':
+        # detection models take lists of images and have data dependent control flow, so they are scripted not traced
+        torch.jit.save(torch.jit.script(model), path)
+    elif backend == 'onnxruntime':
+        torch.onnx.export(model, ([example_input()[0]],), path,
+                          opset_version=11,
+                          input_names=['image'],
+                          output_names=['boxes', 'labels', 'scores'],
+                          dynamic_axes={'image': [1, 2], 'boxes': [0], 'labels': [0], 'scores': [0]})
+        _write_input_size(path, model_input_size(model))
+    else:
+        raise ValueError(f"Cannot export for backend {backend}, choose one of {BACKENDS[1:]}")
+
+
+def _write_input_size(path: str, input_size: tuple):
+    # the scaling is traced into the ONNX graph, the metadata lets load_backend check it
+    import onnx
+
+    exported = onnx.load(path)
+    for key, value in zip(('input_min_size', 'input_max_size'), input_size):
+        entry = exported.metadata_props.add()
+        entry.key, entry.value = key, str(value)
+    onnx.save(exported, path)
+
+
+def verify_backend(backend: InferenceBackend, reference: InferenceBackend, tolerance=DEFAULT_TOLERANCE,
+                   input_batch=None, min_score=0.1, max_detections=100) -> int:
+    """Compare the detections of a backend against the eager model.
+    Every detection scoring at least min_score needs a counterpart in the other output with the same label, a score
+    within tolerance and a box overlapping by at least 1 - 10 * tolerance (at least 0.5, the overlap of detection
+    benchmarks). Detections are matched by overlap and not by their position in the output, engines order near tie
+    detections differently.
+
+    Args:
+        backend (InferenceBackend): backend to check
+        reference (InferenceBackend): eager backend with the same weights
+        tolerance (float, optional): score tolerance, see above. Defaults to DEFAULT_TOLERANCE.
+        input_batch (torch.Tensor, optional): normalized NCHW batch, eg. from sample_input.
+            Defaults to example_input().
+        min_score (float, optional): weaker detections may drop below the score threshold of the model in the other
+            engine and need no counterpart. Defaults to 0.1.
+        max_detections (int, optional): detections per image the model keeps (detections_per_img), a full output
+            may have cut off the counterparts of detections scoring close to its weakest one. Defaults to 100.
+
+    Returns:
+        int: number of compared detections, 0 means the input could not tell the engines apart
+
+    Raises:
+        RuntimeError: detections differ by more than the tolerance
+    """
+    input_batch = example_input() if input_batch is None else input_batch
+    name = type(backend).__name__
+    compared = 0
+    for expected, actual in zip(reference(input_batch), backend(input_batch)):
+        expected = {key: value.detach().cpu() for key, value in expected.items()}
+        actual = {key: value.detach().cpu() for key, value in actual.items()}
+        compared += _match_detections(name, expected, actual, tolerance, min_score, max_detections)
+        _match_detections(name, actual, expected, tolerance, min_score, max_detections)
+    return compared
+
+
+def _match_detections(name: str, detections: dict, others: dict, tolerance: float, min_score: float,
+                      max_detections: int) -> int:
+    from torchvision.ops import box_iou
+
+    if len(others['scores']) >= max_detections:
+        min_score = max(min_score, others['scores'].min().item())
+    keep = detections['scores'] >= min_score + tolerance
+    if not keep.any():
+        return 0
+    if len(others['boxes']) == 0:
+        raise RuntimeError(f"{name} detections do not match the eager model, {int(keep.sum())} detections are missing.")
+    boxes, labels, scores = (detections[key][keep] for key in ('boxes', 'labels', 'scores'))
+    candidates = ((labels[:, None] == others['labels'][None, :].to(labels))
+                  & ((scores[:, None] - others['scores'][None, :].to(scores)).abs() <= tolerance))
+    overlaps = torch.where(candidates, box_iou(boxes, others['boxes'].to(boxes)), torch.zeros(()))
+    worst = overlaps.max(dim=1).values.min().item()
+    if worst < max(1 - 10 * tolerance, 0.5):
+        raise RuntimeError(f"{name} detections do not match the eager model, the worst match of a detection with "
+                           f"the same label and score overlaps it by {worst:.3f}.")
+    return int(keep.sum())
+
+
+def load_backend(backend: str, model: torch.nn.Module, path=None, quantize=False, device=torch.device('cpu'),
+                 verify=True, tolerance=None, sample=None) -> InferenceBackend:
+    """Create the selected inference backend
+
+    Args:
+        backend (str): one of BACKENDS
+        model (torch.nn.Module): eager model with loaded weights, used directly or as reference for the load check
+        path (str, optional): exported model file, required for torchscript and onnxruntime
+        quantize (bool, optional): quantize the eager model, exported models are quantized at export time, pass it for
+            them as well to check with QUANTIZED_TOLERANCE. Defaults to False.
+        device (torch.device, optional): device for eager and torchscript backends. Defaults to cpu.
+        verify (bool, optional): compare outputs against the eager model at load time. Defaults to True.
+        tolerance (float, optional): tolerance of the load check, see verify_backend.
+            Defaults to None, QUANTIZED_TOLERANCE for quantized models and DEFAULT_TOLERANCE otherwise.
+        sample (torch.Tensor, optional): input of the load check, eg. from sample_input. Defaults to None, noise.
+
+    Returns:
+        InferenceBackend: ready to run backend
+
+    Raises:
+        ValueError: the exported model was exported for another input size than the transform of model
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}, choose one of {BACKENDS}")
+    if backend != 'eager' and path is None:
+        raise ValueError(f"The {backend} backend needs the path of an exported model.")
+
+    if backend == 'eager':
+        engine = EagerBackend(quantize_model(model) if quantize else model)
+    elif backend == 'torchscript':
+        engine = TorchScriptBackend(path, device)
+    else:
+        engine = OnnxRuntimeBackend(path)
+
+    if backend != 'eager':
+        expected = model_input_size(model)
+        if engine.input_size is None:
+            logger.warning("The %s model %s does not record its input size, it may not rescale inputs to min size %d "
+                           "and max size %d.", backend, path, *expected)
+        elif engine.input_size != expected:
+            raise ValueError(f"The {backend} model {path} was exported for min size {engine.input_size[0]} and max "
+                             f"size {engine.input_size[1]}, not {expected[0]} and {expected[1]}. Export it again with "
+                             f"--min-size {expected[0]} --max-size {expected[1]}.")
+
+    if verify and (backend != 'eager' or quantize):
+        if tolerance is None:
+            tolerance = QUANTIZED_TOLERANCE if quantize else DEFAULT_TOLERANCE
+        compared = verify_backend(engine, EagerBackend(model), tolerance, sample)
+        if compared == 0:
+            logger.warning("The %s backend check compared no detections, pass a sample frame to verify it.", backend)
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Lego brick sorting model for a faster inference backend")
+    parser.add_argument('--weights', required=True, help="trained model weights (state dict)")
+    parser.add_argument('--backend', required=True, choices=BACKENDS[1:])
+    parser.add_argument('--output', required=True, help="exported model file")
+    parser.add_argument('--quantize', action='store_true', help="dynamic INT8 quantization, torchscript only")
+    parser.add_argument('--min-size', type=int, default=800,
+                        help="shorter image side after rescaling, input_min_size of LegoBrickSorting")
+    parser.add_argument('--max-size', type=int, default=1333,
+                        help="upper limit of the longer side after rescaling, input_max_size of LegoBrickSorting")
+    parser.add_argument('--tolerance', type=float,
+                        help=f"score tolerance of the check against the eager model, defaults to {DEFAULT_TOLERANCE} "
+                             f"and {QUANTIZED_TOLERANCE} for quantized models")
+    parser.add_argument('--sample', help="camera frame (image file) the exported model is checked on")
+    args = parser.parse_args()
+
+    from ImageProcessing.LegoSorting import LegoBrickSorting
+    model = LegoBrickSorting.load_model(args.weights)
+    # the scaling becomes part of the exported model
+    model.transform.min_size = (args.min_size,)
+    model.transform.max_size = args.max_size
+    model.eval()
+
+    export_model(model, args.backend, args.output, quantize=args.quantize)
+    sample = sample_input(args.sample) if args.sample else None
+    load_backend(args.backend, model, args.output, quantize=args.quantize, tolerance=args.tolerance, sample=sample)
+    print(f"Exported {args.backend} model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import numpy as np
 import cv2
-from AbstractImageProcessing import ImageProcessing
+from ImageProcessing.AbstractImageProcessing import ImageProcessing
 
 class LegoBrickRecognition(ImageProcessing):
-    def __init__ (self, red_color_threshold=200, shape_threshold = 0.95, dummy_method=True):
+    def __init__ (self, red_color_threshold=200, shape_threshold = 0.95, min_contour_area=0.0, roi=None, downscale=1,
+                  refine_padding=8, dummy_method=True):
         """
         Dummy rule based image recognition algorithm on checking if current image has lego bricks or not
         Assumptions: 
@@ -15,11 +16,25 @@ class LegoBrickRecognition(ImageProcessing):
         Args:
             red_color_threshold (int, optional): intensity threshold on segmenting red color, maximum set to 255, adjustable. Defaults to 200.
             shape_threshold (float, optional): describe how well the contour fit the shape, maximum set to 1, adjustable. Defaults to 0.95.
+            min_contour_area (float, optional): contours up to this area (pixels) are discarded before shape checks. Defaults to 0.0.
+            roi (tuple, optional): (x, y, width, height) of the conveyor belt, pixels outside are ignored. Defaults to None, the full image.
+            downscale (int, optional): run a coarse red blob detection on every downscale-th pixel first, and segment at full
+                resolution only around the blobs found. Defaults to 1, segment the full image directly.
+            refine_padding (int, optional): full resolution pixels added around each coarse blob. Defaults to 8.
             dummy_method (bool, optional): this method is dummy. Defaults to True.
         """
         self.red_color_threshold = red_color_threshold
         self.shape_threshold = shape_threshold
+        self.min_contour_area = min_contour_area
+        self.roi = roi
+        self.downscale = downscale
+        self.refine_padding = refine_padding
         self.is_dummy = dummy_method
+
+        # kernels and masks are reused across frames, masks are reallocated only when the frame size changes
+        self._kernel = np.ones((5, 5), np.uint8)
+        self._coarse_kernel = np.ones((3, 3), np.uint8)
+        self._buffers = {}
     
     def run(self, image: np.ndarray) -> bool:
         """
@@ -35,26 +50,215 @@ class LegoBrickRecognition(ImageProcessing):
             bool: return True if find lego brick, otherwise return False
         """
 
-        red_channel = image[:, :, 2]  # assuming a black back ground and only look at red pixels
-        red_channel_mask = red_channel > self.red_color_threshold
-        mask = cv2.morphologyEx(red_channel_mask, cv2.MORPH_OPEN, kernel = np.ones((5,5),np.uint8))
+        contours = self.find_contours(image)
+        circles, rectangles = self.classify_contours(contours)
+
+        return self._has_circle_inside_rectangle(circles, rectangles)
+
+    def detect_bricks(self, image: np.ndarray) -> list:
+        """
+        Locate the bricks instead of only telling if there is one, eg. for tracking them across frames
+
+        Args:
+            image (np.ndarray): input image
+
+        Returns:
+            list: (x, y, width, height) bounding box of every rectangle with a circle inside, in full image coordinates
+        """
+        contours = self.find_contours(image)
+        circles, rectangles = self.classify_contours(contours)
+        return [tuple(int(value) for value in cv2.boundingRect(rectangles[index]))
+                for index in self._rectangles_with_circle(circles, rectangles)]
+
+    def find_contours(self, image: np.ndarray) -> list:
+        """
+        Segment red blobs inside the region of interest, optionally refining only regions found by a coarse pass
+
+        Args:
+            image (np.ndarray): input image
+
+        Returns:
+            list: contours in full image coordinates
+        """
+        x0, y0 = 0, 0
+        if self.roi is not None:
+            x0, y0, width, height = self.roi
+            image = image[y0:y0 + height, x0:x0 + width]
+
+        if self.downscale <= 1:
+            return self._segment(image, (x0, y0), reuse_buffers=True)
+
+        contours = []
+        for x, y, width, height in self.find_candidate_regions(image):
+            contours.extend(self._segment(image[y:y + height, x:x + width], (x0 + x, y0 + y)))
+        return contours
+
+    def find_candidate_regions(self, image: np.ndarray) -> list:
+        """
+        Coarse red blob detection on a subsampled red channel, cheap enough to run on every frame of an empty belt
+
+        Args:
+            image (np.ndarray): input image (already cropped to the region of interest)
+
+        Returns:
+            list: padded (x, y, width, height) regions around red blobs, in coordinates of the given image
+        """
+        step = self.downscale
+        # strided view, only every step-th pixel of the red channel is read
+        subsampled = image[::step, ::step, 2]
+        coarse = self._buffer('coarse', subsampled.shape, subsampled.dtype)
+        np.copyto(coarse, subsampled)
+        mask = self._threshold(coarse, 'coarse_mask')
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._coarse_kernel, dst=self._buffer('coarse_open', mask.shape))
+        blobs, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        regions = []
+        height, width = image.shape[:2]
+        for blob in blobs:
+            x, y, w, h = cv2.boundingRect(blob)
+            left = max(x * step - self.refine_padding, 0)
+            top = max(y * step - self.refine_padding, 0)
+            right = min((x + w) * step + self.refine_padding, width)
+            bottom = min((y + h) * step + self.refine_padding, height)
+            regions.append((left, top, right - left, bottom - top))
+        return regions
+
+    def _segment(self, image: np.ndarray, offset: tuple, reuse_buffers=False) -> list:
+        # assuming a black back ground and only look at red pixels
+        if reuse_buffers:
+            red_channel = cv2.extractChannel(image, 2, dst=self._buffer('red', image.shape[:2], image.dtype))
+            mask = self._threshold(red_channel, 'mask')
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._kernel, dst=self._buffer('open', mask.shape))
+        else:
+            # candidate regions change size every frame, not worth caching
+            red_channel = cv2.extractChannel(image, 2)
+            mask = self._threshold(red_channel)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._kernel)
         # find contors of segmented red blobs
-        contours, _= cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        circles = []
-        rectangles = []
-        for cnt in contours:
-            if self.check_circularity(cnt) == True:
-                circles.append(cnt)
-            if self.check_check_rectangularity(cnt) == True:
-                rectangles.append(cnt)
-
-        for rect in rectangles:
-            for circle in circles:
-                if cv2.pointPolygonTest(rect, tuple(circle[0][0]), False) >= 0:  # positive return value means points are inside the contour
-                    return True  # if we find any circle inside a rectangle
-        
-        return False # if we find nothing, return False on finding lego bricks
-            
+        contours, _= cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        return list(contours)
+
+    def _threshold(self, red_channel: np.ndarray, name=None) -> np.ndarray:
+        # uint8 mask with 255 where red_channel > red_color_threshold
+        if red_channel.dtype != np.uint8:
+            _, mask = cv2.threshold(red_channel, self.red_color_threshold, 255, cv2.THRESH_BINARY)
+            return mask.astype(np.uint8)
+        dst = self._buffer(name, red_channel.shape) if name is not None else None
+        _, mask = cv2.threshold(red_channel, self.red_color_threshold, 255, cv2.THRESH_BINARY, dst=dst)
+        return mask
+
+    def _buffer(self, name: str, shape: tuple, dtype=np.uint8) -> np.ndarray:
+        # preallocated array, only reallocated when the frame size changes
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def classify_contours(self, contours) -> tuple:
+        """
+        Same checks as check_circularity and check_rectangularity, computed for all contours at once
+
+        Args:
+            contours (list): contours detected via OpenCV contour finder
+
+        Returns:
+            tuple: (circles, rectangles) lists of contours, a contour can be in both
+        """
+        if len(contours) == 0:
+            return [], []
+
+        # early out on tiny blobs before any shape fitting, empty contours can never match a shape
+        areas = np.array([cv2.contourArea(cnt) for cnt in contours])
+        candidates = np.flatnonzero(areas > max(self.min_contour_area, 0.0))
+        if len(candidates) == 0:
+            return [], []
+        contours = [contours[i] for i in candidates]
+        areas = areas[candidates]
+
+        # circularity, radius is truncated to int as in check_circularity
+        radii = np.array([cv2.minEnclosingCircle(cnt)[1] for cnt in contours]).astype(int)
+        circle_ratio = np.pi * radii**2 / areas
+
+        # rectangularity
+        rectangle_ratio = self._principal_box_areas(contours) / areas
+
+        lower, upper = 1 * self.shape_threshold, 1 / self.shape_threshold
+        is_circle = (lower < circle_ratio) & (circle_ratio < upper)
+        is_rectangle = (lower < rectangle_ratio) & (rectangle_ratio < upper)
+        return [contours[i] for i in np.flatnonzero(is_circle)], [contours[i] for i in np.flatnonzero(is_rectangle)]
+
+    @staticmethod
+    def _principal_box_areas(contours) -> np.ndarray:
+        """
+        Vectorized version of the PCA in check_rectangularity: the points of all contours are concatenated,
+        per contour sums are taken with np.add.reduceat and the 2x2 covariance is decomposed in closed form
+
+        Args:
+            contours (list): non empty contours
+
+        Returns:
+            np.ndarray: length * width of each contour along its principal axes
+        """
+        counts = np.array([len(cnt) for cnt in contours])
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        points = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+
+        # center the points of every contour
+        means = np.add.reduceat(points, starts, axis=0) / counts[:, None]
+        centered = points - np.repeat(means, counts, axis=0)
+        x, y = centered[:, 0], centered[:, 1]
+
+        # principal axis angle of the covariance [[sxx, sxy], [sxy, syy]], the scale of the covariance does not matter
+        sxx = np.add.reduceat(x * x, starts)
+        syy = np.add.reduceat(y * y, starts)
+        sxy = np.add.reduceat(x * y, starts)
+        theta = 0.5 * np.arctan2(2 * sxy, sxx - syy)
+        cos = np.repeat(np.cos(theta), counts)
+        sin = np.repeat(np.sin(theta), counts)
+
+        # project onto both principal axes and measure the extent per contour
+        major = x * cos + y * sin
+        minor = -x * sin + y * cos
+        length = np.maximum.reduceat(major, starts) - np.minimum.reduceat(major, starts)
+        width = np.maximum.reduceat(minor, starts) - np.minimum.reduceat(minor, starts)
+        return length * width
+
+    @staticmethod
+    def _has_circle_inside_rectangle(circles, rectangles) -> bool:
+        """
+        Identified circles should be inside the detected rectangles
+
+        Returns:
+            bool: True if any circle is inside any rectangle
+        """
+        # stops at the first rectangle found
+        return next(LegoBrickRecognition._rectangles_with_circle(circles, rectangles), None) is not None
+
+    @staticmethod
+    def _rectangles_with_circle(circles, rectangles):
+        """
+        Yields the index of every rectangle with a circle inside, the first point of each circle is tested.
+        Point in polygon tests only run for circles inside the bounding box of a rectangle
+        """
+        if not circles or not rectangles:
+            return
+
+        points = np.array([circle[0][0] for circle in circles], dtype=np.float64)
+        boxes = np.array([cv2.boundingRect(rect) for rect in rectangles])
+        x, y = points[None, :, 0], points[None, :, 1]
+        left, top = boxes[:, None, 0], boxes[:, None, 1]
+        right, bottom = left + boxes[:, None, 2], top + boxes[:, None, 3]
+        inside_box = (x >= left) & (x < right) & (y >= top) & (y < bottom)
+
+        found = set()
+        for rect_index, circle_index in zip(*np.nonzero(inside_box)):
+            if rect_index in found:
+                continue
+            point = (float(points[circle_index, 0]), float(points[circle_index, 1]))
+            if cv2.pointPolygonTest(rectangles[rect_index], point, False) >= 0:  # positive return value means points are inside the contour
+                found.add(rect_index)
+                yield int(rect_index)
 
     def check_circularity(self, contour) ->bool : 
         """
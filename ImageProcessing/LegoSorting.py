@@ -1,67 +1,176 @@
 from ImageProcessing.AbstractImageProcessing import ImageProcessing
+from Logger.Logger import logger
 import cv2
-import torch
-from torchvision import models, transforms
-from torchvision.models.detection.rpn import AnchorGenerator
-from PIL import Image
+import numpy as np
+import time
+
+# torch and torchvision are imported when a LegoBrickSorting is created, importing this module stays cheap for
+# processes that only run LegoBrickRecognition
 
 class LegoBrickSorting(ImageProcessing):
-    def __init__ (self, model_weight_path="Path_To_Trained_Model_Weight.pth"):
+    def __init__ (self, model_weight_path="Path_To_Trained_Model_Weight.pth", reuse_input_buffer=True,
+                  backend='eager', backend_model_path=None, quantize=False, backend_tolerance=None, backend_sample_path=None,
+                  warmup_iterations=1, warmup_shape=(1080, 1920, 3), warmup_batch_size=1, input_min_size=800,
+                  input_max_size=1333):
 
         """ Off the shelve object detection model, should be fine tuned based on Lego data set
         Args:
-            model_weight_path (str, optional): path of model weight
+            model_weight_path (str, optional): path of model weight, a state dict saved with torch.save. Everything is
+                loaded from this file, nothing is downloaded.
+            reuse_input_buffer (bool, optional): keep the input batch tensor allocated across calls, it is pinned when
+                running on GPU. Defaults to True.
+            backend (str, optional): inference engine, 'eager', 'torchscript' or 'onnxruntime'. Defaults to 'eager'.
+            backend_model_path (str, optional): exported model for torchscript and onnxruntime, see InferenceBackend.py
+            quantize (bool, optional): dynamic INT8 quantization of the eager model. Defaults to False.
+            backend_tolerance (float, optional): allowed score difference to the eager model, checked when the backend
+                is loaded. Defaults to None, looser for quantized models, see InferenceBackend.verify_backend.
+            backend_sample_path (str, optional): camera frame (image file) the backend is checked on. Defaults to None,
+                random noise, on which a trained model may detect nothing to compare.
+            warmup_iterations (int, optional): batches of blank frames run at startup, so the first real frame does not
+                pay for memory allocation and kernel selection. Defaults to 1, 0 skips the warm-up.
+            warmup_shape (tuple, optional): (height, width, channels) of the warm-up frames, use the camera resolution.
+                Defaults to (1080, 1920, 3).
+            warmup_batch_size (int, optional): frames per warm-up batch, use the batch size of the node. Defaults to 1.
+            input_min_size (int, optional): the model rescales every image so its shorter side has this length.
+                Defaults to 800. Set it to the crop size when classifying crops (see CascadeDetector), crops are
+                otherwise upscaled and cost as much as a full frame.
+            input_max_size (int, optional): upper limit of the longer side after rescaling. Defaults to 1333.
+                Exported models keep the sizes they were exported with, see --min-size and --max-size of
+                InferenceBackend.py, loading them fails for other sizes.
         """
+        started = time.perf_counter()
+        import torch
+        from ImageProcessing.InferenceBackend import load_backend, sample_input
+        # seconds spent in each startup step, reported once the model is ready
+        self.startup_times = {'import': time.perf_counter() - started}
 
-        self.model = self._get_model()
+        step = time.perf_counter()
         self.model_weight_path = model_weight_path
-        self.model.load_state_dict(torch.load(self.model_weight_path))
-        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.model = self.load_model(self.model_weight_path)
+        # input scaling of the model, not part of the weights
+        self.model.transform.min_size = (input_min_size,)
+        self.model.transform.max_size = input_max_size
+        # quantized kernels only run on CPU
+        use_cuda = torch.cuda.is_available() and not quantize and backend != 'onnxruntime'
+        self.device = torch.device('cuda') if use_cuda else torch.device('cpu')
         self.model.to(self.device)
+        self.model.eval()
+        self.startup_times['load_model'] = time.perf_counter() - step
 
-        self.preprocess = transforms.Compose([
-            transforms.ToTensor(),  # Convert NumPy array to PyTorch tensor
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),])  # Normalize as per the model's requirements
+        step = time.perf_counter()
+        self.backend = load_backend(backend, self.model, backend_model_path, quantize=quantize, device=self.device,
+                                    tolerance=backend_tolerance,
+                                    sample=sample_input(backend_sample_path) if backend_sample_path else None)
+        self.startup_times['load_backend'] = time.perf_counter() - step
 
-    
-    def run(self, images: list) -> list:
+        # Normalize as per the model's requirements, same values as transforms.Normalize, shaped to broadcast over NCHW
+        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        self.std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        self.reuse_input_buffer = reuse_input_buffer
+        self._input_buffer = None
+
+        step = time.perf_counter()
+        self.warmup(warmup_iterations, warmup_shape, warmup_batch_size)
+        self.startup_times['warmup'] = time.perf_counter() - step
+        self.startup_times['total'] = time.perf_counter() - started
+        logger.info("LegoBrickSorting ready in %.2f s (%s)", self.startup_times['total'],
+                    ", ".join(f"{name} {seconds:.2f} s" for name, seconds in self.startup_times.items() if name != 'total'))
+
+    def warmup(self, iterations=1, shape=(1080, 1920, 3), batch_size=1):
+        """Run batches of blank frames through the model, allocations and kernel selection happen here instead
+        of on the first real frame. Frames of another size or batch size may still pay part of that cost.
+        """
+        if iterations <= 0:
+            return
+        import torch
+
+        frame = np.zeros(shape, dtype=np.uint8)
+        for _ in range(iterations):
+            self.run_batch([frame] * batch_size)
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    def run(self, image) -> dict:
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list) -> list:
         # convert np array to torch tensor
-        input_batch = self._numpy_to_tensor(images)
+        input_batch = self._numpy_to_tensor(images).to(self.device, non_blocking=True)
         
-        # run inference
-        with torch.no_grad():
-            result = self.model(input_batch)        
+        # run inference, one forward pass for the whole batch
+        result = self.backend(input_batch)
         
         return result 
             
     def _numpy_to_tensor(self, images):
-        tensors = []
-        for img in images:
-            # Convert NumPy array to PIL image
-            pil_image = Image.fromarray(img.astype('uint8'), 'RGB')
-            # Preprocess the image and add batch dimension
-            tensor_image = self.preprocess(pil_image).unsqueeze(0)
-            tensors.append(tensor_image)
-        # Concatenate all tensors to create a batch
-        return torch.cat(tensors)
+        """Convert HWC uint8 RGB frames into one normalized NCHW float batch.
+        Produces exactly the same values as ToTensor + Normalize on each image, without PIL round trips:
+        every frame is viewed as a tensor without copying and written once into the batch tensor,
+        the uint8 to float conversion happens in that same copy, and normalization runs in place on the whole batch.
+        """
+        import torch
+
+        frames = [np.asarray(img).astype(np.uint8, copy=False) for img in images]
+        height, width, channels = frames[0].shape
+        input_batch = self._get_input_buffer((len(frames), channels, height, width))
+        for i, frame in enumerate(frames):
+            input_batch[i].copy_(torch.from_numpy(frame).permute(2, 0, 1))
+
+        return input_batch.div_(255).sub_(self.mean).div_(self.std)
+
+    def _get_input_buffer(self, shape):
+        import torch
+
+        if self.reuse_input_buffer and self._input_buffer is not None and self._input_buffer.shape == shape:
+            return self._input_buffer
+        # pinned host memory makes the copy to the GPU asynchronous
+        input_buffer = torch.empty(shape, dtype=torch.float32, pin_memory=self.device.type == 'cuda')
+        if self.reuse_input_buffer:
+            self._input_buffer = input_buffer
+        return input_buffer
     
-    def _get_model():
+    @staticmethod
+    def load_model(model_weight_path: str):
+        """Build the model and load its weights from a single file, on the CPU
+
+        The model is built on the meta device, so its parameters take no memory and skip random initialization.
+        The weights are then memory mapped and assigned to the model instead of being copied into it.
+        """
+        import torch
+
+        try:
+            state_dict = torch.load(model_weight_path, map_location='cpu', mmap=True, weights_only=True)
+        except RuntimeError:
+            # files of the legacy (pre zip) torch.save format can not be memory mapped
+            state_dict = torch.load(model_weight_path, map_location='cpu', weights_only=True)
+        model = LegoBrickSorting._get_model(init_device='meta')
+        model.load_state_dict(state_dict, assign=True)
+        return model
+
+    @staticmethod
+    def _get_model(init_device=None):
+        import torch
+        from torchvision import models
+        from torchvision.models.detection.rpn import AnchorGenerator
+
         num_classes=137  # depends on real dataset
-        
-        # Encoder backbone
-        backbone = models.detection.backbone_utils.resnet_fpn_backbone(backbone_name="resnet50",
-                                                                    pretrained=True,
-                                                                    trainable_layers=0)
 
         anchor_sizes = ((8,), (16,), (64,), (256,), (512,))
         aspect_ratios = ((0.5, 0.8, 1.0, 1.25, 2.0),) * len(anchor_sizes)
 
+        # created outside of init_device, its anchors are plain tensors that no weight file restores
         anchor_generator = AnchorGenerator(sizes=anchor_sizes,
                                         aspect_ratios=aspect_ratios)
 
-        model = models.detection.FasterRCNN(backbone=backbone,
-                                            num_classes=num_classes,
-                                            rpn_anchor_generator=anchor_generator)
+        with torch.device(init_device or 'cpu'):
+            # Encoder backbone, no pretrained weights: the trained weights of the whole model are loaded afterwards
+            backbone = models.detection.backbone_utils.resnet_fpn_backbone(backbone_name="resnet50",
+                                                                        weights=None,
+                                                                        trainable_layers=0)
+
+            model = models.detection.FasterRCNN(backbone=backbone,
+                                                num_classes=num_classes,
+                                                rpn_anchor_generator=anchor_generator)
 
         return model
 
@@ -70,7 +179,7 @@ class LegoBrickSorting(ImageProcessing):
 def test():
     brick_sorting = LegoBrickSorting()
     img = cv2.imread("PATH to Sample Testing image contains lego brick")
-    result = brick_sorting.run([img])
+    result = brick_sorting.run_batch([img])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+"""
+Tracking of bricks across frames, so the expensive classification runs once per brick instead of once per frame
+
+A brick stays in view for many frames while the belt moves it along. A cheap detector (LegoBrickRecognition.detect_bricks)
+finds the bricks on every frame, IoUTracker links the boxes to tracks and TrackingClassifier runs the classifier
+(eg. LegoBrickSorting) only on crops of new tracks, or again once a track's cached result is reclassify_interval
+frames old.
+"""
+
+from ImageProcessing.AbstractImageProcessing import ImageProcessing
+import numpy as np
+
+
+def box_iou(box, boxes: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        box: (x, y, width, height)
+        boxes (np.ndarray): (N, 4) boxes in the same format
+
+    Returns:
+        np.ndarray: intersection over union of box with each of boxes
+    """
+    x, y, w, h = box
+    left = np.maximum(x, boxes[:, 0])
+    top = np.maximum(y, boxes[:, 1])
+    right = np.minimum(x + w, boxes[:, 0] + boxes[:, 2])
+    bottom = np.minimum(y + h, boxes[:, 1] + boxes[:, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    union = w * h + boxes[:, 2] * boxes[:, 3] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+def crop_window(image: np.ndarray, box, crop_size: tuple, padding=0) -> tuple:
+    """Fixed size window centered on a box and shifted inside the image, keeps the scale of the brick.
+    The window grows for boxes larger than crop_size minus the padding on both sides.
+
+    Returns:
+        tuple: ((left, top) of the window in the image, view of the window)
+    """
+    height, width = image.shape[:2]
+    x, y, w, h = box
+    crop_width = min(max(crop_size[0], int(w) + 2 * padding), width)
+    crop_height = min(max(crop_size[1], int(h) + 2 * padding), height)
+    left = int(min(max(x + w / 2 - crop_width / 2, 0), width - crop_width))
+    top = int(min(max(y + h / 2 - crop_height / 2, 0), height - crop_height))
+    return (left, top), image[top:top + crop_height, left:left + crop_width]
+
+
+def detection_boxes(result: dict, score_threshold=0.5) -> list:
+    # (x, y, width, height) boxes of a LegoBrickSorting result, so sorting detections can be tracked as well
+    boxes = []
+    for (x1, y1, x2, y2), score in zip(result['boxes'].tolist(), result['scores'].tolist()):
+        if score >= score_threshold:
+            boxes.append((x1, y1, x2 - x1, y2 - y1))
+    return boxes
+
+
+class Track:
+    def __init__(self, track_id: int, box: tuple, frame: int):
+        """One brick followed across frames
+
+        Args:
+            track_id (int): unique id of the track
+            box (tuple): (x, y, width, height) of the latest detection
+            frame (int): frame number the track was created on
+        """
+        self.track_id = track_id
+        self.box = box
+        self.first_frame = frame
+        self.last_frame = frame
+        self.hits = 1
+        self.misses = 0
+        # cached classification and the frame it was computed on
+        self.result = None
+        self.classified_frame = None
+        # top left corner of the crop the result was computed on, result coordinates are relative to it
+        self.result_offset = None
+        self.velocity = (0.0, 0.0)
+
+    @property
+    def predicted_box(self) -> tuple:
+        # where the brick should be on the next frame if it keeps moving like the belt did so far
+        x, y, w, h = self.box
+        return (x + self.velocity[0], y + self.velocity[1], w, h)
+
+    def update(self, box: tuple, frame: int):
+        x, y = box[0], box[1]
+        frames = max(frame - self.last_frame, 1)
+        self.velocity = ((x - self.box[0]) / frames, (y - self.box[1]) / frames)
+        self.box = box
+        self.last_frame = frame
+        self.hits += 1
+        self.misses = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'track_id': self.track_id,
+            'box': tuple(self.box),
+            'result': self.result,
+            'classified_frame': self.classified_frame,
+            'result_offset': self.result_offset,
+            'first_frame': self.first_frame
+        }
+
+
+class IoUTracker:
+    def __init__(self, iou_threshold=0.3, max_distance=50.0, max_misses=5):
+        """Greedy IoU tracker with a centroid distance fallback for fast moving or resized boxes
+
+        Args:
+            iou_threshold (float, optional): minimum overlap of a detection with the predicted box of a track. Defaults to 0.3.
+            max_distance (float, optional): detections without enough overlap are matched to the track with the nearest
+                predicted centroid within this many pixels. Defaults to 50.0, None disables the fallback.
+            max_misses (int, optional): frames a track survives without detection, eg. a brick briefly occluded.
+                Defaults to 5.
+        """
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.max_misses = max_misses
+        self.tracks = []
+        self.frame = 0
+        self._next_id = 1
+
+    def update(self, boxes: list) -> tuple:
+        """Link the detections of the next frame to the tracks
+
+        Args:
+            boxes (list): (x, y, width, height) detections of the frame
+
+        Returns:
+            tuple: (tracks matched to boxes in order of boxes, newly created tracks among them)
+        """
+        self.frame += 1
+        matched = [None] * len(boxes)
+        new_tracks = []
+        if boxes and self.tracks:
+            detections = np.array(boxes, dtype=np.float64)
+            predicted = np.array([track.predicted_box for track in self.tracks], dtype=np.float64)
+            overlaps = np.stack([box_iou(box, detections) for box in predicted])
+            # highest overlaps first, every track and every detection is used once
+            used_tracks, used_boxes = set(), set()
+            for track_index, box_index in zip(*np.unravel_index(np.argsort(-overlaps, axis=None), overlaps.shape)):
+                if overlaps[track_index, box_index] < self.iou_threshold:
+                    break
+                if track_index in used_tracks or box_index in used_boxes:
+                    continue
+                used_tracks.add(track_index)
+                used_boxes.add(box_index)
+                matched[box_index] = self.tracks[track_index]
+
+            if self.max_distance is not None:
+                centers = detections[:, :2] + detections[:, 2:] / 2
+                predicted_centers = predicted[:, :2] + predicted[:, 2:] / 2
+                for box_index in np.flatnonzero([track is None for track in matched]):
+                    distances = np.linalg.norm(predicted_centers - centers[box_index], axis=1)
+                    distances[list(used_tracks)] = np.inf
+                    track_index = int(np.argmin(distances))
+                    if distances[track_index] <= self.max_distance:
+                        used_tracks.add(track_index)
+                        matched[box_index] = self.tracks[track_index]
+
+        for box_index, (box, track) in enumerate(zip(boxes, matched)):
+            if track is None:
+                track = Track(self._next_id, box, self.frame)
+                self._next_id += 1
+                self.tracks.append(track)
+                new_tracks.append(track)
+                matched[box_index] = track
+            else:
+                track.update(box, self.frame)
+
+        # tracks missing for too long left the field of view
+        for track in self.tracks:
+            if track.last_frame != self.frame:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+        return matched, new_tracks
+
+
+class TrackingClassifier(ImageProcessing):
+    def __init__(self, detector, classifier: ImageProcessing = None, reclassify_interval=0, crop_size=(256, 256),
+                 iou_threshold=0.3, max_distance=50.0, max_misses=5):
+        """Runs a cheap detector on every frame and the expensive classifier only for new or stale tracks
+
+        Args:
+            detector: LegoBrickRecognition, or any object with detect_bricks(image) returning (x, y, width, height) boxes
+            classifier (ImageProcessing, optional): classifier of the brick crops, eg. LegoBrickSorting. Its result for a
+                crop is cached on the track. Defaults to None, only tracking.
+            reclassify_interval (int, optional): frames after which a track is classified again.
+                Defaults to 0, every brick is classified once.
+            crop_size (tuple, optional): (width, height) of the window around a brick passed to the classifier, grown
+                for larger bricks. Crops of equal size are classified in one batch. Defaults to (256, 256).
+            iou_threshold (float, optional): see IoUTracker. Defaults to 0.3.
+            max_distance (float, optional): see IoUTracker. Defaults to 50.0.
+            max_misses (int, optional): see IoUTracker. Defaults to 5.
+        """
+        self.detector = detector
+        self.classifier = classifier
+        self.reclassify_interval = reclassify_interval
+        self.crop_size = crop_size
+        self.tracker = IoUTracker(iou_threshold, max_distance, max_misses)
+        self.classifications = 0
+        self.cached_results = 0
+
+    @property
+    def statistics(self) -> dict:
+        # exported by ImageProcessingNode next to its own counters
+        return {
+            'tracks': len(self.tracker.tracks),
+            'classifications': self.classifications,
+            'cached_results': self.cached_results
+        }
+
+    def run(self, image: np.ndarray) -> list:
+        return self.run_batch([image])[0]
+
+    def run_batch(self, images: list) -> list:
+        """
+        Returns:
+            list: per frame, a list of track dicts (track_id, box, result, classified_frame, result_offset,
+                first_frame), one per detected brick
+        """
+        frames = []
+        # crops of every frame of the batch are classified together
+        to_classify = []
+        # frames later in the batch reuse the pending classification
+        pending = set()
+        for image in images:
+            tracks, _ = self.tracker.update(self.detector.detect_bricks(image))
+            for track in tracks:
+                if track.track_id not in pending and self._needs_classification(track):
+                    to_classify.append((track, self.tracker.frame, self._crop(image, track.box)))
+                    pending.add(track.track_id)
+                else:
+                    self.cached_results += 1
+            frames.append(tracks)
+
+        if self.classifier is not None and to_classify:
+            self._classify(to_classify)
+        return [[track.to_dict() for track in tracks] for tracks in frames]
+
+    def _needs_classification(self, track: Track) -> bool:
+        if self.classifier is None:
+            return False
+        if track.classified_frame is None:
+            return True
+        return self.reclassify_interval > 0 and self.tracker.frame - track.classified_frame >= self.reclassify_interval
+
+    def _crop(self, image: np.ndarray, box: tuple) -> tuple:
+        return crop_window(image, box, self.crop_size)
+
+    def _classify(self, to_classify: list):
+        groups = {}
+        for track, frame, (offset, crop) in to_classify:
+            groups.setdefault(crop.shape, []).append((track, frame, offset, crop))
+        for group in groups.values():
+            results = self.classifier.run_batch([crop for _, _, _, crop in group])
+            # only marked as classified once there is a result, a failed batch is classified again on the next frame
+            for (track, frame, offset, _), result in zip(group, results):
+                track.result = result
+                track.classified_frame = frame
+                track.result_offset = offset
+                self.classifications += 1
@@ -0,0 +1,154 @@
+"""
+Structured log records sent from the nodes to the LoggingNode
+
+Nodes never format, encode or send a log message on the calling thread. LogPublisher drops records below its level
+right away, queues the others and a background thread formats and encodes them and publishes them as one batch
+per flush interval. A record is a fixed binary header followed by utf-8 strings:
+
+    level (uint8) | created (float64, wall clock) | sequence (int64) | len(node), len(template), len(message) | strings
+
+The template is the unformatted message, the LoggingNode uses it to rate limit repeated messages.
+"""
+
+from collections import deque
+import logging
+import struct
+import threading
+import time
+import traceback
+
+
+_RECORD_HEADER = struct.Struct('<BdqHHI')
+
+
+def encode_records(records: list) -> bytes:
+    """
+    Args:
+        records (list): (level, created, sequence, node, template, message) tuples
+
+    Returns:
+        bytes: the records concatenated in the binary format of the module docstring
+    """
+    chunks = []
+    for level, created, sequence, node, template, message in records:
+        node, template, message = node.encode(), template.encode(), message.encode()
+        chunks.append(_RECORD_HEADER.pack(level, created, sequence, len(node), len(template), len(message)))
+        chunks.extend((node, template, message))
+    return b''.join(chunks)
+
+
+def decode_records(data: bytes) -> list:
+    # inverse of encode_records
+    records = []
+    offset = 0
+    while offset < len(data):
+        level, created, sequence, node_length, template_length, message_length = _RECORD_HEADER.unpack_from(data, offset)
+        offset += _RECORD_HEADER.size
+        node = data[offset:offset + node_length].decode()
+        offset += node_length
+        template = data[offset:offset + template_length].decode()
+        offset += template_length
+        message = data[offset:offset + message_length].decode(errors='replace')
+        offset += message_length
+        records.append((level, created, sequence, node, template, message))
+    return records
+
+
+class LogPublisher:
+    def __init__(self, publisher, topic: bytes, node: str, level=logging.INFO, flush_interval=0.25, max_batch=256,
+                 max_pending=4096):
+        """Non blocking log emission for the hot paths of a node
+
+        Args:
+            publisher (Publisher): publisher the batches are sent with
+            topic (bytes): topic of the batches, Topics['LOG_RECORDS']
+            node (str): name of the emitting node
+            level (int, optional): records below this logging level are dropped at the source. Defaults to logging.INFO.
+            flush_interval (float, optional): seconds between batches. Defaults to 0.25.
+            max_batch (int, optional): maximum records per published batch. Defaults to 256.
+            max_pending (int, optional): records waiting for the next flush, the oldest are dropped beyond that.
+                Defaults to 4096.
+        """
+        self.publisher = publisher
+        self.topic = topic
+        self.node = node
+        self.level = level
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        # deque append and popleft are atomic, the emitting threads never take a lock
+        self._pending = deque(maxlen=max_pending)
+        self.dropped = 0
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def is_enabled_for(self, level: int) -> bool:
+        return level >= self.level
+
+    def log(self, level: int, template: str, *args, sequence=0, exc_text=None):
+        """Queue a record, template % args is formatted later on the flush thread
+
+        Args:
+            level (int): logging level
+            template (str): %-style message template
+            sequence (int, optional): frame sequence number the record refers to. Defaults to 0.
+            exc_text (str, optional): formatted traceback appended to the message. Defaults to None.
+        """
+        if level < self.level:
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+        self._pending.append((level, time.time(), sequence, template, args, exc_text))
+        if self._thread is None:
+            self._start()
+
+    def debug(self, template: str, *args, sequence=0):
+        if self.level <= logging.DEBUG:
+            self.log(logging.DEBUG, template, *args, sequence=sequence)
+
+    def info(self, template: str, *args, sequence=0):
+        if self.level <= logging.INFO:
+            self.log(logging.INFO, template, *args, sequence=sequence)
+
+    def warning(self, template: str, *args, sequence=0):
+        if self.level <= logging.WARNING:
+            self.log(logging.WARNING, template, *args, sequence=sequence)
+
+    def error(self, template: str, *args, sequence=0):
+        if self.level <= logging.ERROR:
+            self.log(logging.ERROR, template, *args, sequence=sequence)
+
+    def exception(self, template: str, *args, sequence=0):
+        # error record with the traceback of the exception being handled, captured now while it is still available
+        self.log(logging.ERROR, template, *args, sequence=sequence, exc_text=traceback.format_exc())
+
+    def flush(self):
+        # format, encode and publish everything queued so far, in batches of at most max_batch records
+        while self._pending:
+            records = []
+            while self._pending and len(records) < self.max_batch:
+                level, created, sequence, template, args, exc_text = self._pending.popleft()
+                records.append((level, created, sequence, self.node, template, self._format(template, args, exc_text)))
+            self.publisher.publish(self.topic, encode_records(records))
+
+    def _start(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+                self._thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                # logging must never take a node down, the batch is lost
+                self.dropped += 1
+
+    @staticmethod
+    def _format(template: str, args: tuple, exc_text: str) -> str:
+        try:
+            message = template % args if args else template
+        except (TypeError, ValueError):
+            message = f"{template} {args}"
+        return f"{message}\n{exc_text.rstrip()}" if exc_text else message
@@ -0,0 +1,119 @@
+"""
+Latency metrics of the nodes
+
+Every frame message carries a 'trace' dict of stage name -> time.perf_counter_ns() taken when the frame passed that
+stage. perf_counter is a system wide monotonic clock, so stage timestamps can be compared between processes on the
+same machine (not between machines). Each node records how long frames spent in its stages in LatencyHistograms,
+snapshots with p50/p99 are written to a json file and/or published on Topics['METRICS'].
+"""
+
+import json
+import math
+import os
+import threading
+import time
+
+
+def trace_now() -> int:
+    # timestamp of a pipeline stage, see module docstring
+    return time.perf_counter_ns()
+
+
+class LatencyHistogram:
+    def __init__(self, min_value=1e-6, max_value=100.0, buckets_per_octave=8):
+        """Log bucketed histogram of latencies in seconds, fixed memory and O(1) recording
+
+        Args:
+            min_value (float, optional): smallest resolved latency. Defaults to 1e-6 (1 us).
+            max_value (float, optional): larger latencies go to the last bucket. Defaults to 100.0.
+            buckets_per_octave (int, optional): buckets per doubling of latency, 8 gives ~9% resolution. Defaults to 8.
+        """
+        self._min_value = min_value
+        self._base = 2 ** (1 / buckets_per_octave)
+        self._num_buckets = int(math.ceil(math.log(max_value / min_value, self._base))) + 1
+        # bucket 0 holds everything below min_value, bucket i covers [min * base^(i-1), min * base^i)
+        self._counts = [0] * (self._num_buckets + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        if seconds < self._min_value:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / self._min_value, self._base)) + 1, self._num_buckets)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket holding the given percentile, 0.0 if nothing was recorded"""
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            target = max(math.ceil(percent / 100 * self.count), 1)
+            cumulative = 0
+            for index, count in enumerate(self._counts):
+                cumulative += count
+                if cumulative >= target:
+                    return min(self._min_value * self._base ** index, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+
+class NodeMetrics:
+    def __init__(self, name: str):
+        """Stage latency histograms and counters of one node
+
+        Args:
+            name (str): node name used in exported snapshots
+        """
+        self.name = name
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage: str) -> LatencyHistogram:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def record(self, stage: str, seconds: float):
+        self.histogram(stage).record(seconds)
+
+    def record_between(self, stage: str, start_ns: int, end_ns: int):
+        # durations between two trace timestamps, negative values (clock of another machine) are ignored
+        if start_ns is not None and end_ns is not None and end_ns >= start_ns:
+            self.record(stage, (end_ns - start_ns) / 1e9)
+
+    def set_counter(self, name: str, value):
+        self._counters[name] = value
+
+    def snapshot(self) -> dict:
+        return {
+            'node': self.name,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'stages': {stage: histogram.summary() for stage, histogram in list(self._histograms.items())},
+            'counters': dict(self._counters)
+        }
+
+    def export_json(self, path: str):
+        # write to a temporary file first, readers never see a half written snapshot
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(temporary_path, path)
@@ -3,16 +3,41 @@ Abstract classes that support "publisher-subscriber" communication pattern ZeroM
 
 More details can be found on https://learning-0mq-with-pyzmq.readthedocs.io/en/latest/pyzmq/patterns/pubsub.html
 
+Nodes do not connect to each other directly, every publisher connects to the frontend of a Broker and every
+subscriber to its backend. Nodes living in the broker process use its inproc:// endpoints, all sockets of a process
+share one zmq context.
+
 """
 
 from abc import ABC, abstractmethod
+from Logger.LogRecords import LogPublisher
+from Logger.Metrics import NodeMetrics
+from Node.FrameEncoding import FrameEncoding
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import asyncio
+import inspect
+import json
+import logging
+import threading
+import time
 import zmq
+import zmq.asyncio
 
 
 # list of byte strings for sending over network
 Topics = {
     'IMAGE_RGB': b'sensor_data.image_rgb',
     'IMAGE_RAW': b'sensor_data.image_raw',
+    # reduced streams derived from the camera frames, see CameraNode. Names must not start with another topic,
+    # zmq subscriptions match by prefix
+    'IMAGE_HALF': b'sensor_data.image_half',
+    'IMAGE_THUMBNAIL': b'sensor_data.image_thumbnail',
+    'IMAGE_GRAY': b'sensor_data.image_gray',
+    'IMAGE_ROI': b'sensor_data.image_roi',
+    # synchronized frames of several cameras, see MultiCameraNode
+    'IMAGE_SET': b'sensor_data.image_set',
     'IMAGE_RECONGNITION_RESULT': b'image_recongition_result',
     'IMAGE_DETECTION': b'image_process_detection_result',
     'IMAGE_SEGEMENTATION': b'image_process_detection_result',
@@ -20,52 +45,482 @@ Topics = {
     'LOG_INFO': b'log_info',
     'LOG_WARN': b'log.warn',
     'LOG_ERROR': b'log.error',
-    'LOG_CRITICAL': b'log_critical'
+    'LOG_CRITICAL': b'log_critical',
+    # batches of binary log records, see Logger/LogRecords.py
+    'LOG_RECORDS': b'log.records',
+    'METRICS': b'metrics',
+    # runtime settings of the nodes, published by QoSController
+    'CONTROL': b'control'
 }
 
+def get_context() -> zmq.Context:
+    # one context (and io thread) per process, sockets of the same context can also talk over inproc://
+    return zmq.Context.instance()
+
+
+class BrokerEndpoints(NamedTuple):
+    """Urls of a Broker, publishers connect to publish and subscribers to subscribe"""
+    publish: str
+    subscribe: str
+
+
+def publish_url(address) -> tuple:
+    # (url, bind) of a publisher, a plain url is bound by the publisher itself
+    if isinstance(address, BrokerEndpoints):
+        return address.publish, False
+    return address, True
+
+
+def subscribe_urls(address) -> list:
+    # urls a subscriber connects to
+    if isinstance(address, BrokerEndpoints):
+        return [address.subscribe]
+    return [address] if isinstance(address, str) else list(address)
+
+
+class Broker:
+    def __init__(self, frontend="tcp://127.0.0.1:5555", backend="tcp://127.0.0.1:5556", name="lego", send_hwm=None):
+        """XSUB/XPUB proxy, all publishers of the pipeline fan in to the frontend and all subscribers connect
+        to the backend, so no node has to bind a well known port. Subscriptions are forwarded upstream, publishers
+        still filter topics nobody subscribed to. Besides the tcp urls for other processes the broker binds
+        inproc:// urls, nodes in the broker process use them and skip the tcp stack.
+
+        Args:
+            frontend (str, optional): url publishers connect to. Defaults to "tcp://127.0.0.1:5555".
+            backend (str, optional): url subscribers connect to. Defaults to "tcp://127.0.0.1:5556".
+            name (str, optional): name of the inproc urls, unique per broker in a process. Defaults to "lego".
+            send_hwm (int, optional): messages the broker queues per subscriber, a slow subscriber loses further
+                messages instead of piling them up in the broker. Defaults to None, zmq default of 1000.
+        """
+        self.send_hwm = send_hwm
+        self.endpoints = BrokerEndpoints(frontend, backend)
+        self.local_endpoints = BrokerEndpoints(f"inproc://{name}.publish", f"inproc://{name}.subscribe")
+        self._thread = None
+
+    def start(self) -> threading.Thread:
+        """Run the proxy in a daemon thread, returns once both sides are bound so nodes can connect right away"""
+        if self._thread is not None:
+            return self._thread
+        bound = threading.Event()
+        errors = []
+
+        def proxy():
+            context = get_context()
+            # sockets are created in the proxy thread, zmq sockets must not be shared between threads
+            frontend = context.socket(zmq.XSUB)
+            backend = context.socket(zmq.XPUB)
+            if self.send_hwm is not None:
+                backend.setsockopt(zmq.SNDHWM, self.send_hwm)
+            try:
+                for socket, urls in ((frontend, (self.endpoints.publish, self.local_endpoints.publish)),
+                                     (backend, (self.endpoints.subscribe, self.local_endpoints.subscribe))):
+                    for url in urls:
+                        socket.bind(url)
+            except zmq.ZMQError as e:
+                errors.append(e)
+                return
+            finally:
+                bound.set()
+            try:
+                # forwards messages downstream and subscriptions upstream until the context is terminated
+                zmq.proxy(frontend, backend)
+            except zmq.ContextTerminated:
+                pass
+            finally:
+                frontend.close(linger=0)
+                backend.close(linger=0)
+
+        self._thread = threading.Thread(target=proxy, daemon=True)
+        self._thread.start()
+        bound.wait()
+        if errors:
+            self._thread = None
+            raise errors[0]
+        return self._thread
+
+
 class Publisher(ABC):
     @abstractmethod
     def publish(self, topic: bytes, message: bytes) -> None:
         pass
 
+    @abstractmethod
+    def publish_frames(self, topic: bytes, frames: list) -> None:
+        pass
+
+    def publish_message(self, topic: bytes, message) -> None:
+        # image and frame set messages, publishers supporting encodings compress them on the way
+        self.publish_frames(topic, message.serialize())
+
 class Subscriber(ABC):
     @abstractmethod
     def subscribe(self, callback: callable) -> None:
         pass
 
 class ZeroMQPublisher(Publisher):
-    def __init__(self, address: str):
-        # 
+    def __init__(self, address, send_hwm=None, encodings=None, encoder_threads=2):
+        """
+        Args:
+            address (str or BrokerEndpoints): url to bind to, or the endpoints of a Broker to connect to
+            send_hwm (int, optional): messages queued per subscriber, further messages to a slow subscriber are dropped.
+                Defaults to None, zmq default of 1000.
+            encodings (dict, optional): topic -> frame encoding (eg. 'jpeg:85', see Node/FrameEncoding.py) of the
+                messages sent with publish_message, subscribers decode them transparently. Defaults to None, all raw.
+            encoder_threads (int, optional): threads compressing frames, so the publishing thread does not wait for
+                the encoder. Defaults to 2.
+        """
         self._address = address
-        # required to initialize zmq 
-        self._context = zmq.Context()
+        self._context = get_context()
         self._socket = self._context.socket(zmq.PUB)
-        self._socket.bind(self._address)
+        if send_hwm is not None:
+            self._socket.setsockopt(zmq.SNDHWM, send_hwm)
+        url, bind = publish_url(address)
+        if bind:
+            self._socket.bind(url)
+        else:
+            self._socket.connect(url)
+        # zmq sockets are not thread safe, nodes may publish from their receiving and processing threads
+        self._lock = threading.Lock()
+
+        self.encodings = {topic.encode() if isinstance(topic, str) else topic: FrameEncoding.parse(encoding)
+                          for topic, encoding in (encodings or {}).items()}
+        self._encoder = None
+        if any(not encoding.is_raw for encoding in self.encodings.values()):
+            self._encoder = ThreadPoolExecutor(encoder_threads, thread_name_prefix='frame-encoder')
+            # frames being encoded, publish_message blocks beyond that instead of queueing without bound
+            self._encoding_slots = threading.Semaphore(2 * encoder_threads)
+        # (topic, future) in publish order, sent once every frame before them was sent
+        self._encoding = deque()
+        self._encode_error = None
+        self.frames_encoded = 0
+        self.encode_seconds = 0.0
+        self.bytes_raw = 0
+        self.bytes_encoded = 0
+
+    @property
+    def statistics(self) -> dict:
+        if not self.frames_encoded:
+            return {}
+        return {
+            'frames_encoded': self.frames_encoded,
+            'encode_ms_per_frame': self.encode_seconds / self.frames_encoded * 1e3,
+            'encoded_bytes_per_frame': self.bytes_encoded / self.frames_encoded,
+            'compression_ratio': self.bytes_raw / max(self.bytes_encoded, 1)
+        }
 
     def publish(self, topic: bytes, message: bytes) -> None:
-        self._socket.send_multipart([topic, message])
+        with self._lock:
+            self._socket.send_multipart([topic, message])
+
+    def publish_frames(self, topic: bytes, frames: list) -> None:
+        # frames may be numpy arrays, their memory is sent without copying
+        with self._lock:
+            self._socket.send_multipart([topic] + frames, copy=False)
+
+    def publish_message(self, topic: bytes, message) -> None:
+        """Publish an ImageMessage or FrameSetMessage, encoded if its topic has an encoding. Encoding runs on the
+        encoder threads, messages of a topic are still sent in the order they were published.
+
+        Raises:
+            ValueError: a previous frame could not be encoded, eg. a float frame with jpeg encoding. Raised once per
+                failed frame, later messages are published again.
+        """
+        encoding = self.encodings.get(topic)
+        if encoding is None or encoding.is_raw:
+            self.publish_frames(topic, message.serialize())
+            return
+        self._encoding_slots.acquire()
+        future = self._encoder.submit(self._encode, message, encoding)
+        with self._lock:
+            self._encoding.append((topic, future))
+            error, self._encode_error = self._encode_error, None
+        future.add_done_callback(self._send_encoded)
+        # this message is queued anyway, the error belongs to an earlier one
+        if error is not None:
+            raise error
+
+    def _encode(self, message, encoding: FrameEncoding) -> tuple:
+        started = time.perf_counter()
+        frames = message.serialize(encoding)
+        images = message.frames.values() if hasattr(message, 'frames') else [message]
+        raw_bytes = sum(image.image.nbytes for image in images if image.image is not None)
+        return frames, time.perf_counter() - started, raw_bytes
+
+    def _send_encoded(self, _):
+        # runs on the encoder thread that finished, sends every frame at the head of the queue that is ready
+        with self._lock:
+            while self._encoding and self._encoding[0][1].done():
+                topic, future = self._encoding.popleft()
+                self._encoding_slots.release()
+                try:
+                    frames, seconds, raw_bytes = future.result()
+                except Exception as e:
+                    # raised on the publishing thread by the next publish_message
+                    self._encode_error = ValueError(f"Encoding a frame of topic {topic!r} failed: {e}")
+                    self._encode_error.__cause__ = e
+                    continue
+                self.frames_encoded += 1
+                self.encode_seconds += seconds
+                self.bytes_raw += raw_bytes
+                self.bytes_encoded += sum(frame.nbytes if hasattr(frame, 'nbytes') else len(frame) for frame in frames[1:])
+                self._socket.send_multipart([topic] + frames, copy=False)
 
 class ZeroMQSubscriber(Subscriber):
-    def __init__(self, address: str):
+    def __init__(self, address, receive_hwm=None):
+        """
+        Args:
+            address (str, list or BrokerEndpoints): url to connect to, a list of urls receives from several publishers
+            receive_hwm (int, optional): messages queued in this subscriber before the publisher starts dropping.
+                Defaults to None, zmq default of 1000. ZMQ_CONFLATE is not offered, zmq does not support it for
+                multipart messages and every message here has a topic frame. Latest only behaviour for images is a
+                small receive_hwm plus a bounded DropOldestQueue, see ImageProcessingNode.
+        """
         self._address = address
-        self._context = zmq.Context()
+        self._context = get_context()
         self._socket = self._context.socket(zmq.SUB)
-        self._socket.connect(self._address)
-        
+        if receive_hwm is not None:
+            self._socket.setsockopt(zmq.RCVHWM, receive_hwm)
+        for url in subscribe_urls(address):
+            self._socket.connect(url)
 
     def subscribe(self, callback: callable, topic: bytes) -> None:
+        """Receive messages forever and call callback(topic, message, *buffers) for each of them.
+        Topic and message are passed as bytes, additional frames (eg. image buffers) as memoryviews without copying.
+        """
         self._socket.setsockopt(zmq.SUBSCRIBE, topic)
         while True:
-            topic, message = self._socket.recv_multipart()
-            callback(topic, message)
+            frames = self._socket.recv_multipart(copy=False)
+            topic, message = frames[0].bytes, frames[1].bytes
+            callback(topic, message, *[frame.buffer for frame in frames[2:]])
+
+
+class AsyncZeroMQSubscriber(Subscriber):
+    def __init__(self, address, receive_hwm=None):
+        """ZeroMQSubscriber for asyncio, several subscribers share one event loop instead of one thread each
+
+        Args:
+            address (str, list or BrokerEndpoints): url(s) to connect to, see ZeroMQSubscriber
+            receive_hwm (int, optional): see ZeroMQSubscriber. Defaults to None.
+        """
+        self._address = address
+        # shadows the process wide context, inproc:// urls of the broker are reachable from asyncio sockets too
+        self._context = zmq.asyncio.Context.shadow(get_context().underlying)
+        self._socket = self._context.socket(zmq.SUB)
+        if receive_hwm is not None:
+            self._socket.setsockopt(zmq.RCVHWM, receive_hwm)
+        for url in subscribe_urls(address):
+            self._socket.connect(url)
+
+    async def subscribe(self, callback: callable, topic: bytes) -> None:
+        """Same callback contract as ZeroMQSubscriber.subscribe, callback may also be a coroutine function"""
+        self._socket.setsockopt(zmq.SUBSCRIBE, topic)
+        while True:
+            frames = await self._socket.recv_multipart(copy=False)
+            topic, message = frames[0].bytes, frames[1].bytes
+            result = callback(topic, message, *[frame.buffer for frame in frames[2:]])
+            if inspect.isawaitable(result):
+                await result
+
+
+class ZeroMQPusher(Publisher):
+    def __init__(self, address: str, high_water_mark=2):
+        """Load balancing sender, every message goes to exactly one of the connected pullers
+
+        Args:
+            address (str): url of the puller to connect to
+            high_water_mark (int, optional): messages queued before sending blocks. Defaults to 2.
+        """
+        self._address = address
+        self._context = get_context()
+        self._socket = self._context.socket(zmq.PUSH)
+        self._socket.setsockopt(zmq.SNDHWM, high_water_mark)
+        self._socket.connect(self._address)
+        self._lock = threading.Lock()
+
+    def publish(self, topic: bytes, message: bytes) -> None:
+        with self._lock:
+            self._socket.send_multipart([topic, message])
+
+    def publish_frames(self, topic: bytes, frames: list) -> None:
+        with self._lock:
+            self._socket.send_multipart([topic] + frames, copy=False)
+
+class ZeroMQPuller(Subscriber):
+    def __init__(self, address: str, high_water_mark=2):
+        """Receiving end of a load balanced work queue, a small high water mark keeps idle workers getting the next frame
+
+        Args:
+            address (str): url of the pusher to connect to
+            high_water_mark (int, optional): messages queued in this worker. Defaults to 2.
+        """
+        self._address = address
+        self._context = get_context()
+        self._socket = self._context.socket(zmq.PULL)
+        self._socket.setsockopt(zmq.RCVHWM, high_water_mark)
+        self._socket.connect(self._address)
+
+    def subscribe(self, callback: callable, topic: bytes) -> None:
+        # same callback contract as ZeroMQSubscriber, messages of other topics are ignored
+        while True:
+            frames = self._socket.recv_multipart(copy=False)
+            message_topic, message = frames[0].bytes, frames[1].bytes
+            if message_topic.startswith(topic):
+                callback(message_topic, message, *[frame.buffer for frame in frames[2:]])
 
 
 class Node(ABC):
-    def __init__(self, address: str):
-        self.publisher = Publisher(address)
-        self.subscriber = Subscriber(address)
+    def __init__(self, address, publisher: Publisher = None, subscriber: Subscriber = None, log_level=logging.INFO):
+        """
+        Args:
+            address (str or BrokerEndpoints): endpoints of the Broker used by the default ZeroMQ publisher and
+                subscriber. A plain url is bound by the publisher, only one node per url can publish then.
+            publisher (Publisher, optional): replaces the default publisher, eg. a pusher for pooled workers
+            subscriber (Subscriber, optional): replaces the default subscriber, eg. a puller for pooled workers
+            log_level (int, optional): records below this level are dropped in the node. Defaults to logging.INFO,
+                per frame messages are logged at DEBUG.
+        """
+        self.address = address
+        self.publisher = publisher if publisher is not None else ZeroMQPublisher(address)
+        self.subscriber = subscriber if subscriber is not None else ZeroMQSubscriber(address)
+        self.metrics = NodeMetrics(type(self).__name__)
+        # log records are batched and published by a background thread, see Logger/LogRecords.py
+        self.log = LogPublisher(self.publisher, Topics['LOG_RECORDS'], type(self).__name__, log_level)
+        # original values of the settings overridden through apply_settings, settings rejected (warned once)
+        self._setting_defaults = {}
+        self._rejected_settings = set()
+
+    # attributes a controller may change at runtime, dotted paths below them too, eg. 'camera.framerate'
+    controllable = ()
+    # integer settings and their smallest valid value, eg. {'frame_step': 1}, invalid values are ignored
+    setting_minimums = {}
+
+    @property
+    def name(self) -> str:
+        # name in metrics snapshots, log records and control messages, the class name unless set, eg. by Pipeline
+        return self.metrics.name
+
+    @name.setter
+    def name(self, value: str):
+        self.metrics.name = value
+        self.log.node = value
+
+    @property
+    def statistics(self) -> dict:
+        # counters of the node, exported together with the latency histograms
+        return {}
+
+    def apply_settings(self, settings: dict) -> dict:
+        """Override runtime settings of the node. Settings overridden before and missing from settings get their
+        original value back, so apply_settings({}) restores the node.
+
+        Args:
+            settings (dict): attribute path -> value, the first part of the path must be in controllable
+
+        Returns:
+            dict: attribute path -> new value of the settings that changed
+        """
+        changed = {}
+        for path in set(settings) | set(self._setting_defaults):
+            if path in self._rejected_settings:
+                continue
+            owner, _, attribute = path.rpartition('.')
+            target = self
+            for part in filter(None, owner.split('.')):
+                target = getattr(target, part, None)
+            if path.split('.')[0] not in self.controllable or not hasattr(target, attribute):
+                self._rejected_settings.add(path)
+                self.log.warning("Setting %s can not be controlled in %s", path, self.name)
+                continue
+            if path in settings and path in self.setting_minimums:
+                value = settings[path]
+                if isinstance(value, bool) or not isinstance(value, int) or value < self.setting_minimums[path]:
+                    # keep the current value, eg. frame_step 0 would fail on every frame
+                    self.log.warning("Setting %s of %s must be an integer of at least %d, %r is ignored", path,
+                                     self.name, self.setting_minimums[path], value)
+                    continue
+            if path not in self._setting_defaults:
+                self._setting_defaults[path] = getattr(target, attribute)
+            value = settings.get(path, self._setting_defaults[path])
+            if getattr(target, attribute) != value:
+                setattr(target, attribute, value)
+                changed[path] = value
+            if path not in settings:
+                del self._setting_defaults[path]
+        return changed
+
+    def follow_control(self, topic=Topics['CONTROL']) -> threading.Thread:
+        """Apply the settings a QoSController publishes for this node (by name) in a background thread
+
+        Returns:
+            threading.Thread: the receiving thread
+        """
+        subscriber = ZeroMQSubscriber(self.address)
+
+        def callback(topic: bytes, message: bytes):
+            try:
+                control = json.loads(message)
+                if self.name not in control.get('nodes', {}):
+                    return
+                changed = self.apply_settings(control['nodes'][self.name])
+                if changed:
+                    self.log.info("QoS level %s applied to %s: %s", control.get('level'), self.name, changed)
+            except Exception as e:
+                self.log.exception("Exception occurred while applying control settings")
+
+        thread = threading.Thread(target=subscriber.subscribe, args=(callback, topic), daemon=True)
+        thread.start()
+        return thread
+
+    def export_metrics(self, path=None, interval=5.0, publish=True) -> threading.Thread:
+        """Periodically export a snapshot of the node metrics in a background thread
+
+        Args:
+            path (str, optional): json file the latest snapshot is written to. Defaults to None, no file.
+            interval (float, optional): seconds between snapshots. Defaults to 5.0.
+            publish (bool, optional): publish the snapshot as json on Topics['METRICS']. Defaults to True.
+
+        Returns:
+            threading.Thread: the exporting thread
+        """
+        def export():
+            while True:
+                time.sleep(interval)
+                for name, value in self.statistics.items():
+                    self.metrics.set_counter(name, value)
+                self.metrics.set_counter('log_records_dropped', self.log.dropped)
+                if path is not None:
+                    self.metrics.export_json(path)
+                if publish:
+                    self.publisher.publish(Topics['METRICS'], json.dumps(self.metrics.snapshot()).encode())
+
+        thread = threading.Thread(target=export, daemon=True)
+        thread.start()
+        return thread
     
     @abstractmethod
     def run(self):
         pass
 
+
+class AsyncNode(Node):
+    def __init__(self, address, publisher: Publisher = None, subscriber: Subscriber = None, receive_hwm=None):
+        """Node with a coroutine run(), run several of them in one thread with run_nodes
+
+        Args:
+            address (str or BrokerEndpoints): see Node
+            publisher (Publisher, optional): see Node. Publishing does not block, the default ZeroMQPublisher is used.
+            subscriber (Subscriber, optional): defaults to an AsyncZeroMQSubscriber
+            receive_hwm (int, optional): receive high water mark of the default subscriber. Defaults to None.
+        """
+        if subscriber is None:
+            subscriber = AsyncZeroMQSubscriber(address, receive_hwm)
+        super().__init__(address, publisher, subscriber)
+
+    @abstractmethod
+    async def run(self):
+        pass
+
+
+async def run_nodes(*nodes: AsyncNode):
+    # multiplexes the subscribers of all nodes on the current event loop, eg. asyncio.run(run_nodes(a, b))
+    await asyncio.gather(*(node.run() for node in nodes))
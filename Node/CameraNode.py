@@ -1,51 +1,241 @@
 from typing import Any
-from AbstractNode import Node, Topics
+from Node.AbstractNode import Node, Topics, ZeroMQPublisher
 from Buffer.RingBuffer import RingBuffer
 from Device.Camera import Camera
-import pickle
+from Node.Message import CameraMessage
+from Logger.Metrics import trace_now
+import cv2
+import numpy as np
+import threading
 import time
 
 
+# derived stream -> default topic
+DERIVED_STREAMS = {
+    'half': Topics['IMAGE_HALF'],
+    'thumbnail': Topics['IMAGE_THUMBNAIL'],
+    'gray': Topics['IMAGE_GRAY'],
+    'roi': Topics['IMAGE_ROI']
+}
+
+
 class CameraNode(Node):
-    def __init__(self, address: str, camera: Camera, ring_buffer: RingBuffer):
+    # see Node.apply_settings, eg. 'camera.framerate'
+    controllable = ('camera', 'latest_only')
+
+    def __init__(self, address: str, camera: Camera, ring_buffer: RingBuffer, publish_image=True, latest_only=False,
+                 send_hwm=None, topic=Topics['IMAGE_RGB'], derived_streams=(), roi=None, thumbnail_width=320,
+                 encodings=None, encoder_threads=2):
+        """Node publishing the frames of one camera
 
-        super().__init__(address)
+        Args:
+            address (str): url the frames are published on
+            camera (Camera): camera to stream from
+            ring_buffer (RingBuffer): shared memory buffer holding the latest frames
+            publish_image (bool, optional): send the pixels with every message. Set to False when all subscribers
+                run on this machine, they then read the frame from the shared ring buffer by sequence number. Defaults to True.
+            latest_only (bool, optional): when publishing falls behind, send only the newest frame and count the
+                others as skipped. Defaults to False, every frame is published exactly once.
+            send_hwm (int, optional): frames queued per subscriber, zmq drops frames for subscribers that fall further behind.
+                Defaults to None, zmq default of 1000.
+            topic (bytes, optional): topic the frames are published on. Defaults to Topics['IMAGE_RGB'].
+            derived_streams (list or dict, optional): reduced copies of every frame published next to the full frame,
+                computed once here instead of in every consumer. Any of 'half' (half resolution), 'thumbnail'
+                (thumbnail_width wide), 'gray' (single channel) and 'roi' (crop of roi), on the topics of
+                DERIVED_STREAMS, or a dict stream -> topic. Derived frames always carry their pixels, plus 'stream' and
+                'scale' or 'roi' to map coordinates back to the full frame. Defaults to (), none.
+            roi (tuple, optional): (x, y, width, height) of the 'roi' stream in full frame pixels, must lie inside the
+                frames of the camera. Defaults to None.
+            thumbnail_width (int, optional): width of the 'thumbnail' stream, the aspect ratio is kept. Defaults to 320.
+            encodings (dict, optional): topic -> compression of its frames for subscribers on other machines, eg.
+                {Topics['IMAGE_RGB']: 'jpeg:85'}, see Node/FrameEncoding.py. Defaults to None, raw frames.
+            encoder_threads (int, optional): threads encoding frames, see ZeroMQPublisher. Defaults to 2.
+        """
+        # checked before the sockets are opened
+        if not isinstance(derived_streams, dict):
+            derived_streams = {stream: DERIVED_STREAMS.get(stream) for stream in derived_streams}
+        unknown = [stream for stream in derived_streams if stream not in DERIVED_STREAMS]
+        if unknown:
+            raise ValueError(f"Unknown derived streams {unknown}, choose from {list(DERIVED_STREAMS)}.")
+        if 'roi' in derived_streams:
+            if roi is None:
+                raise ValueError("The 'roi' stream needs a roi.")
+            x, y, roi_width, roi_height = roi
+            height, width = camera.frame_shape[:2]
+            if roi_width <= 0 or roi_height <= 0 or x < 0 or y < 0 or x + roi_width > width or y + roi_height > height:
+                raise ValueError(f"The roi {tuple(roi)} is empty or exceeds the {width}x{height} frames of the camera.")
+
+        super().__init__(address, publisher=ZeroMQPublisher(address, send_hwm, encodings, encoder_threads))
         self.camera = camera
         self.ring_buffer = ring_buffer
-        self.topic = Topics['IMAGE_RGB']
+        self.publish_image = publish_image
+        self.latest_only = latest_only
+        self.topic = topic
+        self.derived_streams = derived_streams
+        self.roi = tuple(roi) if roi is not None else None
+        self.thumbnail_width = thumbnail_width
+        self.derived_published = 0
+
+        # wakes up the publishing loop whenever the camera adds a frame to the ring buffer
+        self._new_frame = threading.Condition()
+        self._running = False
+        self._last_published = 0
+        self.frames_published = 0
+        self.frames_dropped = 0
+        self.frames_skipped = 0
 
     def run(self):
+        # Binding ring buffer update function to camera new frame arrived call back, streaming is started only once
+        self._running = True
+        self._last_published = self.ring_buffer.counter
+        self.camera.set_new_frame_callback(self._on_new_frame)
+        self.camera.start_streaming()
         try:
-            while True:                
-                # Binding ring buffer update function to camera new frame arrived call back
-                self.camera.set_new_frame_callback(self.ring_buffer.add)
-                self.camera.start_streaming()
-                
-                if self.ring_buffer.is_updated():
-                    latest_image = self.ring_buffer.get_latest()
-                    if latest_image is not None:
-                        camera_info = f"Camera {self.camera.cameratype}"
-                        timestamp = time.time()
-                        serialized_message = self.serialize_message(latest_image, camera_info, timestamp)
-                        self.publisher.publish(self.topic, serialized_message)
-
-                        self.publisher.publish(Topics['LOG_INFO'], b"Published latest image from {camera_info} at {timestamp}")
+            while self._running:
+                # sleep until the camera delivered a frame that has not been published yet
+                with self._new_frame:
+                    self._new_frame.wait_for(lambda: self.ring_buffer.counter > self._last_published or not self._running)
+                self._publish_pending_frames()
 
         except Exception as e:
-            self.publisher.publish(Topics['LOG_ERROR'], b"Exception occurred in CameraNode run loop")
+            self.log.exception("Exception occurred in CameraNode run loop")
+            # the node is going down, do not wait for the next periodic flush
+            self.log.flush()
             raise
+        finally:
+            self.camera.stop_streaming()
 
-    def serialize_message(self, image: Any, camera_info: str, timestamp: float) -> bytes:
-        try:
-            message = {
+    def stop(self):
+        self._running = False
+        with self._new_frame:
+            self._new_frame.notify_all()
+
+    @property
+    def statistics(self) -> dict:
+        return {
+            'frames_published': self.frames_published,
+            'frames_dropped': self.frames_dropped,
+            'frames_skipped': self.frames_skipped,
+            'derived_published': self.derived_published,
+            # encoded frame size and cost
+            **self.publisher.statistics,
+            # frame buffer reuse of the camera, exhausted counts frames that needed a new allocation
+            **self.camera.frame_pool.statistics
+        }
+
+    def _on_new_frame(self, frame):
+        # called from the camera streaming thread
+        self.ring_buffer.add(frame)
+        with self._new_frame:
+            self._new_frame.notify()
+
+    def _publish_pending_frames(self):
+        latest = self.ring_buffer.counter
+        if latest <= self._last_published:
+            # woken by stop() or spuriously, every frame is published already
+            return
+        first = self._last_published + 1
+        if self.latest_only:
+            # stale frames are not worth sending, only the newest one goes out
+            self.frames_skipped += latest - first
+            first = latest
+
+        camera_info = f"Camera {self.camera.cameratype}"
+        for sequence in range(first, latest + 1):
+            image = self.ring_buffer.get_by_sequence(sequence)
+            if image is not None and (self.publish_image or self.derived_streams):
+                # zmq sends large frames without copying and encoders read them later, a view of the slot would
+                # change under the subscriber once the camera laps the ring buffer
+                image = image.copy()
+            if image is None or self.ring_buffer.is_overwritten(sequence):
+                # the camera lapped the ring buffer before this frame could be published
+                self.frames_dropped += 1
+                continue
+            timestamp = self.ring_buffer.get_timestamp(sequence)
+            if timestamp is not None:
+                # time the frame waited in the ring buffer, capture timestamps are wall clock
+                self.metrics.record('capture_to_publish', time.time() - timestamp)
+
+            published = trace_now()
+            message = self._message(image, camera_info, timestamp, sequence, trace={'camera': published})
+            # encoded topics are serialized on the encoder threads, this only measures the hand over then
+            self.publisher.publish_message(self.topic, message)
+            self.metrics.record_between('serialize', published, trace_now())
+            self.frames_published += 1
+            if self.derived_streams:
+                self._publish_derived_frames(image, camera_info, timestamp, sequence, published)
+
+            self.log.debug("Published image %d from %s at %s", sequence, camera_info, timestamp, sequence=sequence)
+        self._last_published = latest
+
+    def _publish_derived_frames(self, image, camera_info: str, timestamp: float, sequence: int, published: int):
+        started = trace_now()
+        for stream, (derived, geometry) in self.derive_frames(image).items():
+            message = CameraMessage({
                 'camera_info': camera_info,
                 'time_stamp': timestamp,
-                'image': image
-            }
-            return pickle.dumps(message)
+                'sequence': sequence,
+                'trace': {'camera': published},
+                'stream': stream,
+                **geometry,
+                'image': derived
+            })
+            self.publisher.publish_message(self.derived_streams[stream], message)
+            self.derived_published += 1
+        self.metrics.record_between('derive', started, trace_now())
+
+    def derive_frames(self, image: np.ndarray) -> dict:
+        """
+        Args:
+            image (np.ndarray): full frame, (height, width) or (height, width, channels)
+
+        Returns:
+            dict: stream -> (new contiguous frame, {'scale': (x, y)} or {'roi': (x, y, width, height)}), frames are
+                sent without copying, so they never share memory with the ring buffer
+        """
+        derived = {}
+        height, width = image.shape[:2]
+        half = None
+        if 'half' in self.derived_streams or 'thumbnail' in self.derived_streams:
+            half = cv2.resize(image, (max(width // 2, 1), max(height // 2, 1)), interpolation=cv2.INTER_AREA)
+            if 'half' in self.derived_streams:
+                derived['half'] = (half, {'scale': (half.shape[1] / width, half.shape[0] / height)})
+        if 'thumbnail' in self.derived_streams:
+            # from the half resolution frame, a quarter of the pixels to average
+            thumbnail_height = max(int(round(height * self.thumbnail_width / width)), 1)
+            source = half if self.thumbnail_width <= half.shape[1] else image
+            thumbnail = cv2.resize(source, (self.thumbnail_width, thumbnail_height), interpolation=cv2.INTER_AREA)
+            derived['thumbnail'] = (thumbnail, {'scale': (self.thumbnail_width / width, thumbnail_height / height)})
+        if 'gray' in self.derived_streams:
+            if image.ndim == 2:
+                gray = image.copy()
+            else:
+                conversion = cv2.COLOR_BGRA2GRAY if image.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+                gray = cv2.cvtColor(image, conversion)
+            derived['gray'] = (gray, {'scale': (1.0, 1.0)})
+        if 'roi' in self.derived_streams:
+            x, y, roi_width, roi_height = self.roi
+            derived['roi'] = (image[y:y + roi_height, x:x + roi_width].copy(), {'roi': self.roi})
+        return derived
+
+    def serialize_message(self, image: Any, camera_info: str, timestamp: float, sequence: int = 0, trace=None) -> list:
+        try:
+            return self._message(image, camera_info, timestamp, sequence, trace).serialize()
         except Exception as e:
-            self.publisher.publish(Topics['LOG_ERROR'], b"Exception occurred while serializing message")
-            raise 
+            self.log.exception("Exception occurred while serializing message", sequence=sequence)
+            raise
+
+    def _message(self, image: Any, camera_info: str, timestamp: float, sequence: int = 0, trace=None) -> CameraMessage:
+        return CameraMessage({
+            'camera_info': camera_info,
+            'time_stamp': timestamp,
+            'sequence': sequence,
+            # stage timestamps, extended by every node the frame passes, see Logger/Metrics.py
+            'trace': trace or {},
+            # subscribers on the same machine attach to the ring buffer by name and skip the pixel copy
+            'ring_buffer': self.ring_buffer.name,
+            'image': image if self.publish_image else None
+        })
 
 
 def testing_camera_node():
@@ -0,0 +1,145 @@
+"""
+Compressed transport of image frames, for subscribers on other machines
+
+Raw frames are cheapest on localhost but saturate the line network once nodes run on other machines. A publisher can
+encode the frames of a topic (see ZeroMQPublisher encodings), the image message header then carries an 'encoding'
+entry and ImageMessage.deserialize decodes the frame, subscribers need no changes.
+
+    raw       the ndarray buffer itself, no cost
+    lz4       lossless, fastest, any dtype (pip install lz4)
+    zstd      lossless, smaller than lz4 at a higher cost, any dtype (pip install zstandard)
+    png       lossless through OpenCV, uint8 or uint16 with 1, 3 or 4 channels
+    jpeg      lossy through OpenCV with a quality setting, uint8 with 1 or 3 channels
+
+Encodings are written as "codec" or "codec:setting" in pipeline files, eg. "jpeg:85" or "zstd:3". The setting is the
+quality of jpeg and the compression level of the others.
+"""
+
+import cv2
+import numpy as np
+import threading
+
+
+CODECS = ('raw', 'lz4', 'zstd', 'png', 'jpeg')
+
+
+def _lz4():
+    try:
+        import lz4.block
+    except ImportError as e:
+        raise ImportError("The lz4 encoding requires the lz4 package: pip install lz4") from e
+    return lz4.block
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("The zstd encoding requires the zstandard package: pip install zstandard") from e
+    return zstandard
+
+
+class FrameEncoding:
+    def __init__(self, codec='raw', setting=None):
+        """
+        Args:
+            codec (str, optional): one of CODECS. Defaults to 'raw'.
+            setting (int, optional): jpeg quality (default 90), png compression level 0-9 (default 1),
+                lz4 acceleration level (default 0) or zstd level (default 3). Defaults to None.
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unknown frame encoding {codec!r}, choose from {CODECS}.")
+        self.codec = codec
+        self.setting = setting
+        # checked here, a missing package should fail when the node starts and not on the first frame
+        if codec == 'lz4':
+            _lz4()
+        elif codec == 'zstd':
+            _zstd()
+        # zstd compressors must not be shared between the encoding threads
+        self._local = threading.local()
+
+    @classmethod
+    def parse(cls, encoding) -> "FrameEncoding":
+        # "jpeg:85", "png", a FrameEncoding or None (raw)
+        if encoding is None:
+            return cls()
+        if isinstance(encoding, FrameEncoding):
+            return encoding
+        codec, _, setting = str(encoding).partition(':')
+        return cls(codec, int(setting) if setting else None)
+
+    @property
+    def is_raw(self) -> bool:
+        return self.codec == 'raw'
+
+    def __repr__(self) -> str:
+        return self.codec if self.setting is None else f"{self.codec}:{self.setting}"
+
+    def encode(self, image: np.ndarray) -> tuple:
+        """
+        Args:
+            image (np.ndarray): C contiguous frame
+
+        Returns:
+            tuple: (encoded buffer, header entry needed by decode_image)
+        """
+        if self.codec == 'raw':
+            return image, None
+        info = {'codec': self.codec, 'dtype': image.dtype.str, 'shape': image.shape}
+        if self.codec == 'lz4':
+            data = _lz4().compress(image, mode='fast', acceleration=self.setting or 0, store_size=False)
+        elif self.codec == 'zstd':
+            compressor = getattr(self._local, 'compressor', None)
+            if compressor is None:
+                compressor = _zstd().ZstdCompressor(level=3 if self.setting is None else self.setting)
+                self._local.compressor = compressor
+            data = compressor.compress(image)
+        else:
+            data = self._encode_image(image)
+        return data, info
+
+    def _encode_image(self, image: np.ndarray) -> bytes:
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        if self.codec == 'jpeg':
+            if image.dtype != np.uint8 or channels not in (1, 3):
+                raise ValueError(f"jpeg encodes uint8 frames with 1 or 3 channels, got {image.dtype} {image.shape}.")
+            parameters = [cv2.IMWRITE_JPEG_QUALITY, 90 if self.setting is None else self.setting]
+            extension = '.jpg'
+        else:
+            if image.dtype not in (np.uint8, np.uint16) or channels not in (1, 3, 4):
+                raise ValueError(f"png encodes uint8 or uint16 frames with 1, 3 or 4 channels, "
+                                 f"got {image.dtype} {image.shape}.")
+            parameters = [cv2.IMWRITE_PNG_COMPRESSION, 1 if self.setting is None else self.setting]
+            extension = '.png'
+        success, encoded = cv2.imencode(extension, image, parameters)
+        if not success:
+            raise ValueError(f"OpenCV could not encode a {image.dtype} {image.shape} frame as {self.codec}.")
+        return encoded
+
+
+def decode_image(buffer, info: dict) -> np.ndarray:
+    """Inverse of FrameEncoding.encode
+
+    Args:
+        buffer: received encoded frame
+        info (dict): 'encoding' entry of the message header
+
+    Returns:
+        np.ndarray: decoded frame
+    """
+    codec = info['codec']
+    dtype = np.dtype(info['dtype'])
+    shape = tuple(info['shape'])
+    if codec == 'lz4':
+        data = _lz4().decompress(buffer, uncompressed_size=int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+    if codec == 'zstd':
+        data = _zstd().ZstdDecompressor().decompress(buffer, max_output_size=int(np.prod(shape)) * dtype.itemsize)
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+    if codec in ('png', 'jpeg'):
+        image = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError(f"Received {codec} frame could not be decoded.")
+        return image.reshape(shape)
+    raise ValueError(f"Unknown frame encoding {codec!r}.")
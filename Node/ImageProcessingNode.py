@@ -1,65 +1,235 @@
-import pickle
-from AbstractNode import Node, Topics
+from Node.AbstractNode import Node, Topics, Publisher, Subscriber, ZeroMQSubscriber
+from Node.Message import CameraMessage, MessageProcessingResult
+from Buffer.RingBuffer import RingBuffer
+from Buffer.DropOldestQueue import DropOldestQueue
 from ImageProcessing.AbstractImageProcessing import ImageProcessing
+from ImageProcessing.ChangeDetection import FrameChangeDetector
+from ImageProcessing.Cascade import CascadeDetector
+from Logger.Metrics import trace_now
 from typing import Any
 import numpy as np
+import queue
+import threading
+import time
 
 
 
 class ImageProcessingNode(Node):
-    def __init__(self, address: str, processing_algorithm: ImageProcessing):
-        """_summary_
+    # see Node.apply_settings, eg. 'processing_algorithm.downscale' of a LegoBrickRecognition
+    controllable = ('frame_step', 'max_batch_size', 'max_batch_wait', 'processing_algorithm')
+    setting_minimums = {'frame_step': 1}
+
+    def __init__(self, address: str, processing_algorithm: ImageProcessing, max_batch_size=1, max_batch_wait=0.0,
+                 change_threshold=None, change_step=8, queue_size=0, receive_hwm=None,
+                 input_topic=Topics['IMAGE_RGB'], result_topic=Topics['IMAGE_RECONGNITION_RESULT'],
+                 candidate_detector=None, frame_step=1, block_when_full=False, publisher: Publisher = None,
+                 subscriber: Subscriber = None):
+        """Node running an image processing algorithm on every received frame
 
         Args:
             address (str): Image process node will subscribe to this url and cache the image
             processing_algorithm (ImageProcessing): The method to handle image processing task
+            max_batch_size (int, optional): maximum number of frames processed in one run_batch call. Defaults to 1.
+            max_batch_wait (float, optional): seconds to wait for more frames after the first frame of a batch arrived.
+                Defaults to 0.0, frames that are already queued are batched but the node never waits for more.
+            change_threshold (float, optional): mean absolute intensity difference to the last processed frame below which
+                the frame is not processed and the cached result is published again. Defaults to None, every frame is processed.
+            change_step (int, optional): pixel step of the subsampled change detection. Defaults to 8.
+            queue_size (int, optional): frames waiting for processing, when full the oldest frame is dropped.
+                Set it to max_batch_size (or 1 for latest frame only) to bound latency when processing is slower than
+                the camera. Defaults to 0, unbounded.
+            receive_hwm (int, optional): zmq receive high water mark of the default subscriber. Defaults to None.
+            input_topic (bytes, optional): topic of the frames to process. Defaults to Topics['IMAGE_RGB'].
+            result_topic (bytes, optional): topic the results are published on. Defaults to Topics['IMAGE_RECONGNITION_RESULT'].
+            candidate_detector (optional): cascade mode, eg. LegoBrickRecognition. Runs first on every frame and
+                processing_algorithm only on crops of the bricks it found, see CascadeDetector. Defaults to None.
+            frame_step (int, optional): process only frames whose sequence number is a multiple of frame_step.
+                Defaults to 1, every frame. Lowered at runtime by a QoSController, see Node/QoSController.py.
+            block_when_full (bool, optional): a full queue blocks the receiving thread instead of dropping the oldest
+                frame, frames then back up into the subscriber socket and are dropped by the sender, eg. the
+                dispatcher of an ImageProcessingPool. Defaults to False.
+            publisher (Publisher, optional): replaces the default publisher, see ImageProcessingPool
+            subscriber (Subscriber, optional): replaces the default subscriber, see ImageProcessingPool
         """
 
-        super().__init__(address)
+        if subscriber is None:
+            subscriber = ZeroMQSubscriber(address, receive_hwm)
+        super().__init__(address, publisher, subscriber)
+        if candidate_detector is not None:
+            processing_algorithm = CascadeDetector(candidate_detector, processing_algorithm)
         self.processing_algorithm = processing_algorithm
+        self.input_topic = input_topic
+        self.result_topic = result_topic
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.frame_step = frame_step
+        self.change_detector = FrameChangeDetector(change_threshold, change_step) if change_threshold is not None else None
+        self._last_result = None
+        # startup cost of the algorithm (eg. loading a model), exported together with the other counters
+        for step, seconds in getattr(processing_algorithm, 'startup_times', {}).items():
+            self.metrics.set_counter(f'startup_{step}_s', seconds)
+        self.frames_processed = 0
+        self.frames_unchanged = 0
+        self.frames_skipped = 0
+        self.frames_overwritten = 0
+        # shared memory ring buffers of local cameras, attached on first use
+        self._ring_buffers = {}
+        # frames handed from the receiving thread to the batching thread, never blocks the receiving thread unless
+        # block_when_full is set
+        self._pending = queue.Queue(queue_size) if block_when_full else DropOldestQueue(queue_size)
+        self._processing_thread = None
 
     def run(self):
+        self._processing_thread = threading.Thread(target=self._process_batches, daemon=True)
+        self._processing_thread.start()
         try:
             # Only subscribe to image data by topic filtering
-            self.subscriber.subscribe(self.callback, topic = b'sensor_data.image_rgb')
+            self.subscriber.subscribe(self.callback, topic = self.input_topic)
         except Exception as e:
-            self.publisher.publish(Topics['LOG_ERROR'], b"Exception occurred in ImageProcessingNode run loop")
+            self.log.exception("Exception occurred in ImageProcessingNode run loop")
 
-    def callback(self, serialized_message: bytes):
+    def callback(self, topic: bytes, header: bytes, *buffers):
         try:
-            message = pickle.loads(serialized_message)
-            image = message['image']
-            timestamp = message['time_stamp']
+            received = trace_now()
+            message = CameraMessage.deserialize(header, *buffers)
+            if message.sequence % self.frame_step:
+                # thinned out frames are not even read from the ring buffer
+                self.frames_skipped += 1
+                return
+            image = self._get_image(message)
+            if image is None:
+                self.log.warning("Frame %d was overwritten in ring buffer before processing", message.sequence,
+                                 sequence=message.sequence)
+                return
 
-            # Process the image
-            result = self._process_image(image)
-            serialized_processed_message = self._serialize_message(image, result, timestamp)
-            
-            # Publish the Processing result, eg, can be used by a physical actuator
-            self.publisher.publish(Topics['IMAGE_RECONGNITION_RESULT'], serialized_processed_message)
+            trace = message.trace
+            trace['received'] = received
+            trace['queued'] = trace_now()
+            self.metrics.record_between('transport', trace.get('camera'), received)
+            self.metrics.record_between('deserialize', received, trace['queued'])
 
-            # Publish information for logging
-            self.publisher.publish(Topics['LOG_INFO'], b"Published processed image at {timestamp}")
+            # Processing happens on the batching thread
+            self._pending.put((message, image))
 
         except Exception as e:
-            self.publisher.publish(Topics['LOG_ERROR'], b"Exception occurred in ImageProcessingNode callback")
+            self.log.exception("Exception occurred in ImageProcessingNode callback")
 
-    def _process_image(self, image: np.ndarray) -> Any:
-        try:
-            # Convert image to grayscale as a basic processing step
-            return self.processing_algorithm.run(image)
-        except Exception as e:
-            self.publisher.publish(Topics['LOG_ERROR'], b"Exception occurred while processing image")
-            raise
+    def _collect_batch(self) -> list:
+        # block for the first frame, then gather more until the batch is full or the deadline passed
+        batch = [self._pending.get()]
+        deadline = time.monotonic() + self.max_batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._pending.get(timeout=remaining))
+                else:
+                    batch.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _process_batches(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                started = trace_now()
+                # Process all images in one pass and split the results back per frame
+                results = self._process_images([image for _, image in batch])
+                processed = trace_now()
+                for (message, _), result in zip(batch, results):
+                    if self._is_overwritten(message):
+                        # the camera lapped the ring buffer while the frame was processed, the result may describe
+                        # a different frame than the sequence it would be published under
+                        self.frames_overwritten += 1
+                        self.log.warning("Frame %d was overwritten in ring buffer during processing", message.sequence,
+                                         sequence=message.sequence)
+                        continue
+                    trace = message.trace
+                    trace['processed'] = processed
+                    self.metrics.record_between('queueing', trace.get('queued'), started)
+                    self.metrics.record_between('process', started, processed)
+
+                    timestamp = message.timestamp
+                    serialized_processed_message = self._serialize_message(message.sequence, result, timestamp, trace)
+                    published = trace_now()
+                    self.metrics.record_between('serialize', processed, published)
+                    self.metrics.record_between('end_to_end', trace.get('camera'), published)
+
+                    # Publish the Processing result, eg, can be used by a physical actuator
+                    self.publisher.publish_frames(self.result_topic, serialized_processed_message)
+
+                    # Per frame information, dropped in the node unless its log level is DEBUG
+                    self.log.debug("Published result of image %d captured at %s", message.sequence, timestamp,
+                                   sequence=message.sequence)
+
+            except Exception as e:
+                self.log.exception("Exception occurred in ImageProcessingNode batch processing")
+
+    @property
+    def statistics(self) -> dict:
+        return {
+            'frames_processed': self.frames_processed,
+            'frames_unchanged': self.frames_unchanged,
+            'frames_skipped': self.frames_skipped,
+            'frames_overwritten': self.frames_overwritten,
+            'frames_dropped': getattr(self._pending, 'dropped', 0),
+            'queue_depth': self._pending.qsize(),
+            # counters of the algorithm itself, eg. cache hits of a TrackingClassifier
+            **getattr(self.processing_algorithm, 'statistics', {})
+        }
+
+    def _get_image(self, message: CameraMessage) -> np.ndarray:
+        # Frames published without pixels are read straight from the camera's shared memory ring buffer
+        if message.image is not None:
+            return message.image
+        name = message.content['ring_buffer']
+        if name not in self._ring_buffers:
+            self._ring_buffers[name] = RingBuffer.attach(name)
+        return self._ring_buffers[name].get_by_sequence(message.sequence)
+
+    def _is_overwritten(self, message: CameraMessage) -> bool:
+        # images received with the message belong to the node, ring buffer views are only valid until the camera laps
+        if message.image is not None:
+            return False
+        return self._ring_buffers[message.content['ring_buffer']].is_overwritten(message.sequence)
+
+    def _process_images(self, images: list) -> list:
+        # exceptions are logged by _process_batches
+        if self.change_detector is None:
+            results = self.processing_algorithm.run_batch(images)
+            self.frames_processed += len(images)
+            return results
+
+        # only frames that differ from the last processed frame go to the algorithm,
+        # every other frame gets the result of the last processed frame before it
+        changed = []
+        sources = []
+        for image in images:
+            if self.change_detector.has_changed(image):
+                changed.append(image)
+            sources.append(len(changed) - 1)
+        processed = self.processing_algorithm.run_batch(changed) if changed else []
+
+        results = [processed[index] if index >= 0 else self._last_result for index in sources]
+        if processed:
+            self._last_result = processed[-1]
+        self.frames_processed += len(changed)
+        self.frames_unchanged += len(images) - len(changed)
+        return results
 
-    def _serialize_message(self, image: Any, result: Any, timestamp: float) -> bytes:
+    def _serialize_message(self, sequence: int, result: Any, timestamp: float, trace=None) -> list:
         try:
-            message = {
-                'timestamp': timestamp,
-                'image': image,
-                'result': result
-            }
-            return pickle.dumps(message)
+            # the result refers to the frame by sequence number, the pixels are not sent again
+            message = MessageProcessingResult({
+                'sequence': sequence,
+                'time_stamp': timestamp,
+                # tells a QoSController which node is late
+                'node': self.name,
+                'result': result,
+                'trace': trace or {}
+            })
+            return message.serialize()
         except Exception as e:
-            self.publisher.publish(Topics['LOG_ERROR'], b"Exception occurred while serializing processed message")
+            self.log.exception("Exception occurred while serializing processed message", sequence=sequence)
             raise
@@ -0,0 +1,213 @@
+"""
+Runs N replicas of an ImageProcessingNode in separate processes, so image processing algorithms do not share one GIL
+
+              PUB/SUB               PUSH/PULL                 PUSH/PULL              PUB
+    camera  ----------->  pool  --------------> worker 1..N  ------------>  pool  ---------> result subscribers
+                        dispatch                                          collect, reorder
+
+The pool receives frames from the camera and load balances them over its workers. Results are collected
+and published in frame sequence order, log messages of the workers are forwarded as they arrive.
+"""
+
+from collections import deque
+from Node.AbstractNode import Node, Topics, ZeroMQPublisher, ZeroMQPusher, ZeroMQPuller, get_context, subscribe_urls
+from Node.Message import CameraMessage, MessageProcessingResult
+from Node.Resources import split_cpus
+import multiprocessing
+import time
+import zmq
+
+
+def run_worker(work_address: str, collect_address: str, algorithm_class: type, algorithm_kwargs: dict,
+               max_batch_size: int, max_batch_wait: float, node_kwargs=None, resources=None, name=None):
+    """Entry point of a worker process, the algorithm is created inside the worker so it never has to be pickled"""
+    # imported here so the pool itself does not pull in image processing dependencies
+    from Node.ImageProcessingNode import ImageProcessingNode
+    from Node.Resources import apply_resources
+
+    # before the algorithm is created, so its thread pools are sized for this worker
+    apply_resources(**(resources or {}))
+    algorithm = algorithm_class(**algorithm_kwargs)
+    node = ImageProcessingNode(work_address, algorithm, max_batch_size, max_batch_wait,
+                               publisher=ZeroMQPusher(collect_address),
+                               subscriber=ZeroMQPuller(work_address), **(node_kwargs or {}))
+    if name is not None:
+        node.name = name
+    node.run()
+
+
+class ImageProcessingPool(Node):
+    # the algorithms live in the workers, only the dispatching can be changed at runtime
+    controllable = ('frame_step',)
+    setting_minimums = {'frame_step': 1}
+
+    def __init__(self, address, result_address, work_address: str, collect_address: str,
+                 algorithm_class: type, algorithm_kwargs=None, num_workers=2, max_batch_size=1, max_batch_wait=0.0,
+                 reorder_timeout=1.0, input_topic=Topics['IMAGE_RGB'], result_topic=Topics['IMAGE_RECONGNITION_RESULT'],
+                 node_kwargs=None, worker_resources=None, max_in_flight=None):
+        """Process pool of image processing workers for one algorithm
+
+        Args:
+            address (str or BrokerEndpoints): url of the camera publishing frames, or the Broker endpoints
+            result_address (str or BrokerEndpoints): url the ordered results are published on,
+                None publishes them through the Broker given as address
+            work_address (str): url frames are pushed to the workers on
+            collect_address (str): url the workers push their results to
+            algorithm_class (type): ImageProcessing subclass, instantiated in every worker
+            algorithm_kwargs (dict, optional): arguments for algorithm_class. Defaults to None.
+            num_workers (int, optional): number of worker processes. Defaults to 2.
+            max_batch_size (int, optional): batch size of every worker, see ImageProcessingNode. Defaults to 1.
+            max_batch_wait (float, optional): batch deadline of every worker, see ImageProcessingNode. Defaults to 0.0.
+            reorder_timeout (float, optional): seconds to wait for a missing result before publishing the later ones.
+                Defaults to 1.0.
+            input_topic (bytes, optional): topic of the frames to process. Defaults to Topics['IMAGE_RGB'].
+            result_topic (bytes, optional): topic of the results. Defaults to Topics['IMAGE_RECONGNITION_RESULT'].
+            node_kwargs (dict, optional): further ImageProcessingNode arguments of the workers, eg. change_threshold.
+                The queue of a worker holds max_batch_size frames unless queue_size is given, a full worker stops
+                receiving, so frames are dropped here instead of piling up in the workers.
+            worker_resources (dict, optional): apply_resources arguments of every worker, the cpu_affinity cpus
+                are split between the workers, see Node/Resources.py. Defaults to None.
+            max_in_flight (int, optional): frames dispatched and still waiting for their result, further frames are
+                dropped. Socket buffers between the pool and the workers would otherwise hold frames for longer than
+                reorder_timeout. Defaults to None, two batches per worker.
+        """
+        super().__init__(address, publisher=ZeroMQPublisher(address if result_address is None else result_address))
+        self.algorithm_class = algorithm_class
+        self.algorithm_kwargs = algorithm_kwargs or {}
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.reorder_timeout = reorder_timeout
+        self.max_in_flight = max_in_flight if max_in_flight is not None else 2 * num_workers * max_batch_size
+        # dispatch only frames whose sequence number is a multiple of frame_step, see ImageProcessingNode
+        self.frame_step = 1
+        self.work_address = work_address
+        self.collect_address = collect_address
+        self.input_topic = input_topic
+        self.result_topic = result_topic
+        self.node_kwargs = dict(node_kwargs or {}, input_topic=input_topic, result_topic=result_topic,
+                                block_when_full=True)
+        self.node_kwargs.setdefault('queue_size', max_batch_size)
+        self.worker_resources = worker_resources or {}
+
+        self._context = get_context()
+        self._frames = self._context.socket(zmq.SUB)
+        for url in subscribe_urls(address):
+            self._frames.connect(url)
+        self._frames.setsockopt(zmq.SUBSCRIBE, input_topic)
+        self._work = self._context.socket(zmq.PUSH)
+        # one frame queued per worker connection, busy workers make sending fail and the frame is dropped
+        self._work.setsockopt(zmq.SNDHWM, 1)
+        self._work.bind(work_address)
+        self._results = self._context.socket(zmq.PULL)
+        self._results.bind(collect_address)
+
+        # sequence numbers in dispatch order with their dispatch time, results waiting for their turn
+        self._dispatched = deque()
+        self._pending_results = {}
+        self._last_released = 0
+        self._workers = []
+        self.frames_dispatched = 0
+        self.frames_dropped = 0
+        self.frames_skipped = 0
+        self.results_missing = 0
+        self.results_late = 0
+
+    def run(self):
+        self._start_workers()
+        poller = zmq.Poller()
+        poller.register(self._frames, zmq.POLLIN)
+        poller.register(self._results, zmq.POLLIN)
+        try:
+            while True:
+                events = dict(poller.poll(timeout=100))
+                if self._frames in events:
+                    self._dispatch(self._frames.recv_multipart(copy=False))
+                if self._results in events:
+                    self._collect(self._results.recv_multipart())
+                self._publish_in_order()
+        except Exception as e:
+            self.log.exception("Exception occurred in ImageProcessingPool run loop")
+            # the node is going down, do not wait for the next periodic flush
+            self.log.flush()
+            raise
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    @property
+    def statistics(self) -> dict:
+        return {
+            'frames_dispatched': self.frames_dispatched,
+            'frames_dropped': self.frames_dropped,
+            'frames_skipped': self.frames_skipped,
+            'results_missing': self.results_missing,
+            'results_late': self.results_late
+        }
+
+    def _start_workers(self):
+        # spawn works the same on Windows and Linux and does not inherit zmq sockets
+        context = multiprocessing.get_context('spawn')
+        # every worker gets its own share of the cpus, workers do not compete for the same cores
+        cpu_sets = split_cpus(self.worker_resources.get('cpu_affinity'), self.num_workers)
+        for cpus in cpu_sets:
+            resources = dict(self.worker_resources, cpu_affinity=cpus)
+            worker = context.Process(target=run_worker, daemon=True,
+                                     args=(self.work_address, self.collect_address, self.algorithm_class,
+                                           self.algorithm_kwargs, self.max_batch_size, self.max_batch_wait,
+                                           self.node_kwargs, resources, self.name))
+            worker.start()
+            self._workers.append(worker)
+
+    def _dispatch(self, frames: list):
+        sequence = CameraMessage.deserialize(frames[1].bytes).sequence
+        if sequence % self.frame_step:
+            self.frames_skipped += 1
+            return
+        if len(self._dispatched) >= self.max_in_flight:
+            # every worker is busy with a batch and has the next one queued
+            self.frames_dropped += 1
+            return
+        try:
+            # forward the received frames as they are, without copying the image
+            self._work.send_multipart(frames, copy=False, flags=zmq.NOBLOCK)
+        except zmq.Again:
+            # every worker is busy and has its queue full, a stale frame is worth less than bounded latency
+            self.frames_dropped += 1
+            return
+        self._dispatched.append((sequence, time.monotonic()))
+        self.frames_dispatched += 1
+
+    def _collect(self, frames: list):
+        topic = frames[0]
+        if topic != self.result_topic:
+            # log messages of the workers
+            self.publisher.publish_frames(topic, frames[1:])
+            return
+        sequence = MessageProcessingResult.deserialize(frames[1]).sequence
+        if sequence <= self._last_released:
+            # the result slot was already given up
+            self.results_late += 1
+            return
+        self._pending_results[sequence] = frames
+
+    def _publish_in_order(self):
+        now = time.monotonic()
+        while self._dispatched:
+            sequence, dispatch_time = self._dispatched[0]
+            if sequence in self._pending_results:
+                frames = self._pending_results.pop(sequence)
+                self.publisher.publish_frames(frames[0], frames[1:])
+            elif now - dispatch_time > self.reorder_timeout:
+                # the worker failed or dropped this frame, do not hold back the following results
+                self.results_missing += 1
+            else:
+                break
+            self._dispatched.popleft()
+            self._last_released = sequence
@@ -1,28 +1,211 @@
-# todo: All messages should be handled by a class
+# All messages sent between nodes are handled by these classes
+#
+# Wire format of image messages, one ZeroMQ frame each:
+#   topic    bytes
+#   header   utf-8 json with dtype, shape, strides, time_stamp, sequence, camera_info ...
+#   image    raw ndarray buffer, sent with copy=False and rebuilt with np.frombuffer on the receiver,
+#            or the compressed frame when the header has an 'encoding' entry, see Node/FrameEncoding.py
+# Frames that are only referenced from a shared memory ring buffer are sent without the image frame.
+# Frame sets of several cameras send one json header for all cameras followed by one image frame per camera.
+
+from Node.FrameEncoding import FrameEncoding, decode_image
+import json
+import pickle
+import numpy as np
+
 
 class ImageMessage():
     def __init__(self, msg: dict):
+        """Message carrying one image
+
+        Args:
+            msg (dict): 'image', 'time_stamp' and 'sequence' plus any json serializable metadata
+        """
         self._message = msg
 
     @property
     def content(self):
         return self._message
 
+    @property
+    def image(self):
+        return self._message.get('image')
+
+    @property
+    def timestamp(self):
+        return self._message.get('time_stamp')
+
+    @property
+    def sequence(self):
+        return self._message.get('sequence', 0)
+
+    @property
+    def trace(self) -> dict:
+        # stage name -> time.perf_counter_ns(), see Logger/Metrics.py
+        return self._message.setdefault('trace', {})
+
+    def serialize(self, encoding: FrameEncoding = None) -> list:
+        """Split the message into a small json header frame and the raw image buffer
+
+        Args:
+            encoding (FrameEncoding, optional): compress the image, decoded again by deserialize. Defaults to None, raw.
+
+        Returns:
+            list: frames to be sent with send_multipart(copy=False)
+        """
+        header, image = self._split(encoding)
+        if image is None:
+            return [json.dumps(header).encode()]
+        return [json.dumps(header).encode(), image]
 
-class CameraMessage():
+    def _split(self, encoding: FrameEncoding = None) -> tuple:
+        # (json serializable header dict, contiguous or encoded image or None)
+        header = {key: value for key, value in self._message.items() if key != 'image'}
+        image = self._message.get('image')
+        if image is None:
+            return header, None
+
+        # zmq sends the array memory directly, only a non contiguous array needs a copy here
+        image = np.ascontiguousarray(image)
+        if encoding is not None and not encoding.is_raw:
+            data, header['encoding'] = encoding.encode(image)
+            return header, data
+        header['dtype'] = image.dtype.str
+        header['shape'] = image.shape
+        header['strides'] = image.strides
+        return header, image
+
+    @classmethod
+    def deserialize(cls, header: bytes, *buffers) -> "ImageMessage":
+        """Rebuild a message from received frames, the image is a read-only view onto the received buffer
+
+        Args:
+            header (bytes): json header frame
+            buffers: received image buffer, missing for frames referenced by ring buffer sequence
+
+        Returns:
+            ImageMessage: decoded message
+        """
+        return cls._join(json.loads(header), buffers[0] if buffers else None)
+
+    @classmethod
+    def _join(cls, msg: dict, buffer=None) -> "ImageMessage":
+        # inverse of _split
+        msg['image'] = None
+        if buffer is not None and 'encoding' in msg:
+            msg['image'] = decode_image(buffer, msg.pop('encoding'))
+        elif buffer is not None:
+            dtype = np.dtype(msg.pop('dtype'))
+            shape = tuple(msg.pop('shape'))
+            strides = tuple(msg.pop('strides'))
+            flat = np.frombuffer(buffer, dtype=dtype)
+            msg['image'] = np.lib.stride_tricks.as_strided(flat, shape=shape, strides=strides, writeable=False)
+        return cls(msg)
+
+
+class CameraMessage(ImageMessage):
+    """Frame published by a camera node, header additionally carries 'camera_info'"""
+
+    @property
+    def camera_info(self):
+        return self._message.get('camera_info')
+
+
+class FrameSetMessage():
     def __init__(self, msg: dict):
+        """Frames of several cameras taken at the same time, published by MultiCameraNode
+
+        Args:
+            msg (dict): 'frames' dict of camera name -> CameraMessage, 'time_stamp' and 'sequence' of the set,
+                plus any json serializable metadata, eg. per camera statistics
+        """
         self._message = msg
 
     @property
     def content(self):
         return self._message
 
+    @property
+    def frames(self) -> dict:
+        return self._message.get('frames', {})
+
+    @property
+    def timestamp(self):
+        return self._message.get('time_stamp')
+
+    @property
+    def sequence(self):
+        return self._message.get('sequence', 0)
+
+    @property
+    def trace(self) -> dict:
+        return self._message.setdefault('trace', {})
+
+    def serialize(self, encoding: FrameEncoding = None) -> list:
+        """One json header frame describing all cameras, followed by the image buffers of the cameras that sent pixels
+
+        Args:
+            encoding (FrameEncoding, optional): compression of the images, see ImageMessage.serialize. Defaults to None.
+
+        Returns:
+            list: frames to be sent with send_multipart(copy=False)
+        """
+        header = {key: value for key, value in self._message.items() if key != 'frames'}
+        header['frames'] = {}
+        images = []
+        for name, frame in self.frames.items():
+            frame_header, image = frame._split(encoding)
+            # index of the image buffer of this camera, frames only in a ring buffer have none
+            frame_header['buffer'] = None if image is None else len(images)
+            if image is not None:
+                images.append(image)
+            header['frames'][name] = frame_header
+        return [json.dumps(header).encode()] + images
+
+    @classmethod
+    def deserialize(cls, header: bytes, *buffers) -> "FrameSetMessage":
+        msg = json.loads(header)
+        frames = {}
+        for name, frame_header in msg['frames'].items():
+            index = frame_header.pop('buffer')
+            frames[name] = CameraMessage._join(frame_header, None if index is None else buffers[index])
+        msg['frames'] = frames
+        return cls(msg)
+
 
 class MessageProcessingResult():
     def __init__(self, msg: dict):
+        """Result of an image processing algorithm, refers to the processed frame by its sequence number
+
+        Args:
+            msg (dict): 'sequence', 'time_stamp', 'result' and the 'trace' of the processed frame
+        """
         self._message = msg
-        pass
-    
+
     @property
     def content(self):
         return self._message
+
+    @property
+    def result(self):
+        return self._message.get('result')
+
+    @property
+    def sequence(self):
+        return self._message.get('sequence', 0)
+
+    @property
+    def timestamp(self):
+        return self._message.get('time_stamp')
+
+    @property
+    def trace(self) -> dict:
+        return self._message.setdefault('trace', {})
+
+    def serialize(self) -> list:
+        # results are small (booleans, detection boxes), no pixels are re-sent
+        return [pickle.dumps(self._message)]
+
+    @classmethod
+    def deserialize(cls, message: bytes) -> "MessageProcessingResult":
+        return cls(pickle.loads(message))
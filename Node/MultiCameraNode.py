@@ -0,0 +1,200 @@
+from Node.AbstractNode import Node, Topics, ZeroMQPublisher
+from Node.Message import CameraMessage, FrameSetMessage
+from Logger.Metrics import trace_now
+from collections import deque
+import functools
+import threading
+import time
+
+
+class MultiCameraNode(Node):
+    def __init__(self, address, cameras: dict, ring_buffers: dict, sync_tolerance=0.01, reference=None,
+                 max_wait=0.1, require_all=True, publish_image=True, send_hwm=None, topic=Topics['IMAGE_SET'],
+                 encoding=None):
+        """Node streaming several cameras at once and publishing their frames as synchronized sets,
+        eg. the RGB and TOF3D frame of the same brick
+
+        Every frame of the reference camera opens a set, the frame of every other camera closest in time is added
+        if it lies within sync_tolerance. Frames of the other cameras that match no reference frame are dropped.
+
+        Args:
+            address (str or BrokerEndpoints): url the frame sets are published on, see Node
+            cameras (dict): camera name -> Camera, every camera streams in its own thread
+            ring_buffers (dict): camera name -> RingBuffer holding the latest frames of that camera
+            sync_tolerance (float, optional): maximum capture time difference in seconds between the frames of a set.
+                Defaults to 0.01.
+            reference (str, optional): camera whose frames open the sets, usually the slowest one.
+                Defaults to None, the first camera.
+            max_wait (float, optional): seconds a set waits for the frames of slower cameras. Defaults to 0.1.
+            require_all (bool, optional): drop sets missing a camera instead of publishing them incomplete.
+                Defaults to True.
+            publish_image (bool, optional): send the pixels with every set, see CameraNode. Defaults to True.
+            send_hwm (int, optional): frame sets queued per subscriber, see CameraNode. Defaults to None.
+            topic (bytes, optional): topic of the frame sets. Defaults to Topics['IMAGE_SET'].
+            encoding (str, optional): compression of the frames of every set, eg. 'lz4', see Node/FrameEncoding.py.
+                Defaults to None, raw frames.
+        """
+        if set(cameras) != set(ring_buffers):
+            raise ValueError("Every camera needs exactly one ring buffer.")
+        super().__init__(address, publisher=ZeroMQPublisher(address, send_hwm, {topic: encoding} if encoding else None))
+        self.cameras = cameras
+        self.ring_buffers = ring_buffers
+        self.sync_tolerance = sync_tolerance
+        self.reference = reference if reference is not None else next(iter(cameras))
+        self.max_wait = max_wait
+        self.require_all = require_all
+        self.publish_image = publish_image
+        self.topic = topic
+
+        self._new_frame = threading.Condition()
+        self._running = False
+        # (sequence, timestamp) of the frames not grouped yet, older frames are overwritten in the ring buffer anyway
+        self._pending = {name: deque(maxlen=ring_buffers[name].size) for name in cameras}
+        self._sequence = 0
+        self.sets_published = 0
+        self.sets_incomplete = 0
+        self._camera_statistics = {name: {'frames': 0, 'fps': 0.0, 'unmatched': 0, 'dropped': 0} for name in cameras}
+        self._last_frame_time = {name: None for name in cameras}
+
+    def run(self):
+        self._running = True
+        for name, camera in self.cameras.items():
+            camera.set_new_frame_callback(functools.partial(self._on_new_frame, name))
+            camera.start_streaming()
+        try:
+            while self._running:
+                # woken by every new frame, the timeout also closes sets whose slower cameras never deliver
+                with self._new_frame:
+                    self._new_frame.wait(timeout=self.max_wait)
+                    sets = self._group_pending_frames()
+                # published without the lock, the camera threads keep adding frames meanwhile
+                for timestamp, members in sets:
+                    self._publish_set(timestamp, members)
+
+        except Exception as e:
+            self.log.exception("Exception occurred in MultiCameraNode run loop")
+            self.log.flush()
+            raise
+        finally:
+            for camera in self.cameras.values():
+                camera.stop_streaming()
+
+    def stop(self):
+        self._running = False
+        with self._new_frame:
+            self._new_frame.notify_all()
+
+    @property
+    def statistics(self) -> dict:
+        statistics = {'sets_published': self.sets_published, 'sets_incomplete': self.sets_incomplete,
+                      **self.publisher.statistics}
+        for name, camera_statistics in self._camera_statistics.items():
+            for key, value in camera_statistics.items():
+                statistics[f"{name}_{key}"] = value
+            for key, value in self.cameras[name].frame_pool.statistics.items():
+                statistics[f"{name}_{key}"] = value
+        return statistics
+
+    def _on_new_frame(self, name: str, frame):
+        # called from the streaming thread of each camera
+        ring_buffer = self.ring_buffers[name]
+        sequence = ring_buffer.add(frame)
+        now = time.time()
+        timestamp = ring_buffer.get_timestamp(sequence)
+        # the pending frames are shared by all camera threads and the run thread, they are only used under the lock
+        with self._new_frame:
+            statistics = self._camera_statistics[name]
+            statistics['frames'] += 1
+            last = self._last_frame_time[name]
+            if last is not None and now > last:
+                # exponential moving average over roughly the last ten frames
+                statistics['fps'] += 0.1 * (1.0 / (now - last) - statistics['fps'])
+            self._last_frame_time[name] = now
+
+            self._pending[name].append((sequence, timestamp))
+            self._new_frame.notify()
+
+    def _group_pending_frames(self) -> list:
+        # called with the _new_frame lock held, returns the (timestamp, members) of the complete sets
+        sets = []
+        reference = self._pending[self.reference]
+        while reference:
+            sequence, timestamp = reference[0]
+            members = {self.reference: sequence}
+            for name, pending in self._pending.items():
+                if name == self.reference:
+                    continue
+                match = self._match(name, pending, timestamp)
+                if match is None and self._may_still_arrive(name, timestamp):
+                    # wait for the slower camera, later reference frames are not grouped before this one
+                    return sets
+                if match is not None:
+                    members[name] = match
+            reference.popleft()
+            sets.append((timestamp, members))
+        return sets
+
+    def _match(self, name: str, pending: deque, timestamp: float):
+        # frames too old for this reference frame are too old for every later one as well
+        while pending and pending[0][1] < timestamp - self.sync_tolerance:
+            pending.popleft()
+            self._camera_statistics[name]['unmatched'] += 1
+        best = None
+        for index, (sequence, frame_timestamp) in enumerate(pending):
+            if frame_timestamp > timestamp + self.sync_tolerance:
+                break
+            if best is None or abs(frame_timestamp - timestamp) < abs(pending[best][1] - timestamp):
+                best = index
+        if best is None:
+            return None
+        # frames before the chosen one can not be closer to a later reference frame
+        for _ in range(best):
+            pending.popleft()
+            self._camera_statistics[name]['unmatched'] += 1
+        return pending.popleft()[0]
+
+    def _may_still_arrive(self, name: str, timestamp: float) -> bool:
+        last = self._last_frame_time[name]
+        if last is not None and last > timestamp + self.sync_tolerance:
+            # the camera already delivered frames after the tolerance window
+            return False
+        return time.time() - timestamp < self.max_wait
+
+    def _publish_set(self, timestamp: float, members: dict):
+        frames = {}
+        for name, sequence in members.items():
+            ring_buffer = self.ring_buffers[name]
+            image = ring_buffer.get_by_sequence(sequence)
+            if image is not None and self.publish_image:
+                # sent without copying, see CameraNode, a view of the slot would change once the camera laps it
+                image = image.copy()
+            if image is None or ring_buffer.is_overwritten(sequence):
+                # the camera lapped the ring buffer before the set was complete
+                self._camera_statistics[name]['dropped'] += 1
+                continue
+            frames[name] = CameraMessage({
+                'camera_info': f"Camera {self.cameras[name].cameratype}",
+                'time_stamp': ring_buffer.get_timestamp(sequence),
+                'sequence': sequence,
+                'ring_buffer': ring_buffer.name,
+                'image': image if self.publish_image else None
+            })
+
+        if len(frames) < len(self.cameras):
+            self.sets_incomplete += 1
+            if self.require_all or not frames:
+                return
+
+        self._sequence += 1
+        message = FrameSetMessage({
+            'frames': frames,
+            'time_stamp': timestamp,
+            'sequence': self._sequence,
+            'trace': {'camera': trace_now()},
+            # per camera frame rate and drop counters, consumers can tell a missing camera from a slow one
+            'cameras': {name: dict(statistics) for name, statistics in self._camera_statistics.items()}
+        })
+        self.publisher.publish_message(self.topic, message)
+        self.sets_published += 1
+        self.log.debug("Published frame set %d of %s at %s", self._sequence, sorted(frames), timestamp,
+                       sequence=self._sequence)
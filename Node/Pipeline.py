@@ -0,0 +1,271 @@
+"""
+Declarative pipeline graph, started from a json (or yaml, with PyYAML installed) file
+
+    python main.py --config pipeline.json
+
+Every node runs in its own process and is pinned to the cpus given in its resources, so torch, OpenCV and the node
+threads of different nodes do not compete for the same cores. All nodes talk through one Broker run by the launcher.
+
+    {
+      "broker": {"frontend": "tcp://127.0.0.1:5555", "backend": "tcp://127.0.0.1:5556", "send_hwm": 8},
+      "worker_ports_from": 5570,
+      "metrics_dir": "metrics",
+      "nodes": [
+        {"name": "camera", "type": "CameraNode",
+         "camera": "SyntheticCamera", "camera_args": {"resolution": [1920, 1080]},
+         "ring_buffer": {"size": 16, "frame_shape": [1080, 1920, 3], "dtype": "uint8"},
+         "topic": "sensor_data.image_rgb", "args": {"send_hwm": 4, "derived_streams": ["thumbnail", "gray"]},
+         "resources": {"cpu_affinity": [0]}},
+        {"name": "station", "type": "MultiCameraNode",
+         "cameras": {"rgb": {"camera": "SyntheticCamera"},
+                     "depth": {"camera": "Camera", "camera_args": {"cameratype": "TOF3D"}}},
+         "args": {"sync_tolerance": 0.01, "reference": "depth"}},
+        {"name": "sorting", "type": "ImageProcessingNode", "replicas": 2,
+         "algorithm": "LegoBrickSorting",
+         "algorithm_args": {"warmup_shape": [256, 256, 3], "warmup_batch_size": 4, "input_min_size": 256},
+         "candidate_detector": "LegoBrickRecognition", "candidate_detector_args": {"downscale": 4},
+         "input_topic": "sensor_data.image_rgb", "result_topic": "image_recongition_result",
+         "args": {"max_batch_size": 4, "max_batch_wait": 0.05, "queue_size": 4},
+         "resources": {"cpu_affinity": [4, 5, 6, 7], "torch_threads": 2, "opencv_threads": 1},
+         "log_level": "INFO"},
+        {"name": "recorder", "type": "RecorderNode", "path": "recordings/belt", "topic": "sensor_data.image_rgb"},
+        {"name": "qos", "type": "QoSController",
+         "args": {"deadline": 0.5, "queue_limit": 2,
+                  "levels": [{"sorting": {"frame_step": 2}},
+                             {"sorting": {"frame_step": 3, "max_batch_size": 1}, "camera": {"camera.framerate": 15}}]}},
+        {"name": "logging", "type": "LoggingNode", "args": {"log_path": "lego_pipeline.log"}}
+      ]
+    }
+
+worker_ports_from is the first of the work/collect ports of replica pools, metrics_dir (optional) receives the
+metrics json file of every node. Class names are either one of the short names below or a dotted path,
+eg. "Device.SyntheticCamera.SyntheticCamera". With a candidate_detector an ImageProcessingNode runs as a cascade,
+the algorithm only sees crops around the candidates, see ImageProcessing/Cascade.py. A recording is replayed with
+"camera": "ReplayCamera", "camera_args": {"path": "recordings/belt"}. Nodes with replicas > 1 run as an
+ImageProcessingPool, the cpus of the node are split between its workers.
+A QoSController holds a latency deadline by changing settings of the named nodes at runtime, frame_step of the
+processing nodes, the camera framerate, batch sizes or algorithm attributes, see Node/QoSController.py. With a
+controller in the pipeline every node publishes its metrics.
+Frames for nodes on other machines are compressed per topic with the "encodings" argument of a CameraNode, eg.
+"args": {"encodings": {"sensor_data.image_rgb": "jpeg:90"}}, see Node/FrameEncoding.py.
+"""
+
+from Node.AbstractNode import Broker, BrokerEndpoints
+from Node.Resources import apply_resources
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+
+NODE_TYPES = ('CameraNode', 'MultiCameraNode', 'ImageProcessingNode', 'RecorderNode', 'LoggingNode', 'QoSController')
+
+# short names of the classes a pipeline file can refer to
+CLASS_NAMES = {
+    'Camera': 'Device.Camera.Camera',
+    'SyntheticCamera': 'Device.SyntheticCamera.SyntheticCamera',
+    'ReplayCamera': 'Device.ReplayCamera.ReplayCamera',
+    'LegoBrickRecognition': 'ImageProcessing.LegoRecognition.LegoBrickRecognition',
+    'LegoBrickSorting': 'ImageProcessing.LegoSorting.LegoBrickSorting'
+}
+
+RESOURCE_KEYS = ('cpu_affinity', 'torch_threads', 'torch_interop_threads', 'opencv_threads')
+
+
+def load_config(path: str) -> dict:
+    with open(path) as file:
+        if path.endswith(('.yaml', '.yml')):
+            # optional dependency, json pipeline files need nothing beyond the standard library
+            import yaml
+            config = yaml.safe_load(file)
+        else:
+            config = json.load(file)
+    validate_config(config)
+    return config
+
+
+def validate_config(config: dict) -> None:
+    # fail before any process is started, with the name of the offending node
+    if not config.get('nodes'):
+        raise ValueError("Pipeline config has no nodes.")
+    names = set()
+    for spec in config['nodes']:
+        name = spec.get('name')
+        if not name or name in names:
+            raise ValueError(f"Every node needs a unique name, got {name!r}.")
+        names.add(name)
+        if spec.get('type') not in NODE_TYPES:
+            raise ValueError(f"Node {name}: type must be one of {NODE_TYPES}, got {spec.get('type')!r}.")
+        if spec['type'] == 'CameraNode' and 'camera' not in spec:
+            raise ValueError(f"Node {name}: a CameraNode needs a camera.")
+        if spec['type'] == 'MultiCameraNode' and not all('camera' in camera for camera in spec.get('cameras', {}).values()):
+            raise ValueError(f"Node {name}: a MultiCameraNode needs cameras, each with a camera class.")
+        if spec['type'] == 'RecorderNode' and 'path' not in spec:
+            raise ValueError(f"Node {name}: a RecorderNode needs a path.")
+        if spec['type'] == 'ImageProcessingNode' and 'algorithm' not in spec:
+            raise ValueError(f"Node {name}: an ImageProcessingNode needs an algorithm.")
+        if spec.get('replicas', 1) < 1 or (spec.get('replicas', 1) > 1 and spec['type'] != 'ImageProcessingNode'):
+            raise ValueError(f"Node {name}: only ImageProcessingNode supports replicas > 1.")
+        unknown = set(spec.get('resources', {})) - set(RESOURCE_KEYS)
+        if unknown:
+            raise ValueError(f"Node {name}: unknown resources {sorted(unknown)}, choose from {RESOURCE_KEYS}.")
+
+
+def resolve_class(name: str) -> type:
+    module_name, _, class_name = CLASS_NAMES.get(name, name).rpartition('.')
+    if not module_name:
+        raise ValueError(f"Unknown class {name}, use one of {sorted(CLASS_NAMES)} or a dotted path.")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _topics(spec: dict, keys: tuple) -> dict:
+    # topics are written as strings in the pipeline file
+    return {key: spec[key].encode() for key in keys if key in spec}
+
+
+def _create_camera(spec: dict) -> tuple:
+    # camera and ring buffer of a camera entry ("camera", "camera_args", "ring_buffer")
+    from Buffer.RingBuffer import RingBuffer
+    from Device.Camera import CameraType
+    import numpy as np
+
+    camera_args = dict(spec.get('camera_args', {}))
+    if 'cameratype' in camera_args:
+        camera_args['cameratype'] = CameraType[camera_args['cameratype']]
+    if 'resolution' in camera_args:
+        camera_args['resolution'] = tuple(camera_args['resolution'])
+    camera = resolve_class(spec['camera'])(**camera_args)
+
+    buffer_spec = spec.get('ring_buffer', {})
+    buffer = RingBuffer(size=buffer_spec.get('size', 16),
+                        frame_shape=tuple(buffer_spec.get('frame_shape', camera.frame_shape)),
+                        dtype=np.dtype(buffer_spec.get('dtype', camera.dtype)))
+    return camera, buffer
+
+
+def build_node(spec: dict, endpoints: BrokerEndpoints, worker_addresses=None):
+    """Create the node of one pipeline file entry
+
+    Args:
+        spec (dict): node entry of the pipeline file
+        endpoints (BrokerEndpoints): broker the node connects to
+        worker_addresses (tuple, optional): (work, collect) urls, required for replicas > 1
+
+    Returns:
+        the node, ready to run
+    """
+    node_type = spec['type']
+    args = dict(spec.get('args', {}))
+    if 'candidate_detector' in spec:
+        # cascade mode of an ImageProcessingNode, also handed to the workers of a pool
+        args['candidate_detector'] = resolve_class(spec['candidate_detector'])(**spec.get('candidate_detector_args', {}))
+
+    if node_type == 'LoggingNode':
+        from Node.SystemLogingNode import LoggingNode
+        return LoggingNode(endpoints, **args)
+
+    if node_type == 'CameraNode':
+        from Node.CameraNode import CameraNode
+
+        camera, buffer = _create_camera(spec)
+        node = CameraNode(endpoints, camera, buffer, **_topics(spec, ('topic',)), **args)
+    elif node_type == 'MultiCameraNode':
+        from Node.MultiCameraNode import MultiCameraNode
+
+        created = {name: _create_camera(camera_spec) for name, camera_spec in spec['cameras'].items()}
+        node = MultiCameraNode(endpoints, {name: camera for name, (camera, _) in created.items()},
+                               {name: buffer for name, (_, buffer) in created.items()}, **_topics(spec, ('topic',)), **args)
+    elif node_type == 'RecorderNode':
+        from Node.RecorderNode import RecorderNode
+        node = RecorderNode(endpoints, spec['path'], **_topics(spec, ('topic',)), **args)
+    elif node_type == 'QoSController':
+        from Node.QoSController import QoSController
+        node = QoSController(endpoints, **_topics(spec, ('result_topic',)), **args)
+    else:
+        algorithm_class = resolve_class(spec['algorithm'])
+        algorithm_args = spec.get('algorithm_args', {})
+        topics = _topics(spec, ('input_topic', 'result_topic'))
+        replicas = spec.get('replicas', 1)
+        if replicas > 1:
+            from Node.ImageProcessingPool import ImageProcessingPool
+
+            batching = {key: args.pop(key) for key in ('max_batch_size', 'max_batch_wait') if key in args}
+            node = ImageProcessingPool(endpoints, None, *worker_addresses, algorithm_class, algorithm_args,
+                                       num_workers=replicas, node_kwargs=args,
+                                       worker_resources=spec.get('resources'), **batching, **topics)
+        else:
+            from Node.ImageProcessingNode import ImageProcessingNode
+            node = ImageProcessingNode(endpoints, algorithm_class(**algorithm_args), **topics, **args)
+
+    # the name is used in metrics, log records and the settings of a QoSController
+    node.name = spec['name']
+    if 'log_level' in spec:
+        node.log.level = logging.getLevelName(spec['log_level'])
+    return node
+
+
+def run_node(spec: dict, endpoints: BrokerEndpoints, worker_addresses=None, metrics_dir=None, controlled=False):
+    """Entry point of a node process, controlled nodes publish their metrics and follow a QoSController"""
+    # terminate() of the launcher runs the cleanup of the node, eg. a pool stops its workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if spec.get('replicas', 1) == 1:
+        # before anything is created, pools hand their resources to the workers instead
+        apply_resources(**spec.get('resources', {}))
+    node = build_node(spec, endpoints, worker_addresses)
+    if (metrics_dir is not None or controlled) and hasattr(node, 'export_metrics'):
+        node.export_metrics(os.path.join(metrics_dir, f"{spec['name']}_metrics.json") if metrics_dir else None)
+    if controlled and getattr(node, 'controllable', ()):
+        node.follow_control()
+    node.run()
+
+
+class PipelineLauncher:
+    def __init__(self, config: dict):
+        """Starts the broker and one process per node of a pipeline config, see the module docstring
+
+        Args:
+            config (dict): pipeline config, eg. from load_config
+        """
+        validate_config(config)
+        self.config = config
+        self.broker = Broker(**config.get('broker', {}))
+        self.processes = {}
+
+    def start(self):
+        self.broker.start()
+        metrics_dir = self.config.get('metrics_dir')
+        if metrics_dir is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+        # spawn works the same on Windows and Linux and does not inherit zmq sockets
+        context = multiprocessing.get_context('spawn')
+        port = self.config.get('worker_ports_from', 5570)
+        controlled = any(spec['type'] == 'QoSController' for spec in self.config['nodes'])
+        # logging nodes first, so they receive the startup messages of the others
+        for spec in sorted(self.config['nodes'], key=lambda spec: spec['type'] != 'LoggingNode'):
+            worker_addresses = None
+            if spec.get('replicas', 1) > 1:
+                worker_addresses = (f"tcp://127.0.0.1:{port}", f"tcp://127.0.0.1:{port + 1}")
+                port += 2
+            process = context.Process(target=run_node, name=spec['name'],
+                                      args=(spec, self.broker.endpoints, worker_addresses, metrics_dir, controlled))
+            process.start()
+            self.processes[spec['name']] = process
+
+    def stop(self):
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join()
+
+    def run(self):
+        # start the graph and block until all nodes have exited
+        self.start()
+        try:
+            for process in self.processes.values():
+                process.join()
+        finally:
+            self.stop()
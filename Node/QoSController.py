@@ -0,0 +1,206 @@
+"""
+Adaptive quality of service, degrades the pipeline step by step to hold a latency deadline
+
+The controller watches the end to end latency of every processing node (capture to published result) and the
+queue depth the nodes export with their metrics. While the latency percentile of a node misses the deadline, or a
+queue grows beyond queue_limit, it moves one level down, and once every node stayed well below the deadline for a
+while it moves one level up again, back to full quality at level 0.
+
+A level is a complete set of node settings, node name -> {attribute path: value}, see Node.apply_settings:
+
+    [{"sorting": {"frame_step": 2}},
+     {"sorting": {"frame_step": 2, "max_batch_size": 2}, "recognition": {"frame_step": 2}},
+     {"sorting": {"frame_step": 3, "max_batch_size": 1}, "recognition": {"frame_step": 2},
+      "camera": {"camera.framerate": 15}}]
+
+The settings of the current level are published on Topics['CONTROL'], nodes follow them with follow_control and
+restore the settings a level does not mention. Decisions are logged and exported with the node metrics.
+"""
+
+from Node.AbstractNode import Node, Topics, ZeroMQSubscriber
+from Node.Message import MessageProcessingResult
+from Logger.Metrics import trace_now
+from collections import deque
+import json
+import threading
+import time
+
+
+# levels for the node names of pipeline.json
+DEFAULT_LEVELS = (
+    {'sorting': {'frame_step': 2}},
+    {'sorting': {'frame_step': 2, 'max_batch_size': 2, 'processing_algorithm.detector.downscale': 4},
+     'recognition': {'frame_step': 2}},
+    {'sorting': {'frame_step': 3, 'max_batch_size': 1, 'processing_algorithm.detector.downscale': 4},
+     'recognition': {'frame_step': 2},
+     'camera': {'camera.framerate': 15}},
+)
+
+
+class QoSController(Node):
+    def __init__(self, address, deadline=0.5, levels=DEFAULT_LEVELS, percentile=95, window=2.0, queue_limit=None,
+                 restore_ratio=0.6, hold=3.0, restore_after=10.0, check_interval=0.5, republish_interval=5.0,
+                 result_topic=Topics['IMAGE_RECONGNITION_RESULT']):
+        """
+        Args:
+            address (str or BrokerEndpoints): see Node
+            deadline (float, optional): seconds from capture to published result the nodes must hold. Defaults to 0.5.
+            levels (list, optional): settings of the degraded levels, mildest first, see module docstring.
+                Defaults to DEFAULT_LEVELS.
+            percentile (float, optional): latency percentile compared with the deadline. Defaults to 95.
+            window (float, optional): seconds of results the percentile is taken over. Defaults to 2.0.
+            queue_limit (int, optional): exported queue_depth of a node above which the pipeline degrades as well.
+                Defaults to None, latency only.
+            restore_ratio (float, optional): a level up needs every node below deadline * restore_ratio.
+                Defaults to 0.6.
+            hold (float, optional): seconds after a change before degrading further, the nodes need time to catch
+                up. Defaults to 3.0.
+            restore_after (float, optional): seconds below the restore latency before a level up. Defaults to 10.0.
+            check_interval (float, optional): seconds between decisions. Defaults to 0.5.
+            republish_interval (float, optional): seconds between repeated publications of the current level, for
+                nodes started later. Defaults to 5.0.
+            result_topic (bytes, optional): topic of the results to watch, subscriptions match by prefix.
+                Defaults to Topics['IMAGE_RECONGNITION_RESULT'].
+        """
+        super().__init__(address)
+        self.deadline = deadline
+        self.levels = [dict(level) for level in levels]
+        self.percentile = percentile
+        self.window = window
+        self.queue_limit = queue_limit
+        self.restore_ratio = restore_ratio
+        self.hold = hold
+        self.restore_after = restore_after
+        self.check_interval = check_interval
+        self.republish_interval = republish_interval
+        self.result_topic = result_topic
+        self.level = 0
+        self.degradations = 0
+        self.restorations = 0
+        # node -> deque of (receive time, latency) of the last window seconds, node -> latest exported queue depth
+        self._latencies = {}
+        self._queue_depths = {}
+        self._lock = threading.Lock()
+        self._last_change = 0.0
+        self._calm_since = None
+        self._last_published = 0.0
+        # all nodes ever named by a level, they get empty settings (full quality) when their level is left
+        self._nodes = sorted({name for level in self.levels for name in level})
+
+    @property
+    def statistics(self) -> dict:
+        latencies = self.node_latencies()
+        return {
+            'qos_level': self.level,
+            'qos_degradations': self.degradations,
+            'qos_restorations': self.restorations,
+            'qos_worst_latency_s': max(latencies.values(), default=0.0),
+            **{f'qos_latency_{node}_s': latency for node, latency in latencies.items()}
+        }
+
+    def run(self):
+        metrics_subscriber = ZeroMQSubscriber(self.address)
+        threading.Thread(target=metrics_subscriber.subscribe, args=(self.on_metrics, Topics['METRICS']),
+                         daemon=True).start()
+        threading.Thread(target=self._control_loop, daemon=True).start()
+        try:
+            self.subscriber.subscribe(self.on_result, topic=self.result_topic)
+        except Exception as e:
+            self.log.exception("Exception occurred in QoSController run loop")
+
+    def on_result(self, topic: bytes, message: bytes):
+        try:
+            received = trace_now()
+            result = MessageProcessingResult.deserialize(message)
+            # camera and controller share the perf_counter clock on one machine, the wall clock is the fallback
+            captured = result.trace.get('camera')
+            latency = (received - captured) / 1e9 if captured is not None else time.time() - result.timestamp
+            node = result.content.get('node', topic.decode())
+            with self._lock:
+                self._latencies.setdefault(node, deque()).append((time.monotonic(), latency))
+            self.metrics.record(f'latency_{node}', latency)
+        except Exception as e:
+            self.log.exception("Exception occurred in QoSController result callback")
+
+    def on_metrics(self, topic: bytes, message: bytes):
+        try:
+            snapshot = json.loads(message)
+            if 'queue_depth' in snapshot.get('counters', {}):
+                self._queue_depths[snapshot['node']] = snapshot['counters']['queue_depth']
+        except Exception as e:
+            self.log.exception("Exception occurred in QoSController metrics callback")
+
+    def node_latencies(self) -> dict:
+        """
+        Returns:
+            dict: node -> latency percentile in seconds over the last window, nodes without recent results are left out
+        """
+        oldest = time.monotonic() - self.window
+        latencies = {}
+        with self._lock:
+            for node, samples in self._latencies.items():
+                while samples and samples[0][0] < oldest:
+                    samples.popleft()
+                if samples:
+                    values = sorted(latency for _, latency in samples)
+                    latencies[node] = values[min(int(len(values) * self.percentile / 100), len(values) - 1)]
+        return latencies
+
+    def evaluate(self, now=None) -> int:
+        """Decide the level for the current latencies and queue depths, publish it when it changed
+
+        Returns:
+            int: the new level
+        """
+        now = time.monotonic() if now is None else now
+        latencies = self.node_latencies()
+        late = {node: latency for node, latency in latencies.items() if latency > self.deadline}
+        # only queues of nodes the levels can relieve, eg. not of a RecorderNode
+        queued = {node: depth for node, depth in self._queue_depths.items()
+                  if self.queue_limit is not None and node in self._nodes and depth > self.queue_limit}
+
+        if late or queued:
+            self._calm_since = None
+            if self.level < len(self.levels) and now - self._last_change >= self.hold:
+                self.degradations += 1
+                self._change_level(self.level + 1, now, f"late {late}" if late else f"queued {queued}")
+        elif latencies and max(latencies.values()) <= self.deadline * self.restore_ratio:
+            if self._calm_since is None:
+                self._calm_since = now
+            if self.level > 0 and now - self._calm_since >= self.restore_after:
+                self.restorations += 1
+                # every further level up waits the full restore_after again
+                self._calm_since = now
+                self._change_level(self.level - 1, now, f"latency {max(latencies.values()):.3f}s")
+        else:
+            # between the restore latency and the deadline, or no results at all, the level is kept
+            self._calm_since = None
+
+        if now - self._last_published >= self.republish_interval:
+            self.publish_level(now)
+        return self.level
+
+    def publish_level(self, now=None):
+        settings = self.levels[self.level - 1] if self.level > 0 else {}
+        message = {'level': self.level, 'nodes': {node: settings.get(node, {}) for node in self._nodes}}
+        self.publisher.publish(Topics['CONTROL'], json.dumps(message).encode())
+        self._last_published = time.monotonic() if now is None else now
+
+    def _change_level(self, level: int, now: float, reason: str):
+        previous, self.level = self.level, level
+        self._last_change = now
+        self.metrics.set_counter('qos_level', level)
+        if level > previous:
+            self.log.warning("QoS level %d -> %d, deadline %.3fs missed: %s", previous, level, self.deadline, reason)
+        else:
+            self.log.info("QoS level %d -> %d, %s below %.3fs", previous, level, reason,
+                          self.deadline * self.restore_ratio)
+        self.publish_level(now)
+
+    def _control_loop(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.evaluate()
+            except Exception as e:
+                self.log.exception("Exception occurred in QoSController control loop")
@@ -0,0 +1,131 @@
+from Node.AbstractNode import Node, Topics, ZeroMQSubscriber
+from Node.Message import CameraMessage
+from Buffer.RingBuffer import RingBuffer
+from Buffer.DropOldestQueue import DropOldestQueue
+from Buffer.FrameRecording import FrameRecordingWriter
+import numpy as np
+import queue
+import threading
+import time
+
+
+class RecorderNode(Node):
+    def __init__(self, address, path: str, frames_per_chunk=256, flush_interval=1.0, queue_size=64,
+                 receive_hwm=None, topic=Topics['IMAGE_RGB']):
+        """Node appending every received frame to an on disk recording, replayed later by Device.ReplayCamera
+
+        Args:
+            address (str or BrokerEndpoints): url the frames are subscribed on, see Node
+            path (str): directory of the recording, see Buffer/FrameRecording.py. Frames of another shape or dtype,
+                eg. after a resolution change, start a new recording in path_1, path_2 ...
+            frames_per_chunk (int, optional): frames per chunk file. Defaults to 256.
+            flush_interval (float, optional): seconds between flushes of the recording to disk. Defaults to 1.0.
+            queue_size (int, optional): frames waiting to be written, when the disk can not keep up the oldest frame
+                is dropped and counted. Defaults to 64.
+            receive_hwm (int, optional): zmq receive high water mark. Defaults to None.
+            topic (bytes, optional): topic of the frames to record. Defaults to Topics['IMAGE_RGB'].
+        """
+        super().__init__(address, subscriber=ZeroMQSubscriber(address, receive_hwm))
+        self.path = path
+        self.frames_per_chunk = frames_per_chunk
+        self.flush_interval = flush_interval
+        self.topic = topic
+        self.writer = None
+        self.recordings = 0
+        self.frames_recorded = 0
+        self.frames_missed = 0
+        self._ring_buffers = {}
+        # frames handed from the receiving thread to the writing thread, disk stalls never block the receiving thread
+        self._pending = DropOldestQueue(queue_size)
+        self._writing_thread = None
+
+    def run(self):
+        self._writing_thread = threading.Thread(target=self._write_frames, daemon=True)
+        self._writing_thread.start()
+        try:
+            self.subscriber.subscribe(self.callback, topic=self.topic)
+        except Exception as e:
+            self.log.exception("Exception occurred in RecorderNode run loop")
+        finally:
+            self.stop()
+
+    def stop(self):
+        # the writing thread closes the recording once every queued frame is written
+        self._pending.put(None)
+        if self._writing_thread is not None and self._writing_thread is not threading.current_thread():
+            self._writing_thread.join()
+
+    @property
+    def statistics(self) -> dict:
+        return {
+            'frames_recorded': self.frames_recorded,
+            'recordings': self.recordings,
+            'frames_missed': self.frames_missed,
+            'frames_dropped': self._pending.dropped,
+            'queue_depth': self._pending.qsize()
+        }
+
+    def callback(self, topic: bytes, header: bytes, *buffers):
+        try:
+            message = CameraMessage.deserialize(header, *buffers)
+            image = message.image
+            if image is None:
+                # frames in a ring buffer are overwritten by the camera, they are copied before queueing
+                image = self._get_ring_buffer_image(message)
+                if image is None:
+                    self.frames_missed += 1
+                    self.log.warning("Frame %d was overwritten in ring buffer before recording", message.sequence,
+                                     sequence=message.sequence)
+                    return
+            self._pending.put((message, image))
+
+        except Exception as e:
+            self.log.exception("Exception occurred in RecorderNode callback")
+
+    def _get_ring_buffer_image(self, message: CameraMessage) -> np.ndarray:
+        name = message.content['ring_buffer']
+        if name not in self._ring_buffers:
+            self._ring_buffers[name] = RingBuffer.attach(name)
+        image = self._ring_buffers[name].get_by_sequence(message.sequence)
+        return np.array(image) if image is not None else None
+
+    def _write_frames(self):
+        last_flush = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self._pending.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    break
+                if item:
+                    message, image = item
+                    if self.writer is not None and (image.shape != self.writer.frame_shape
+                                                    or image.dtype != self.writer.dtype):
+                        # a recording holds frames of one shape only
+                        self._close_writer()
+                    if self.writer is None:
+                        # the recording is created with the first frame, it knows the camera then
+                        path = f"{self.path}_{self.recordings}" if self.recordings else self.path
+                        self.writer = FrameRecordingWriter(path, self.frames_per_chunk, message.camera_info)
+                        self.recordings += 1
+                        self.log.info("Recording %s with frames of shape %s to %s", message.camera_info, image.shape,
+                                      path)
+                    self.writer.append(image, message.sequence, message.timestamp)
+                    self.frames_recorded += 1
+                if self.writer is not None and time.monotonic() - last_flush >= self.flush_interval:
+                    self.writer.flush()
+                    last_flush = time.monotonic()
+
+        except Exception as e:
+            self.log.exception("Exception occurred in RecorderNode writing thread")
+        finally:
+            self._close_writer()
+            self.log.flush()
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.log.info("Recorded %d frames to %s", self.writer.frames, self.writer.path)
+            self.writer = None
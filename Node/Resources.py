@@ -0,0 +1,73 @@
+"""
+CPU partitioning of node processes
+
+Torch intra-op threads, the OpenCV thread pool and the node threads all default to using every core. With several
+nodes on one machine they oversubscribe the same cores, so each node process is pinned to its own set of cores
+and its thread pools are sized to match. Settings are applied at the start of a node process, before any frame is
+processed and before torch is imported where possible.
+"""
+
+from Logger.Logger import logger
+import os
+
+
+def apply_resources(cpu_affinity=None, torch_threads=None, torch_interop_threads=None, opencv_threads=None) -> dict:
+    """Restrict the current process, settings left at None are not changed
+
+    Args:
+        cpu_affinity (list, optional): cpu indices the process may run on, inherited by its child processes
+        torch_threads (int, optional): torch intra-op threads (torch.set_num_threads)
+        torch_interop_threads (int, optional): torch inter-op threads, only settable before torch runs any operation
+        opencv_threads (int, optional): OpenCV thread pool size, 0 runs OpenCV functions single threaded
+
+    Returns:
+        dict: the settings that were applied
+    """
+    applied = {}
+    if cpu_affinity is not None:
+        cpus = set(int(cpu) for cpu in cpu_affinity)
+        if hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(0, cpus)
+            except OSError as e:
+                raise ValueError(f"Can not pin the process to cpus {sorted(cpus)}, this machine has {os.cpu_count()}.") from e
+            applied['cpu_affinity'] = sorted(cpus)
+        else:
+            # Windows and macOS have no os.sched_setaffinity, psutil covers Windows
+            try:
+                import psutil
+                psutil.Process().cpu_affinity(sorted(cpus))
+                applied['cpu_affinity'] = sorted(cpus)
+            except (ImportError, AttributeError):
+                logger.warning("Can not pin the process to cpus %s without os.sched_setaffinity or psutil "
+                               "(pip install psutil), it runs on all cpus.", sorted(cpus))
+
+    if torch_threads is not None:
+        # read by torch and OpenMP when they are imported, covers processes that import torch later on
+        os.environ['OMP_NUM_THREADS'] = str(torch_threads)
+        os.environ['MKL_NUM_THREADS'] = str(torch_threads)
+        import torch
+        torch.set_num_threads(torch_threads)
+        applied['torch_threads'] = torch_threads
+    if torch_interop_threads is not None:
+        import torch
+        torch.set_num_interop_threads(torch_interop_threads)
+        applied['torch_interop_threads'] = torch_interop_threads
+
+    if opencv_threads is not None:
+        import cv2
+        cv2.setNumThreads(opencv_threads)
+        applied['opencv_threads'] = opencv_threads
+    return applied
+
+
+def split_cpus(cpus: list, parts: int) -> list:
+    """Split cpus into parts disjoint sets, eg. for the workers of a pool. Every part gets all cpus if there are
+    fewer cpus than parts.
+    """
+    if cpus is None:
+        return [None] * parts
+    cpus = list(cpus)
+    if len(cpus) < parts:
+        return [cpus] * parts
+    return [cpus[index::parts] for index in range(parts)]
@@ -1,28 +1,133 @@
-from AbstractNode import ZeroMQSubscriber
+from Node.AbstractNode import Topics, ZeroMQSubscriber
+from Logger.LogRecords import decode_records
 from Logger.Logger import logger
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import logging
+import queue
+import time
 
-class LoggingNode(ZeroMQSubscriber):
-    def __init__(self, address: str):
-        super().__init__(address)
 
-        self.topic = b'log' # subscribe to all topics start with 'log'    
-    
+# levels of the plain text log topics, nodes publish batches on Topics['LOG_RECORDS'] instead
+TOPIC_LEVELS = {
+    Topics['LOG_DEBUG']: logging.DEBUG,
+    Topics['LOG_INFO']: logging.INFO,
+    Topics['LOG_WARN']: logging.WARNING,
+    Topics['LOG_ERROR']: logging.ERROR,
+    Topics['LOG_CRITICAL']: logging.CRITICAL
+}
+
+
+class RepeatFilter(logging.Filter):
+    def __init__(self, interval=10.0):
+        """Rate limits repeated messages: a message template of a node passes at most once per interval,
+        the next record that passes tells how many were suppressed in between
+
+        Args:
+            interval (float, optional): seconds a repeated message is suppressed. Defaults to 10.0, 0 disables the filter.
+        """
+        super().__init__()
+        self.interval = interval
+        # (node, level, template) -> [time the message last passed, suppressed count]
+        self._seen = {}
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.interval <= 0:
+            return True
+        key = (record.name, record.levelno, getattr(record, 'template', record.msg))
+        seen = self._seen.get(key)
+        if seen is not None and record.created - seen[0] < self.interval:
+            seen[1] += 1
+            self.suppressed += 1
+            return False
+        if seen is not None and seen[1]:
+            record.msg = f"{record.msg} (repeated {seen[1]} times)"
+        self._seen[key] = [record.created, 0]
+        return True
+
+
+class LoggingNode:
+    def __init__(self, address, log_path='lego_pipeline.log', max_bytes=10 * 2**20, backup_count=5,
+                 level=logging.INFO, repeat_interval=10.0, console=True):
+        """Writes the log records of all nodes. Receiving only decodes records and queues them,
+        formatting and file output happen on a QueueListener thread.
+
+        Args:
+            address (str, list or BrokerEndpoints): url(s) the log messages are published on
+            log_path (str, optional): rotating log file, None for no file. Defaults to 'lego_pipeline.log'.
+            max_bytes (int, optional): size at which the log file is rotated. Defaults to 10 MB.
+            backup_count (int, optional): number of rotated files kept. Defaults to 5.
+            level (int, optional): records below this level are not written. Defaults to logging.INFO.
+            repeat_interval (float, optional): seconds a repeated message is suppressed, see RepeatFilter. Defaults to 10.0.
+            console (bool, optional): also write to the console. Defaults to True.
+        """
+        self.subscriber = ZeroMQSubscriber(address)
+        self.topic = b'log' # subscribe to all topics start with 'log'
+        self.level = level
+
+        handlers = []
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        if log_path is not None:
+            handlers.append(RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count))
+        if console:
+            handlers.append(logging.StreamHandler())
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        self._queue = queue.SimpleQueue()
+        self._listener = QueueListener(self._queue, *handlers)
+        self.repeat_filter = RepeatFilter(repeat_interval)
+        self._queue_handler = QueueHandler(self._queue)
+        self._queue_handler.addFilter(self.repeat_filter)
+
     def run(self):
+        self._listener.start()
         try:
             # Only subscribe to logging message by Topic filtering
-            self.subscriber.subscribe(self.callback, topic = b'log')
+            self.subscriber.subscribe(self.callback, topic=self.topic)
         except Exception as e:
             logger.exception(f"Exception occurred in LoggingNode run loop")
-    
-    def callback(self, topic :bytes, serialized_message: bytes):
-        self._write_to_log(topic, serialized_message)
-        
-
-    def _write_to_log(topic, msg):
-        # dummy code, replace it a function extracting log type from the topics
-        log_message_type = "INFO"
-        match log_message_type:
-            case 'INFO': 
-                logger.info(msg)
-            case 'EXCEPTION':
-                logger.exception(msg)
+        finally:
+            self._listener.stop()
+
+    def callback(self, topic: bytes, serialized_message: bytes, *buffers):
+        if topic == Topics['LOG_RECORDS']:
+            for level, created, sequence, node, template, message in decode_records(serialized_message):
+                self._write_to_log(level, node, message, created, template, sequence)
+        else:
+            # plain text message of a publisher not using LogPublisher
+            self._write_to_log(TOPIC_LEVELS.get(topic, logging.INFO), topic.decode(errors='replace'),
+                               serialized_message.decode(errors='replace'))
+
+    def _write_to_log(self, level: int, node: str, message: str, created=None, template=None, sequence=0):
+        if level < self.level:
+            return
+        record = logging.LogRecord(node, level, __file__, 0, message, None, None)
+        if created is not None:
+            # keep the time the node logged the record, not the time it arrived here
+            record.created = created
+            record.msecs = (created - int(created)) * 1000
+        record.template = template if template is not None else message
+        record.sequence = sequence
+        # the filter runs here, the handlers on the listener thread
+        self._queue_handler.handle(record)
+
+
+def testing_logging_node(address="tcp://127.0.0.1:5599"):
+    # publish a few records, including repeats, and write them to the console
+    from Node.AbstractNode import ZeroMQPublisher
+    from Logger.LogRecords import LogPublisher
+    import threading
+
+    node = LoggingNode(address, log_path=None, repeat_interval=1.0)
+    threading.Thread(target=node.run, daemon=True).start()
+    log = LogPublisher(ZeroMQPublisher(address), Topics['LOG_RECORDS'], 'testing', flush_interval=0.1)
+    time.sleep(0.5)
+    for sequence in range(100):
+        log.warning("Frame %d was dropped", sequence, sequence=sequence)
+    log.info("done")
+    time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    testing_logging_node()
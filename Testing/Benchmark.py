@@ -0,0 +1,250 @@
+"""
+Reproducible benchmarks of the pipeline stages on synthetic (or replayed) camera frames
+
+    python -m Testing.Benchmark --frames 300 --output results.json
+    python -m Testing.Benchmark --frames 300 --output new.json --baseline results.json
+    python -m Testing.Benchmark --source-dir recorded_frames --sorting-weights model.pth --sorting-batch-size 4
+
+Every stage reports throughput, latency percentiles, CPU time per frame and resident memory.
+Results are saved as json, with --baseline the relative change of every metric is printed.
+"""
+
+from Device.SyntheticCamera import SyntheticCamera
+from Node.FrameEncoding import FrameEncoding
+from Logger.Metrics import LatencyHistogram, trace_now
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def resident_memory_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        import resource
+        # peak resident memory, kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    except ImportError:
+        return None
+
+
+def measure(process_frame: callable, frames: list, num_frames: int, frames_per_call=1) -> dict:
+    """Run process_frame over num_frames frames, cycling through the given frames
+
+    Args:
+        process_frame (callable): called with a list of frames_per_call frames
+        frames (list): pre-rendered frames, rendering is not part of the measurement
+        num_frames (int): total number of frames to process
+        frames_per_call (int, optional): batch size. Defaults to 1.
+
+    Returns:
+        dict: throughput, latency summary, cpu time and memory
+    """
+    latency = LatencyHistogram()
+    memory_before = resident_memory_mb()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for index in range(0, num_frames, frames_per_call):
+        batch = [frames[(index + i) % len(frames)] for i in range(frames_per_call)]
+        started = time.perf_counter()
+        process_frame(batch)
+        latency.record(time.perf_counter() - started)
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    memory_after = resident_memory_mb()
+
+    return {
+        'frames': num_frames,
+        'frames_per_call': frames_per_call,
+        'throughput_fps': num_frames / wall_time,
+        'latency_s': latency.summary(),
+        'cpu_s_per_frame': cpu_time / num_frames,
+        'memory_mb': memory_after,
+        'memory_growth_mb': None if memory_before is None else memory_after - memory_before
+    }
+
+
+def benchmark_recognition(frames: list, num_frames: int, **kwargs) -> dict:
+    from ImageProcessing.LegoRecognition import LegoBrickRecognition
+
+    recognition = LegoBrickRecognition(**kwargs)
+    detections = []
+    result = measure(lambda batch: detections.append(recognition.run(batch[0])), frames, num_frames)
+    result['detection_rate'] = float(np.mean(detections))
+    result['settings'] = kwargs
+    return result
+
+
+def benchmark_sorting(frames: list, num_frames: int, weights: str, batch_size: int, backend='eager',
+                      backend_model_path=None) -> dict:
+    from ImageProcessing.LegoSorting import LegoBrickSorting
+
+    sorting = LegoBrickSorting(weights, backend=backend, backend_model_path=backend_model_path)
+    result = measure(sorting.run_batch, frames, num_frames, frames_per_call=batch_size)
+    result['settings'] = {'backend': backend, 'batch_size': batch_size}
+    return result
+
+
+def benchmark_transport(frames: list, num_frames: int, address: str, max_in_flight=4, encoding=None) -> dict:
+    """Publish frames over ZeroMQ and measure publish to callback latency, at most max_in_flight frames are queued.
+    With an encoding (see Node/FrameEncoding.py) the frames are compressed by the publisher and decoded by the
+    subscriber, both are part of the latency."""
+    from Node.AbstractNode import ZeroMQPublisher, ZeroMQSubscriber, Topics
+    from Node.Message import CameraMessage
+
+    publisher = ZeroMQPublisher(address, encodings={Topics['IMAGE_RGB']: encoding} if encoding else None)
+    subscriber = ZeroMQSubscriber(address)
+    latency = LatencyHistogram()
+    decode = LatencyHistogram()
+    in_flight = threading.Semaphore(max_in_flight)
+    received = threading.Event()
+    count = [0]
+    received_bytes = [0]
+
+    def callback(topic, header, *buffers):
+        started = trace_now()
+        message = CameraMessage.deserialize(header, *buffers)
+        decode.record((trace_now() - started) / 1e9)
+        latency.record((trace_now() - message.trace['camera']) / 1e9)
+        received_bytes[0] += len(header) + sum(len(memoryview(buffer)) for buffer in buffers)
+        in_flight.release()
+        count[0] += 1
+        if count[0] == num_frames:
+            received.set()
+
+    threading.Thread(target=subscriber.subscribe, args=(callback, Topics['IMAGE_RGB']), daemon=True).start()
+    # pub/sub slow joiner, give the subscription time to reach the publisher
+    time.sleep(0.5)
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for sequence in range(num_frames):
+        in_flight.acquire()
+        message = CameraMessage({'image': frames[sequence % len(frames)], 'time_stamp': time.time(),
+                                 'sequence': sequence, 'trace': {'camera': trace_now()}})
+        publisher.publish_message(Topics['IMAGE_RGB'], message)
+    received.wait(timeout=60)
+    wall_time = time.perf_counter() - wall_start
+    frame_bytes = frames[0].nbytes
+
+    return {
+        'frames': count[0],
+        'throughput_fps': count[0] / wall_time,
+        'throughput_mb_s': count[0] * frame_bytes / wall_time / 2**20,
+        'bytes_per_frame': received_bytes[0] / max(count[0], 1),
+        'compression_ratio': frame_bytes * count[0] / max(received_bytes[0], 1),
+        'encode_ms_per_frame': publisher.statistics.get('encode_ms_per_frame', 0.0),
+        'decode_s': decode.summary(),
+        'latency_s': latency.summary(),
+        'cpu_s_per_frame': (time.process_time() - cpu_start) / max(count[0], 1),
+        'memory_mb': resident_memory_mb(),
+        'settings': {'address': address, 'max_in_flight': max_in_flight, 'encoding': encoding or 'raw'}
+    }
+
+
+def benchmark_encodings(frames: list, num_frames: int, address: str, encodings: list) -> dict:
+    """benchmark_transport for every encoding, each on its own port after the port of address.
+    Encodings whose package is not installed are skipped and recorded as {'skipped': reason}"""
+    url, port = address.rsplit(':', 1)
+    results = {}
+    for offset, encoding in enumerate(encodings, start=1):
+        try:
+            FrameEncoding.parse(encoding)
+        except ImportError as e:
+            print(f"  Skipping {encoding}: {e}")
+            results[encoding] = {'skipped': str(e)}
+            continue
+        print(f"  {encoding} ...")
+        results[encoding] = benchmark_transport(frames, num_frames, f"{url}:{int(port) + offset}", encoding=encoding)
+    return results
+
+
+def compare(results: dict, baseline: dict, prefix=""):
+    # print the relative change of every numeric metric present in both runs
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and isinstance(baseline[key], dict):
+            compare(value, baseline[key], f"{name}.")
+        elif isinstance(value, (int, float)) and isinstance(baseline[key], (int, float)) and baseline[key]:
+            change = (value - baseline[key]) / abs(baseline[key]) * 100
+            print(f"{name:60s} {baseline[key]:12.6g} -> {value:12.6g} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Lego pipeline stages on synthetic camera frames")
+    parser.add_argument('--frames', type=int, default=300, help="frames processed per benchmark")
+    parser.add_argument('--unique-frames', type=int, default=60, help="distinct frames rendered and cycled through")
+    parser.add_argument('--resolution', default='1920x1080', help="WIDTHxHEIGHT of the synthetic frames")
+    parser.add_argument('--fps', type=int, default=30, help="frame rate of the synthetic camera")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic scene")
+    parser.add_argument('--source-dir', help="replay images from this directory instead of rendering")
+    parser.add_argument('--recording', help="benchmark on the frames of a RecorderNode recording instead of rendering")
+    parser.add_argument('--recognition-downscale', type=int, default=1, help="LegoBrickRecognition downscale setting")
+    parser.add_argument('--sorting-weights', help="model weights, the sorting benchmark is skipped without them")
+    parser.add_argument('--sorting-batch-size', type=int, default=1)
+    parser.add_argument('--sorting-backend', default='eager')
+    parser.add_argument('--sorting-backend-model', help="exported model for the torchscript and onnxruntime backends")
+    parser.add_argument('--address', default='tcp://127.0.0.1:5599', help="address of the transport benchmark")
+    parser.add_argument('--encodings', default='png,jpeg:90',
+                        help="comma separated frame encodings benchmarked over transport, empty to skip, "
+                             "lz4 and zstd need their packages and are skipped without them")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help="results json of a previous run to compare against")
+    args = parser.parse_args()
+
+    if args.recording:
+        from Device.ReplayCamera import ReplayCamera
+        # the recorded frames stay memory mapped, only the frames benchmarked are read from disk
+        frames = list(ReplayCamera(args.recording).frames())[:args.unique_frames]
+    else:
+        width, height = (int(value) for value in args.resolution.split('x'))
+        camera = SyntheticCamera(resolution=(width, height), framerate=args.fps, seed=args.seed,
+                                 source_dir=args.source_dir)
+        frames = [camera.render_frame(index) for index in range(args.unique_frames)]
+
+    results = {}
+    print("Benchmarking recognition ...")
+    results['recognition'] = benchmark_recognition(frames, args.frames, downscale=args.recognition_downscale)
+    if args.sorting_weights:
+        print("Benchmarking sorting ...")
+        results['sorting'] = benchmark_sorting(frames, args.frames, args.sorting_weights, args.sorting_batch_size,
+                                               args.sorting_backend, args.sorting_backend_model)
+    else:
+        print("Skipping sorting, no --sorting-weights given")
+    print("Benchmarking transport ...")
+    results['transport'] = benchmark_transport(frames, args.frames, args.address)
+    if args.encodings:
+        print("Benchmarking encoded transport ...")
+        results['encoding'] = benchmark_encodings(frames, args.frames, args.address, args.encodings.split(','))
+
+    report = {
+        'config': vars(args),
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'numpy': np.__version__
+        },
+        'time': time.time(),
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file)['results'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Ring buffer and drop oldest queue behaviour, run with python -m pytest Testing"""
+
+from Buffer.RingBuffer import RingBuffer
+from Buffer.DropOldestQueue import DropOldestQueue
+import numpy as np
+import pytest
+import queue
+
+
+@pytest.fixture
+def ring_buffer():
+    buffer = RingBuffer(size=4, frame_shape=(8, 8, 3), num_readers=2)
+    yield buffer
+    buffer.close()
+    buffer.unlink()
+
+
+def frame(value: int) -> np.ndarray:
+    return np.full((8, 8, 3), value, dtype=np.uint8)
+
+
+def test_ring_buffer_returns_frames_by_sequence(ring_buffer):
+    sequences = [ring_buffer.add(frame(value)) for value in (1, 2, 3)]
+    assert sequences == [1, 2, 3]
+    for sequence, value in zip(sequences, (1, 2, 3)):
+        assert not ring_buffer.is_overwritten(sequence)
+        assert ring_buffer.get_by_sequence(sequence)[0, 0, 0] == value
+    assert ring_buffer.get_by_sequence(4) is None
+
+
+def test_ring_buffer_overwrites_oldest_frame(ring_buffer):
+    for value in range(1, 6):
+        ring_buffer.add(frame(value))
+    # five frames in four slots, the first one is gone
+    assert ring_buffer.is_overwritten(1)
+    assert ring_buffer.get_by_sequence(1) is None
+    assert ring_buffer.get_by_sequence(5)[0, 0, 0] == 5
+
+
+def test_ring_buffer_claim_invalidates_slot_before_writing(ring_buffer):
+    for value in range(1, 5):
+        ring_buffer.add(frame(value))
+    # the next slot still holds frame 1, it must not be readable while the camera fills it
+    slot = ring_buffer.claim()
+    assert ring_buffer.is_overwritten(1)
+    assert ring_buffer.get_by_sequence(1) is None
+    slot[:] = 5
+    assert ring_buffer.commit() == 5
+    assert ring_buffer.get_by_sequence(5)[0, 0, 0] == 5
+
+
+def test_ring_buffer_attached_view_sees_overwrite(ring_buffer):
+    attached = RingBuffer.attach(ring_buffer.name)
+    try:
+        sequence = ring_buffer.add(frame(1))
+        view = attached.get_by_sequence(sequence)
+        for value in range(2, 6):
+            ring_buffer.add(frame(value))
+        # the view now shows another frame, readers must check is_overwritten after using it
+        assert attached.is_overwritten(sequence)
+        assert view[0, 0, 0] == 5
+    finally:
+        del view
+        attached.close()
+
+
+def test_ring_buffer_reader_counts_dropped_frames(ring_buffer):
+    for value in range(1, 7):
+        ring_buffer.add(frame(value))
+    # frames 1 and 2 were overwritten before reader 0 got to them
+    sequence, view = ring_buffer.read(reader=0)
+    assert sequence == 3 and view[0, 0, 0] == 3
+    assert ring_buffer.dropped(reader=0) == 2
+    # readers have independent cursors
+    assert ring_buffer.read_latest(reader=1)[0] == 6
+    assert ring_buffer.dropped(reader=1) == 5
+    assert ring_buffer.read(reader=1) is None
+
+
+def test_drop_oldest_queue_drops_oldest_item():
+    pending = DropOldestQueue(2)
+    assert not pending.put(1)
+    assert not pending.put(2)
+    assert pending.put(3)
+    assert pending.dropped == 1
+    assert pending.qsize() == 2
+    assert [pending.get_nowait(), pending.get_nowait()] == [2, 3]
+
+
+def test_drop_oldest_queue_unbounded_and_empty():
+    pending = DropOldestQueue()
+    for item in range(100):
+        assert not pending.put(item)
+    assert pending.dropped == 0 and pending.qsize() == 100
+    for item in range(100):
+        assert pending.get(timeout=0.1) == item
+    with pytest.raises(queue.Empty):
+        pending.get_nowait()
+    with pytest.raises(queue.Empty):
+        pending.get(timeout=0.01)
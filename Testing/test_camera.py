@@ -0,0 +1,78 @@
+"""Frame buffer reuse of the cameras, run with python -m pytest Testing"""
+
+from Buffer.FrameRecording import FrameRecordingWriter
+from Device.Camera import Camera, CameraType
+from Device.ReplayCamera import ReplayCamera
+from Node.CameraNode import CameraNode
+import numpy as np
+import pytest
+
+
+FRAMES = 20
+
+
+def recording(tmp_path) -> str:
+    path = str(tmp_path / 'recording')
+    with FrameRecordingWriter(path, frames_per_chunk=8) as writer:
+        for number in range(FRAMES):
+            writer.append(np.full((24, 32, 3), number, dtype=np.uint8), number + 1, number / 30)
+    return path
+
+
+def test_replay_camera_returns_pool_buffers(tmp_path):
+    # replayed frames are memory mapped views and not the pooled buffers, the pooled buffers still go back
+    camera = ReplayCamera(recording(tmp_path), realtime=False)
+    received = []
+    camera.set_new_frame_callback(lambda frame: received.append(int(frame[0, 0, 0])))
+    camera.start_streaming()
+    # without loop the streaming thread ends after the last frame
+    camera._streaming_thread.join(timeout=10)
+
+    assert received == list(range(FRAMES))
+    statistics = camera.frame_pool.statistics
+    assert FRAMES > statistics['pool_size']
+    assert statistics['pool_acquired'] == FRAMES
+    assert statistics['pool_exhausted'] == 0
+    assert statistics['pool_in_use'] == 0
+
+
+def test_replay_camera_without_callback_returns_pool_buffers(tmp_path):
+    camera = ReplayCamera(recording(tmp_path), realtime=False)
+    camera._streaming = True
+    for number in range(FRAMES):
+        frame = camera.capture_new_frame()
+        assert frame[0, 0, 0] == number
+        camera.frame_pool.release(frame)
+    assert camera.frame_pool.statistics['pool_exhausted'] == 0
+    assert camera.frame_pool.in_use == 0
+
+
+def test_camera_reuses_filled_buffers():
+    camera = Camera(CameraType.Color, resolution=(32, 24), buffer_pool_size=2)
+    kept = []
+
+    def keep_first_frame(frame):
+        # a consumer keeping a frame beyond the callback retains it
+        if not kept:
+            camera.frame_pool.retain(frame)
+            kept.append(frame)
+
+    camera.set_new_frame_callback(keep_first_frame)
+    camera._streaming = True
+    for _ in range(FRAMES):
+        camera.capture_new_frame()
+    # the kept buffer stays with the consumer, all other frames cycle through the second one
+    statistics = camera.frame_pool.statistics
+    assert statistics['pool_in_use'] == 1
+    assert statistics['pool_acquired'] == FRAMES
+    assert statistics['pool_exhausted'] == 0
+    camera.frame_pool.release(kept[0])
+    assert camera.frame_pool.in_use == 0
+
+
+@pytest.mark.parametrize('roi', [(0, 0, 0, 10), (0, 0, 10, -1), (-1, 0, 10, 10), (0, -1, 10, 10), (30, 0, 10, 10),
+                                 (0, 20, 10, 10), (0, 0, 33, 24)])
+def test_camera_node_rejects_roi_outside_frame(roi):
+    camera = Camera(CameraType.Color, resolution=(32, 24))
+    with pytest.raises(ValueError):
+        CameraNode("tcp://127.0.0.1:5703", camera, None, derived_streams=['roi'], roi=roi)
@@ -0,0 +1,98 @@
+"""Crop to frame mapping and merging of CascadeDetector, run with python -m pytest Testing"""
+
+from ImageProcessing.Cascade import CascadeDetector, non_maximum_suppression
+import cv2
+import numpy as np
+
+
+def find_bricks(image: np.ndarray) -> list:
+    # (x, y, width, height) of every bright rectangle, also the parts of rectangles cut off by the image border
+    count, _, stats, _ = cv2.connectedComponentsWithStats((image[..., 0] > 0).astype(np.uint8))
+    return [tuple(int(value) for value in stats[label, :4]) for label in range(1, count)]
+
+
+class StubDetector:
+    def detect_bricks(self, image: np.ndarray) -> list:
+        return find_bricks(image)
+
+
+class StubClassifier:
+    """Detects every rectangle visible in a crop, in crop coordinates, scored by its brightness"""
+
+    def __init__(self):
+        self.crops = []
+
+    def run_batch(self, crops: list) -> list:
+        self.crops.extend(crop.shape for crop in crops)
+        results = []
+        for crop in crops:
+            bricks = find_bricks(crop)
+            results.append({
+                'boxes': np.array([(x, y, x + w, y + h) for x, y, w, h in bricks], dtype=np.float32).reshape(-1, 4),
+                'scores': np.array([crop[y, x, 0] / 255 for x, y, _, _ in bricks], dtype=np.float32),
+                'labels': np.ones(len(bricks), dtype=np.int64)
+            })
+        return results
+
+
+def scene(*bricks, shape=(480, 640, 3)) -> np.ndarray:
+    image = np.zeros(shape, dtype=np.uint8)
+    for x, y, w, h, value in bricks:
+        image[y:y + h, x:x + w] = value
+    return image
+
+
+def corners(*bricks) -> list:
+    return sorted((x, y, x + w, y + h) for x, y, w, h, _ in bricks)
+
+
+def detected(result: dict) -> list:
+    return sorted(tuple(int(round(value)) for value in box) for box in result['boxes'].tolist())
+
+
+def test_non_maximum_suppression_keeps_best_of_overlapping_boxes():
+    boxes = np.array([[0, 0, 10, 10], [1, 0, 11, 10], [20, 20, 30, 30], [0, 0, 10, 10], [5, 0, 15, 10]],
+                     dtype=np.float32)
+    scores = np.array([0.6, 0.9, 0.5, 0.6, 0.7], dtype=np.float32)
+    # box 1 wins over its duplicates 0 and 3, box 4 overlaps it by 6/14 only and box 2 by nothing
+    assert non_maximum_suppression(boxes, scores, 0.5).tolist() == [1, 4, 2]
+    assert non_maximum_suppression(boxes, scores, 0.3).tolist() == [1, 2]
+    assert non_maximum_suppression(np.empty((0, 4), np.float32), np.empty(0, np.float32)).tolist() == []
+
+
+def test_overlapping_crops_detect_each_brick_once():
+    # both windows show both bricks and the neighbours lie within the padding, so each brick is detected twice
+    bricks = [(100, 100, 20, 20, 200), (125, 100, 20, 20, 250)]
+    classifier = StubClassifier()
+    cascade = CascadeDetector(StubDetector(), classifier, crop_size=(128, 128), padding=16)
+    result = cascade.run(scene(*bricks))
+
+    assert classifier.crops == [(128, 128, 3)] * 2
+    assert detected(result) == corners(*bricks)
+    assert sorted(result['scores'].tolist()) == sorted(np.float32(value / 255) for *_, value in bricks)
+    assert result['regions'] == [brick[:4] for brick in bricks]
+
+
+def test_crops_at_frame_border_map_back_to_frame():
+    # windows of bricks in the corners are shifted inside the frame, their offset is not centered on the brick
+    bricks = [(0, 0, 20, 20, 200), (620, 460, 20, 20, 200), (0, 300, 30, 10, 200)]
+    result = CascadeDetector(StubDetector(), StubClassifier(), crop_size=(128, 128), padding=16).run(scene(*bricks))
+    assert detected(result) == corners(*bricks)
+
+
+def test_bricks_cut_by_crop_border_are_left_to_their_own_crop():
+    # the window of the small brick shows the left end of the long brick, its window grows to show all of it
+    bricks = [(200, 200, 20, 20, 200), (250, 190, 100, 40, 200)]
+    classifier = StubClassifier()
+    result = CascadeDetector(StubDetector(), classifier, crop_size=(128, 128), padding=16).run(scene(*bricks))
+    assert sorted(classifier.crops) == [(128, 128, 3), (128, 132, 3)]
+    assert detected(result) == corners(*bricks)
+
+
+def test_batch_keeps_detections_of_each_frame_apart():
+    frames = [scene((10, 10, 20, 20, 200)), scene(), scene((300, 200, 20, 20, 200), (400, 50, 30, 30, 200))]
+    cascade = CascadeDetector(StubDetector(), StubClassifier(), crop_size=(64, 64), padding=8)
+    results = cascade.run_batch(frames)
+    assert [detected(result) for result in results] == [
+        corners((10, 10, 20, 20, 0)), [], corners((300, 200, 20, 20, 0), (400, 50, 30, 30, 0))]
+    assert cascade.statistics == {'frames_gated': 1, 'candidates': 3, 'crops_classified': 3}
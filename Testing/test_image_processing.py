@@ -0,0 +1,62 @@
+"""Equivalence of the optimized image processing steps with the reference implementations"""
+
+from ImageProcessing.LegoRecognition import LegoBrickRecognition
+from ImageProcessing.LegoSorting import LegoBrickSorting
+import cv2
+import numpy as np
+import pytest
+
+
+def random_mask(rng: np.random.Generator) -> np.ndarray:
+    # cluttered mask of rectangles, circles and noise blobs
+    mask = np.zeros((240, 320), dtype=np.uint8)
+    for _ in range(rng.integers(1, 8)):
+        x, y = rng.integers(0, 300), rng.integers(0, 220)
+        if rng.random() < 0.5:
+            cv2.rectangle(mask, (int(x), int(y)), (int(x + rng.integers(2, 60)), int(y + rng.integers(2, 60))), 255, -1)
+        else:
+            cv2.circle(mask, (int(x), int(y)), int(rng.integers(1, 30)), 255, -1)
+    noise = rng.random(mask.shape) < 0.002
+    mask[noise] = 255
+    return mask
+
+
+def test_classify_contours_matches_per_contour_checks():
+    recognition = LegoBrickRecognition(shape_threshold=0.9)
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        contours, _ = cv2.findContours(random_mask(rng), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        # the per contour checks divide by the area, contours without area are skipped by both
+        contours = [contour for contour in contours if cv2.contourArea(contour) > 0]
+        circles, rectangles = recognition.classify_contours(contours)
+        expected_circles = [contour for contour in contours if recognition.check_circularity(contour)]
+        expected_rectangles = [contour for contour in contours if recognition.check_rectangularity(contour)]
+        assert [id(contour) for contour in circles] == [id(contour) for contour in expected_circles]
+        assert [id(contour) for contour in rectangles] == [id(contour) for contour in expected_rectangles]
+
+
+def test_numpy_to_tensor_matches_torchvision_transforms():
+    torch = pytest.importorskip('torch')
+    transforms = pytest.importorskip('torchvision.transforms')
+    from PIL import Image
+
+    # only the preprocessing is tested, the model is not loaded
+    sorting = LegoBrickSorting.__new__(LegoBrickSorting)
+    sorting.device = torch.device('cpu')
+    sorting.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+    sorting.std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+    sorting.reuse_input_buffer = True
+    sorting._input_buffer = None
+
+    reference = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (48, 64, 3), dtype=np.uint8) for _ in range(3)]
+    expected = torch.cat([reference(Image.fromarray(image, 'RGB')).unsqueeze(0) for image in images])
+
+    for _ in range(2):
+        # the second call reuses the input buffer
+        batch = sorting._numpy_to_tensor(images)
+        assert batch.shape == expected.shape
+        assert torch.equal(batch, expected)
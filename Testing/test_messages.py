@@ -0,0 +1,100 @@
+"""Wire format of the messages between nodes, run with python -m pytest Testing"""
+
+from Node.AbstractNode import ZeroMQPublisher, ZeroMQSubscriber
+from Node.Message import CameraMessage, FrameSetMessage
+import numpy as np
+import pytest
+import queue
+import threading
+
+
+ADDRESS = "tcp://127.0.0.1:5701"
+
+
+def images() -> dict:
+    rng = np.random.default_rng(0)
+    large = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    return {
+        # above 64KB zmq sends the array memory without copying
+        'uint8_large': large,
+        'uint8_small': rng.integers(0, 256, (8, 12, 3), dtype=np.uint8),
+        'uint16_gray': rng.integers(0, 65536, (64, 48), dtype=np.uint16),
+        'float32_4d': rng.random((2, 10, 20, 4), dtype=np.float32),
+        'strided': large[::2, ::3],
+        'transposed': large.transpose(1, 0, 2),
+        'channel': large[..., 1]
+    }
+
+
+def message(image) -> CameraMessage:
+    return CameraMessage({'camera_info': "Camera Color", 'time_stamp': 12.5, 'sequence': 7,
+                          'trace': {'camera': 1}, 'ring_buffer': 'psm_test', 'image': image})
+
+
+def assert_same_message(received: CameraMessage, sent: CameraMessage):
+    assert received.camera_info == sent.camera_info
+    assert received.timestamp == sent.timestamp
+    assert received.sequence == sent.sequence
+    assert received.trace == sent.trace
+    assert received.content['ring_buffer'] == sent.content['ring_buffer']
+    if sent.image is None:
+        assert received.image is None
+    else:
+        assert received.image.dtype == sent.image.dtype
+        assert received.image.shape == sent.image.shape
+        np.testing.assert_array_equal(received.image, sent.image)
+
+
+@pytest.mark.parametrize('name', list(images()))
+def test_serialize_round_trip(name):
+    sent = message(images()[name])
+    header, buffer = sent.serialize()
+    assert_same_message(CameraMessage.deserialize(header, memoryview(buffer)), sent)
+
+
+def test_serialize_without_image():
+    # frames only referenced in a ring buffer have no image frame
+    sent = message(None)
+    frames = sent.serialize()
+    assert len(frames) == 1
+    assert_same_message(CameraMessage.deserialize(*frames), sent)
+
+
+def test_frame_set_round_trip():
+    sent = FrameSetMessage({'time_stamp': 1.0, 'sequence': 3,
+                            'frames': {'rgb': message(images()['strided']), 'tof': message(None)}})
+    received = FrameSetMessage.deserialize(*[memoryview(frame) if i else frame
+                                             for i, frame in enumerate(sent.serialize())])
+    assert received.sequence == 3
+    assert set(received.frames) == {'rgb', 'tof'}
+    for name in ('rgb', 'tof'):
+        assert_same_message(received.frames[name], sent.frames[name])
+
+
+def test_zeromq_round_trip():
+    publisher = ZeroMQPublisher(ADDRESS)
+    subscriber = ZeroMQSubscriber(ADDRESS)
+    received = queue.Queue()
+    threading.Thread(target=subscriber.subscribe, daemon=True,
+                     args=(lambda topic, *frames: received.put(CameraMessage.deserialize(*frames)), b'test')).start()
+
+    # the subscription reaches the publisher asynchronously, publish until the first message arrives
+    warmup = CameraMessage({'sequence': -1, 'image': None})
+    for _ in range(100):
+        publisher.publish_message(b'test', warmup)
+        try:
+            received.get(timeout=0.05)
+            break
+        except queue.Empty:
+            pass
+    else:
+        pytest.fail("The subscriber received nothing.")
+
+    sent = [message(image) for image in images().values()] + [message(None)]
+    for msg in sent:
+        publisher.publish_message(b'test', msg)
+    for msg in sent:
+        received_message = received.get(timeout=5)
+        while received_message.sequence == -1:
+            received_message = received.get(timeout=5)
+        assert_same_message(received_message, msg)
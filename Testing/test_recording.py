@@ -0,0 +1,97 @@
+"""Recording frames to disk and replaying them as a camera, run with python -m pytest Testing"""
+
+from Buffer.FrameRecording import FrameRecording, FrameRecordingWriter
+from Device.ReplayCamera import ReplayCamera
+from Node.Message import CameraMessage
+from Node.RecorderNode import RecorderNode
+import json
+import numpy as np
+import os
+import pytest
+
+
+def frame(value: int, shape=(24, 32, 3)) -> np.ndarray:
+    return np.full(shape, value, dtype=np.uint8)
+
+
+def record(path: str, frames: list, frames_per_chunk=4):
+    with FrameRecordingWriter(path, frames_per_chunk, camera_info="Camera Color") as writer:
+        for number, image in enumerate(frames):
+            writer.append(image, sequence=number + 1, timestamp=100.0 + number / 30)
+
+
+def replay(camera: ReplayCamera, count: int) -> list:
+    frames = []
+    camera.set_new_frame_callback(lambda image: frames.append(np.array(image)))
+    # capture_new_frame only delivers frames while streaming, the streaming thread is not needed here
+    camera._streaming = True
+    for _ in range(count):
+        camera.capture_new_frame()
+    camera._streaming = False
+    return frames
+
+
+def test_record_and_replay_round_trip(tmp_path):
+    path = str(tmp_path / 'recording')
+    frames = [frame(value) for value in range(10)]
+    # several chunks, the last one not full
+    record(path, frames)
+
+    recording = FrameRecording(path)
+    assert len(recording) == 10
+    assert recording.camera_info == "Camera Color"
+    np.testing.assert_array_equal(recording.sequences, np.arange(1, 11))
+    np.testing.assert_allclose(recording.timestamps, 100.0 + np.arange(10) / 30)
+
+    camera = ReplayCamera(path, realtime=False)
+    assert camera.frame_shape == (24, 32, 3)
+    assert camera.framerate == 30
+    replayed = replay(camera, 10)
+    for expected, actual in zip(frames, replayed):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_writer_rejects_shape_change(tmp_path):
+    path = str(tmp_path / 'recording')
+    with FrameRecordingWriter(path, frames_per_chunk=4) as writer:
+        writer.append(frame(1))
+        with pytest.raises(ValueError):
+            writer.append(frame(2, shape=(48, 64, 3)))
+        with pytest.raises(ValueError):
+            writer.append(frame(3).astype(np.uint16))
+        writer.append(frame(4))
+    assert len(FrameRecording(path)) == 2
+
+
+def test_recorder_starts_new_recording_on_shape_change(tmp_path):
+    path = str(tmp_path / 'recording')
+    recorder = RecorderNode("tcp://127.0.0.1:5702", path, frames_per_chunk=4)
+    shapes = [(24, 32, 3)] * 3 + [(48, 64, 3)] * 2
+    for number, shape in enumerate(shapes):
+        recorder._pending.put((CameraMessage({'camera_info': "Camera Color", 'time_stamp': float(number),
+                                              'sequence': number + 1}), frame(number, shape)))
+    recorder._pending.put(None)
+    recorder._write_frames()
+
+    assert recorder.recordings == 2
+    assert recorder.frames_recorded == 5
+    first, second = FrameRecording(path), FrameRecording(f"{path}_1")
+    assert [image.shape for image in first] == [(24, 32, 3)] * 3
+    np.testing.assert_array_equal(second.sequences, [4, 5])
+    np.testing.assert_array_equal(replay(ReplayCamera(f"{path}_1", realtime=False), 2)[1], frame(4, (48, 64, 3)))
+
+
+def test_replay_rejects_mixed_shapes(tmp_path):
+    # recordings written before the writer rejected shape changes may hold chunks of several shapes
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    record(first, [frame(1)] * 4)
+    record(second, [frame(2, shape=(48, 64, 3))] * 4)
+    os.replace(os.path.join(second, 'chunk_00000.raw'), os.path.join(first, 'chunk_00001.raw'))
+    with open(os.path.join(first, 'recording.json')) as file:
+        metadata = json.load(file)
+    metadata['chunks'].append({'file': 'chunk_00001.raw', 'shape': [48, 64, 3], 'dtype': '|u1'})
+    with open(os.path.join(first, 'recording.json'), 'w') as file:
+        json.dump(metadata, file)
+
+    with pytest.raises(ValueError):
+        ReplayCamera(first, realtime=False)
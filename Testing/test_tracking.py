@@ -0,0 +1,101 @@
+"""Track matching and classify once behaviour of TrackingClassifier, run with python -m pytest Testing"""
+
+from ImageProcessing.Tracking import IoUTracker, TrackingClassifier
+import cv2
+import numpy as np
+import pytest
+
+
+class StubDetector:
+    def detect_bricks(self, image: np.ndarray) -> list:
+        count, _, stats, _ = cv2.connectedComponentsWithStats((image > 0).astype(np.uint8))
+        return [tuple(int(value) for value in stats[label, :4]) for label in range(1, count)]
+
+
+class StubClassifier:
+    """Classifies a crop as the brick drawn in it, bricks are drawn with their number as pixel value"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.classified = []
+
+    def run_batch(self, crops: list) -> list:
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("classifier failed")
+        results = [f"brick {crop.max()}" for crop in crops]
+        self.classified.extend(results)
+        return results
+
+
+def belt(frames: int, bricks: dict, step=8, shape=(120, 400)) -> list:
+    # bricks: number -> (x, y) on the first frame, they move step pixels to the right on every frame
+    images = []
+    for frame in range(frames):
+        image = np.zeros(shape, dtype=np.uint8)
+        for number, (x, y) in bricks.items():
+            x += frame * step
+            image[y:y + 20, x:x + 20] = number
+        images.append(image)
+    return images
+
+
+def tracking_classifier(classifier, **kwargs) -> TrackingClassifier:
+    return TrackingClassifier(StubDetector(), classifier, crop_size=(32, 32), **kwargs)
+
+
+def test_tracker_follows_moving_boxes():
+    tracker = IoUTracker(iou_threshold=0.3, max_distance=50.0, max_misses=1)
+    first, _ = tracker.update([(0, 0, 20, 20), (100, 0, 20, 20)])
+    # listed in the other order and moved further than the boxes overlap, matched by their predicted centroids
+    second, new = tracker.update([(130, 0, 20, 20), (30, 0, 20, 20)])
+    assert new == []
+    assert [track.track_id for track in second] == [first[1].track_id, first[0].track_id]
+    assert first[0].velocity == (30.0, 0.0)
+    # the prediction keeps the velocity, the box overlaps it fully, the second brick left the view and a new one
+    # entered too far from its prediction
+    third, new = tracker.update([(60, 0, 20, 20), (300, 0, 20, 20)])
+    assert third[0] is first[0]
+    assert [track.track_id for track in new] == [3]
+    # tracks survive max_misses missed frames
+    assert first[1] in tracker.tracks
+    tracker.update([(90, 0, 20, 20)])
+    assert first[1] not in tracker.tracks
+
+
+def test_every_brick_is_classified_once():
+    classifier = StubClassifier()
+    tracking = tracking_classifier(classifier)
+    images = belt(12, {1: (10, 10), 2: (10, 70)})
+    results = []
+    for start in range(0, len(images), 4):
+        results.extend(tracking.run_batch(images[start:start + 4]))
+
+    assert sorted(classifier.classified) == ["brick 1", "brick 2"]
+    for frame in results:
+        assert sorted(track['result'] for track in frame) == ["brick 1", "brick 2"]
+        assert {track['classified_frame'] for track in frame} == {1}
+    assert tracking.statistics == {'tracks': 2, 'classifications': 2, 'cached_results': 22}
+
+
+def test_failed_classification_is_retried():
+    classifier = StubClassifier(failures=1)
+    tracking = tracking_classifier(classifier)
+    images = belt(6, {1: (10, 10), 2: (10, 70)})
+    with pytest.raises(RuntimeError):
+        tracking.run_batch(images[:2])
+    # the failed frames did not mark the tracks classified, the next batch classifies them, and only once
+    results = tracking.run_batch(images[2:])
+    assert sorted(classifier.classified) == ["brick 1", "brick 2"]
+    for frame in results:
+        assert sorted(track['result'] for track in frame) == ["brick 1", "brick 2"]
+        assert {track['classified_frame'] for track in frame} == {3}
+
+
+def test_tracks_are_classified_again_after_interval():
+    classifier = StubClassifier()
+    tracking = tracking_classifier(classifier, reclassify_interval=4)
+    for image in belt(9, {1: (10, 10)}):
+        tracking.run(image)
+    # frames 1, 5 and 9
+    assert classifier.classified == ["brick 1"] * 3
@@ -1,22 +1,34 @@
-from Device.Camera import Camera
+from Device.Camera import Camera, CameraType
 from Buffer.RingBuffer import RingBuffer
 from ImageProcessing.LegoRecognition import LegoBrickRecognition
 from ImageProcessing.LegoSorting import LegoBrickSorting
+from ImageProcessing.Tracking import TrackingClassifier
 from Node.ImageProcessingNode import ImageProcessingNode
 from Node.CameraNode import CameraNode
+from Node.ImageProcessingPool import ImageProcessingPool
+from Node.AbstractNode import Broker
 from Node.SystemLogingNode import LoggingNode
+from Node.Pipeline import PipelineLauncher, load_config
 
+import argparse
+import multiprocessing
+import os
 import threading
 
 
-def main():
-    # Define address
-    url = "tcp://127.0.0.1:5555"
+def main(metrics_dir=None):
+    # All nodes publish to and subscribe from one broker, nodes of this process talk to it over inproc://
+    # a few frames per subscriber are queued in the broker, see receive_hwm of the nodes
+    broker = Broker(send_hwm=8)
+    broker.start()
+    url = broker.local_endpoints
 
     # Create a camera node
-    camera = Camera()
-    buffer = RingBuffer()
-    camera_node = CameraNode(address=url, camera=camera, ring_buffer=buffer)
+    camera = Camera(CameraType.Color)
+    # frames live in shared memory, so nodes can also be moved into their own processes
+    buffer = RingBuffer(size=16, frame_shape=camera.frame_shape, dtype=camera.dtype)
+    # a few frames per subscriber at most, slow subscribers lose frames instead of building up latency
+    camera_node = CameraNode(address=url, camera=camera, ring_buffer=buffer, send_hwm=4)
 
     # Start the camera node in a separate thread to simulate continuous operation
     camera_thread = threading.Thread(target=camera_node.run)
@@ -24,26 +36,94 @@ def main():
 
     # Create a image processing node with specified method and subscribe to a url where the image data is posted
     brick_recognition_method = LegoBrickRecognition()
-    brick_recognition_node = ImageProcessingNode(url, brick_recognition_method)    
+    # frames of an unchanged belt reuse the previous result instead of being processed again
+    brick_recognition_node = ImageProcessingNode(url, brick_recognition_method, change_threshold=2.0)
 
     # Start recognition node in a separate thread
     processing_thread = threading.Thread(target=brick_recognition_node.run)
     processing_thread.start()
 
     # Easy to switch to another method for different vision inspection task such as sorting
-    brick_sorting_method = LegoBrickSorting()
-    brick_sorting_node = ImageProcessingNode(url, brick_sorting_method)    
+    # bricks are tracked across frames with the cheap recognition, the model only classifies a crop of each new brick
+    # and is warmed up with a full batch of such crops
+    brick_sorting_method = TrackingClassifier(LegoBrickRecognition(),
+                                              LegoBrickSorting(warmup_shape=(256, 256, 3), warmup_batch_size=4),
+                                              crop_size=(256, 256))
+    # batch frames for the detection model, one forward pass is much cheaper than several single image passes
+    # stale frames are worthless for sorting, keep at most one batch waiting and drop the oldest frames
+    brick_sorting_node = ImageProcessingNode(url, brick_sorting_method, max_batch_size=4, max_batch_wait=0.05,
+                                             change_threshold=2.0, queue_size=4, receive_hwm=4)
 
     # Start sorting node in a separate thread
     processing_thread = threading.Thread(target=brick_sorting_node.run)
     processing_thread.start()
 
+    # Stage latency histograms of every node are published periodically and optionally written to json files
+    for name, node in (('camera', camera_node), ('recognition', brick_recognition_node), ('sorting', brick_sorting_node)):
+        node.export_metrics(os.path.join(metrics_dir, f"{name}_metrics.json") if metrics_dir else None)
+
     # Start logging node in a separate thread
     logging_node = LoggingNode(url)
     logging_thread = threading.Thread(target=logging_node.run)
     logging_thread.start()
 
 
+def run_camera_node(url):
+    camera = Camera(CameraType.Color)
+    buffer = RingBuffer(size=16, frame_shape=camera.frame_shape, dtype=camera.dtype)
+    CameraNode(address=url, camera=camera, ring_buffer=buffer).run()
+
+
+def run_processing_pool(url, work_url: str, collect_url: str, algorithm_class: type,
+                        num_workers: int, max_batch_size=1, max_batch_wait=0.0):
+    # results are published through the broker as well
+    # every worker queues one batch at most, frames beyond that are dropped by the pool instead of piling up
+    pool = ImageProcessingPool(url, None, work_url, collect_url, algorithm_class,
+                               num_workers=num_workers, max_batch_size=max_batch_size, max_batch_wait=max_batch_wait,
+                               node_kwargs={'queue_size': max_batch_size})
+    pool.run()
+
+
+def run_logging_node(url):
+    LoggingNode(url).run()
+
+
+def main_processes(recognition_workers: int, sorting_workers: int):
+    """Every node runs in its own process, image processing is spread over a pool of worker processes per algorithm"""
+    # the broker runs in this process, the nodes connect to its tcp endpoints
+    broker = Broker("tcp://127.0.0.1:5555", "tcp://127.0.0.1:5556", send_hwm=8)
+    broker.start()
+    url = broker.endpoints
+    recognition_urls = ("tcp://127.0.0.1:5557", "tcp://127.0.0.1:5558")
+    sorting_urls = ("tcp://127.0.0.1:5559", "tcp://127.0.0.1:5560")
+
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_camera_node, args=(url,)),
+        context.Process(target=run_processing_pool,
+                        args=(url, *recognition_urls, LegoBrickRecognition, recognition_workers)),
+        context.Process(target=run_processing_pool,
+                        args=(url, *sorting_urls, LegoBrickSorting, sorting_workers, 4, 0.05)),
+        context.Process(target=run_logging_node, args=(url,)),
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Lego brick recognition and sorting pipeline")
+    parser.add_argument('--config', help="pipeline json/yaml file, see Node/Pipeline.py and pipeline.json")
+    parser.add_argument('--processes', action='store_true', help="run every node in its own process")
+    parser.add_argument('--recognition-workers', type=int, default=2, help="recognition worker processes")
+    parser.add_argument('--sorting-workers', type=int, default=1, help="sorting worker processes")
+    parser.add_argument('--metrics-dir', help="directory for per node latency metrics json files")
+    args = parser.parse_args()
+
+    if args.config:
+        PipelineLauncher(load_config(args.config)).run()
+    elif args.processes:
+        main_processes(args.recognition_workers, args.sorting_workers)
+    else:
+        main(args.metrics_dir)